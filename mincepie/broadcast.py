@@ -0,0 +1,198 @@
+"""
+The broadcast module ships read-only data, such as a lookup table, a model or
+a vocabulary, from the server to the clients.
+
+Instead of having every client load the same file in set_up() (and hammer the
+same NFS server at the same moment), register the file as a named blob, either
+with the --broadcast flag or by calling
+    broadcast.register('vocab', '/path/to/vocab.txt')
+at the top level of your script. The server announces the blobs to each
+client when it connects. A client only downloads the blobs that are not in the
+local cache directory yet, where they are stored under their content hash, so
+the clients of a node (and the later runs of the job) share a single copy. The
+client runs no task before its blobs are complete.
+
+In the mapper or reducer, use
+    broadcast.get('vocab')
+to get a read-only mmap of the blob, which can be wrapped without copying
+(e.g. with numpy.frombuffer), or broadcast.path('vocab') to get the local file
+name. Since the pages are mapped from the same cached file, the clients of a
+node share their memory. When no server sent the blob (e.g. with
+--launch=inline, or under the native MPI transport), the registered file is
+used directly.
+
+Flags defined by this module:
+    --broadcast: a name=path pair registering a blob. Can be specified
+        multiple times.
+    --broadcast_cache_dir: the local directory where the clients cache the
+        blobs. Default "", which means a mincepie-broadcast directory in the
+        system temporary directory.
+"""
+
+# python modules
+import gflags
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+
+gflags.DEFINE_multistring("broadcast", [],
+    "A name=path pair registering a blob to send to the clients")
+gflags.DEFINE_string("broadcast_cache_dir", "",
+    "The local directory where the clients cache the blobs")
+FLAGS = gflags.FLAGS
+
+# the size of the blob chunks sent to the clients
+CHUNK_SIZE = 1 << 20
+
+# name -> [path, sha1 or None if not computed yet]
+_BLOBS = {}
+# name -> mmap, for the blobs opened by get()
+_MAPS = {}
+
+
+def register(name, path, sha1=None):
+    """Registers the file at path as the blob with the given name.
+    """
+    _BLOBS[name] = [path, sha1]
+    _MAPS.pop(name, None)
+
+
+def _registry():
+    for entry in FLAGS.broadcast:
+        name, _, path = entry.partition('=')
+        if name not in _BLOBS:
+            register(name, path)
+    return _BLOBS
+
+
+def path(name):
+    """Returns the local file name of a blob.
+    """
+    try:
+        return _registry()[name][0]
+    except KeyError:
+        raise KeyError("Unknown broadcast blob: %s" % name)
+
+
+def get(name):
+    """Returns a read-only mmap of a blob (or an empty string if the blob is
+    empty, as empty files cannot be mapped).
+    """
+    if name not in _MAPS:
+        with open(path(name), 'rb') as fid:
+            if os.fstat(fid.fileno()).st_size == 0:
+                _MAPS[name] = b''
+            else:
+                _MAPS[name] = mmap.mmap(fid.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+    return _MAPS[name]
+
+
+def file_sha1(filename):
+    """Returns the hex sha1 digest of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        while True:
+            data = fid.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def manifest():
+    """Returns the list of (name, sha1, size) of the registered blobs.
+    """
+    entries = []
+    for name, blob in sorted(_registry().items()):
+        if blob[1] is None:
+            blob[1] = file_sha1(blob[0])
+        entries.append((name, blob[1], os.path.getsize(blob[0])))
+    return entries
+
+
+def read_chunks(name):
+    """Yields the content of a blob in chunks of CHUNK_SIZE bytes.
+    """
+    with open(path(name), 'rb') as fid:
+        while True:
+            data = fid.read(CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def cache_dir():
+    directory = FLAGS.broadcast_cache_dir or \
+            os.path.join(tempfile.gettempdir(), 'mincepie-broadcast')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another client of the node may have created it
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+class BlobReceiver(object):
+    """Receives the blobs announced by the server on the client side.
+    """
+    def __init__(self):
+        self.announced = False
+        # name -> (sha1, temporary file, its name, running digest)
+        self.pending = {}
+
+    def ready(self):
+        """Tells if all the announced blobs are available locally.
+        """
+        return self.announced and not self.pending
+
+    def announce(self, entries):
+        """Takes the (name, sha1, size) list sent by the server, and returns
+        the names of the blobs that are not cached yet.
+        """
+        self.announced = True
+        directory = cache_dir()
+        missing = []
+        for name, sha1, size in entries:
+            cached = os.path.join(directory, sha1)
+            if os.path.isfile(cached) and os.path.getsize(cached) == size:
+                logging.debug("Blob %s found in the cache." % name)
+                register(name, cached, sha1)
+            else:
+                handle, tmpname = tempfile.mkstemp(dir=directory)
+                self.pending[name] = (sha1, os.fdopen(handle, 'wb'), tmpname,
+                                      hashlib.sha1())
+                missing.append(name)
+        return missing
+
+    def chunk(self, name, data):
+        fid, digest = self.pending[name][1], self.pending[name][3]
+        fid.write(data)
+        digest.update(data)
+
+    def end(self, name):
+        """Checks the blob that has been received, and moves it to the cache.
+        """
+        sha1, fid, tmpname, digest = self.pending.pop(name)
+        fid.close()
+        if digest.hexdigest() != sha1:
+            os.remove(tmpname)
+            raise IOError("Blob %s was corrupted during the transfer." % name)
+        cached = os.path.join(cache_dir(), sha1)
+        if os.path.isfile(cached):
+            # another client of the node got it first
+            os.remove(tmpname)
+        else:
+            # mkstemp files are only readable by their owner
+            os.chmod(tmpname, 0o644)
+            os.rename(tmpname, cached)
+        logging.debug("Blob %s received." % name)
+        register(name, cached, sha1)
+
+if __name__ == "__main__":
+    print(__doc__)
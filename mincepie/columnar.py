@@ -0,0 +1,232 @@
+"""
+The columnar module implements an optional typed store for the intermediate
+values, for jobs whose map outputs are plain numbers (histograms, features).
+
+By default the server keeps the values of each intermediate key as a python
+list, which costs a full python object per value. With --value_type set to an
+array module typecode (such as 'd' for floats or 'l' for integers), the values
+of each key are kept in a typed array.array column instead. The map outputs of
+a task are sent as a ColumnarResults object, where the keys are listed once
+and the values of all the keys are packed into a single array; both the map
+outputs and the values of the reduce tasks are pickled as raw buffers.
+
+Reducers then receive an array.array instead of a list, which supports the
+usual len(), iteration, indexing and sum(). Batch reducers get a numpy view of
+its buffer instead (see mapreducer.BatchReducer). The numpy outputs of batch
+mappers are copied into the typed arrays as raw buffers too.
+
+Without --value_type, the map outputs of batch mappers (see
+mapreducer.BatchMapper), which are numpy arrays, are kept as arrays too: the
+arrays of each key are copied into one contiguous ArrayColumn, which is sent to
+the reducers as a numpy array. The values are thus never turned into python
+objects one by one, unless the reducer iterates over them.
+
+Flags defined by this module:
+    --value_type: the array module typecode of the intermediate values, or ""
+        to keep them as python lists. All the map outputs (after the combiner,
+        if any) should then be numbers of that type. Default "".
+"""
+
+# python modules
+import array
+import gflags
+
+gflags.DEFINE_string("value_type", "",
+    "The array typecode of the intermediate values, or empty for lists")
+FLAGS = gflags.FLAGS
+
+
+def new_column(values=()):
+    """Returns a new container for the values of one intermediate key: a
+    typed array with --value_type, an ArrayColumn if the values are a numpy
+    array, and a list otherwise.
+    """
+    if FLAGS.value_type:
+        column = array.array(FLAGS.value_type)
+        _extend_typed(column, values)
+        return column
+    elif _is_array(values):
+        return ArrayColumn(values)
+    else:
+        return list(values)
+
+
+def extend(column, values):
+    """Adds values to a column returned by new_column(), and returns the
+    column. A new column is returned if column is None, or if column is an
+    empty list and the values are a numpy array.
+    """
+    if column is None:
+        return new_column(values)
+    if isinstance(column, list) and _is_array(values):
+        if not column:
+            return new_column(values)
+        elif values.ndim == 1:
+            # a list would otherwise get a numpy scalar per value
+            values = values.tolist()
+    elif isinstance(column, array.array):
+        _extend_typed(column, values)
+        return column
+    column.extend(values)
+    return column
+
+
+def concatenate(columns):
+    """Returns the values of the given sequence of columns as one column.
+    """
+    column = None
+    for values in columns:
+        column = extend(column, values)
+    if column is None:
+        return new_column()
+    return column
+
+
+def encode(results):
+    """Encodes the map outputs of a task as a ColumnarResults object if
+    --value_type is set. Otherwise, the results are returned unchanged.
+    """
+    if FLAGS.value_type and results:
+        return ColumnarResults(FLAGS.value_type, results)
+    else:
+        return results
+
+
+def _is_array(values):
+    # we check the type name so numpy is not imported unless it is being used
+    cls = type(values)
+    return cls.__name__ == 'ndarray' and cls.__module__ == 'numpy' and \
+            values.ndim > 0
+
+
+def _extend_typed(column, values):
+    # the raw buffer of numpy arrays is copied, as array.array would
+    # otherwise convert each numpy scalar separately.
+    if _is_array(values) and values.ndim == 1:
+        _extend_bytes(column, values.astype(column.typecode).tobytes())
+    elif isinstance(values, array.array) and \
+            values.typecode == column.typecode:
+        column.extend(values)
+    elif hasattr(values, 'tolist'):
+        column.extend(values.tolist())
+    else:
+        column.extend(values)
+
+
+def _to_bytes(column):
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+
+def _extend_bytes(column, data):
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+
+
+def _from_bytes(typecode, data):
+    column = array.array(typecode)
+    _extend_bytes(column, data)
+    return column
+
+
+def _load_array(values):
+    return values
+
+
+class ArrayColumn(object):
+    """The values of one intermediate key, kept in a numpy array.
+
+    The array is allocated with room to spare, which doubles when it is
+    full, so adding the map outputs of a task only copies them once. The
+    values are the first len(column) entries of the array along its first
+    axis, which array() returns. The column supports len(), iteration and
+    indexing, and is pickled as a plain numpy array of its values.
+    """
+    def __init__(self, values):
+        self.buffer = values.copy()
+        self.size = len(values)
+
+    def extend(self, values):
+        import numpy
+        values = numpy.asarray(values)
+        if not len(values):
+            return
+        end = self.size + len(values)
+        dtype = numpy.result_type(self.buffer, values)
+        if end > len(self.buffer) or dtype != self.buffer.dtype:
+            buffer = numpy.empty((max(end, 2 * len(self.buffer)),) +
+                                 self.buffer.shape[1:], dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.buffer[self.size:end] = values
+        self.size = end
+
+    def array(self):
+        """Returns the values as a numpy array (a view of the column).
+        """
+        return self.buffer[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.array())
+
+    def __getitem__(self, index):
+        return self.array()[index]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.array()
+        return self.array().astype(dtype)
+
+    def __reduce__(self):
+        return (_load_array, (self.array(),))
+
+
+class ColumnarResults(object):
+    """The map outputs of a task, stored as one array of values.
+
+    The values of keys[i] are values[offsets[i]:offsets[i] + counts[i]]. The
+    object behaves like a read-only dictionary mapping each key to an
+    array.array of its values.
+    """
+    def __init__(self, typecode, results):
+        self.typecode = typecode
+        self.keys = list(results)
+        self.counts = array.array('l')
+        self.values = array.array(typecode)
+        for key in self.keys:
+            values = results[key]
+            self.counts.append(len(values))
+            _extend_typed(self.values, values)
+
+    def __getstate__(self):
+        return (self.typecode, self.keys, _to_bytes(self.counts),
+                _to_bytes(self.values))
+
+    def __setstate__(self, state):
+        self.typecode, self.keys, counts, values = state
+        self.counts = _from_bytes('l', counts)
+        self.values = _from_bytes(self.typecode, values)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        offset = 0
+        for key, count in zip(self.keys, self.counts):
+            yield key, self.values[offset:offset + count]
+            offset += count
+
+if __name__ == "__main__":
+    print(__doc__)
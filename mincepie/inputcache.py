@@ -0,0 +1,261 @@
+"""
+The inputcache module expands the input file patterns of the readers, and
+caches the result so a job that is launched again with the same input does
+not list the directories again.
+
+On a shared filesystem, expanding a pattern that matches millions of files
+takes a lot of metadata operations, all done before the server can listen.
+expand() returns the sorted list of the files matching a pattern, like a
+sorted glob.glob(), and their sizes. The directories that match the wildcard
+components are listed in parallel by --input_cache_threads threads. The result
+is saved in --input_cache_dir along with the modification time of every
+directory that was listed, and reused as long as none of these times has
+changed, i.e. no file has been added, removed or renamed in them. Checking
+the cache takes one stat per directory, which is also done in parallel.
+
+The cache is off by default: set --input_cache to turn it on. Without it, the
+patterns are expanded with a plain sorted glob.glob(). Note that the sizes are
+the ones seen when the cache was written: a file that is rewritten in place
+does not invalidate the cache.
+
+Flags defined by this module:
+    --input_cache: whether to cache the expanded input patterns. Default
+        False.
+    --input_cache_dir: the directory of the cached patterns. Default "",
+        which means a mincepie-input directory in the system temporary
+        directory.
+    --input_cache_threads: the number of threads listing the directories.
+        Default 16.
+"""
+
+# python modules
+import array
+import fnmatch
+import gflags
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+gflags.DEFINE_bool("input_cache", False,
+    "Whether to cache the expanded input patterns")
+gflags.DEFINE_string("input_cache_dir", "",
+    "The directory of the cached input patterns")
+gflags.DEFINE_integer("input_cache_threads", 16,
+    "The number of threads listing the input directories")
+gflags.RegisterValidator('input_cache_threads', lambda x: x > 0,
+                         message='--input_cache_threads must be positive.')
+FLAGS = gflags.FLAGS
+
+FORMAT_VERSION = 1
+# directories modified this recently (in seconds) when they are listed may
+# change again within the resolution of their modification time, so the
+# result is not cached.
+RACY_SECONDS = 2
+
+
+def cache_dir():
+    directory = FLAGS.input_cache_dir or \
+            os.path.join(tempfile.gettempdir(), 'mincepie-input')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+def cache_name(pattern):
+    """Returns the cache file of a pattern. Relative patterns are expanded
+    relative to the current directory, so it is part of the key.
+    """
+    key = hashlib.sha1(repr((os.getcwd(), pattern)).encode('utf-8'))
+    return os.path.join(cache_dir(), key.hexdigest())
+
+
+def _mtime(directory):
+    try:
+        return os.stat(directory).st_mtime
+    except OSError:
+        return None
+
+
+def _list(args):
+    """Lists a directory and returns the names matching a pattern component,
+    along with the modification time of the directory. If is_last is False,
+    only the subdirectories are kept.
+    """
+    directory, component, is_last = args
+    mtime = _mtime(directory or os.curdir)
+    try:
+        names = os.listdir(directory or os.curdir)
+    except OSError:
+        return mtime, []
+    if not component.startswith('.'):
+        # like glob, the wildcards do not match hidden files
+        names = [name for name in names if not name.startswith('.')]
+    paths = [os.path.join(directory, name)
+             for name in fnmatch.filter(names, component)]
+    if not is_last:
+        paths = [path for path in paths if os.path.isdir(path)]
+    return mtime, paths
+
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _split(pattern):
+    """Splits a pattern into its root (the leading part without wildcards)
+    and the remaining path components.
+    """
+    components = []
+    root = pattern
+    while glob.has_magic(root):
+        root, component = os.path.split(root)
+        if component:
+            components.append(component)
+    components.reverse()
+    return root, components
+
+
+def scan(pattern, pool):
+    """Expands a pattern, and returns the sorted list of filenames, the list
+    of their sizes and the list of (directory, modification time) of the
+    listed directories.
+    """
+    # like glob, a pattern ending with a separator only matches directories,
+    # which are returned with a single trailing separator
+    directory_only = glob.has_magic(pattern) and pattern.endswith(os.sep)
+    if directory_only:
+        pattern = pattern.rstrip(os.sep)
+    root, components = _split(pattern)
+    if not components:
+        parent = os.path.dirname(pattern) or os.curdir
+        directories = [(parent, _mtime(parent))]
+        if os.path.lexists(pattern):
+            return [pattern], [_size(pattern)], directories
+        return [], [], directories
+    directories = []
+    prefixes = [root]
+    for index, component in enumerate(components):
+        is_last = (index == len(components) - 1) and not directory_only
+        if glob.has_magic(component):
+            listed = pool.map(_list, [(prefix, component, is_last)
+                                      for prefix in prefixes])
+            directories.extend((prefix or os.curdir, mtime) for prefix,
+                               (mtime, _) in zip(prefixes, listed))
+            prefixes = [path for _, paths in listed for path in paths]
+        else:
+            # the existence of a plain component depends on the listing of
+            # its parent directory as well
+            directories.extend(zip(prefixes, pool.map(
+                    _mtime, [prefix or os.curdir for prefix in prefixes])))
+            prefixes = [os.path.join(prefix, component)
+                        for prefix in prefixes]
+            check = os.path.lexists if is_last else os.path.isdir
+            prefixes = [path for path, exists in
+                        zip(prefixes, pool.map(check, prefixes)) if exists]
+    if directory_only:
+        prefixes = [path + os.sep for path in prefixes]
+    prefixes.sort()
+    return prefixes, pool.map(_size, prefixes), directories
+
+
+# The cache file holds a pickled header, with the filenames joined by NUL
+# characters (which filenames cannot contain) into a single string, followed
+# by the sizes as an array of doubles: unlike a pickled list of a million
+# strings, both load quickly.
+
+def _load(filename, pattern, pool):
+    """Returns the cached filenames and sizes of a pattern, or None if the
+    cache is missing or stale.
+    """
+    try:
+        with open(filename, 'rb') as fid:
+            header = pickle.load(fid)
+            if header.get('version') != FORMAT_VERSION or \
+                    header['pattern'] != pattern:
+                return None
+            sizes = array.array('d')
+            sizes.fromfile(fid, header['count'])
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    directories = header['directories']
+    mtimes = pool.map(_mtime, [directory for directory, _ in directories])
+    if any(mtime != cached_mtime for mtime, (_, cached_mtime)
+           in zip(mtimes, directories)):
+        logging.info("The input of %s has changed." % pattern)
+        return None
+    names = header['names'].split('\0') if header['count'] else []
+    return names, sizes
+
+
+def _save(filename, pattern, names, sizes, directories, scan_time):
+    if any(mtime is None or mtime >= scan_time - RACY_SECONDS
+           for _, mtime in directories):
+        logging.debug("Not caching %s: its directories are changing." % \
+                      pattern)
+        return
+    try:
+        handle, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(handle, 'wb') as fid:
+            pickle.dump({'version': FORMAT_VERSION,
+                         'pattern': pattern,
+                         'directories': directories,
+                         'names': '\0'.join(names),
+                         'count': len(names),
+                        }, fid, pickle.HIGHEST_PROTOCOL)
+            array.array('d', sizes).tofile(fid)
+        os.rename(tmpname, filename)
+    except (IOError, OSError) as e:
+        logging.warning("Cannot cache the input of %s: %s" % (pattern, e))
+
+
+def expand(pattern):
+    """Returns the sorted list of the files matching a pattern and the
+    sequence of their sizes, from the cache if it is up to date.
+    """
+    # only the server expands the input, so the clients do not import this
+    from multiprocessing.pool import ThreadPool
+    start_time = time.time()
+    pool = ThreadPool(FLAGS.input_cache_threads)
+    try:
+        filename = None
+        if FLAGS.input_cache:
+            filename = cache_name(pattern)
+            cached = _load(filename, pattern, pool)
+            if cached is not None:
+                logging.info("Found %d input files of %s in the cache in "
+                             "%.2f seconds." % (len(cached[0]), pattern,
+                                                time.time() - start_time))
+                return cached
+        names, sizes, directories = scan(pattern, pool)
+        logging.info("Expanded %s to %d input files in %.2f seconds." % \
+                     (pattern, len(names), time.time() - start_time))
+        if filename is not None:
+            _save(filename, pattern, names, sizes, directories, start_time)
+        return names, sizes
+    finally:
+        pool.close()
+        pool.join()
+
+
+def glob_files(pattern):
+    """Returns the sorted list of the files matching a pattern, i.e.
+    sorted(glob.glob(pattern)), from the cache if --input_cache is set and
+    the cache is up to date.
+    """
+    if not FLAGS.input_cache:
+        return sorted(glob.glob(pattern))
+    return expand(pattern)[0]
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,181 @@
+"""
+The intermediate module saves the intermediate data of a job (the shuffled
+map outputs) to disk, so the reduce phase can be run again without the map
+phase, e.g. after fixing a bug in the reducer.
+
+With --intermediate_dir set, the server writes the intermediate data to that
+directory at the end of the map phase. The keys are spread over
+--intermediate_partitions partition files, each holding a sequence of
+pickled (key, values) records, and an index file lists the partition, offset,
+size and number of values of every key. The index of a previous save is
+removed first and the new one is written last, so an interrupted save is never
+loaded.
+
+Running the job again with --reduce_only and the same --intermediate_dir
+skips reading the input and the map phase: the reduce phase runs on the saved
+data, possibly with another --reducer. Only the index is loaded up front; the
+values of each key are read from its partition file when its reduce task is
+sent, so the server does not need the memory the map phase needed. Hot keys
+are found from the index (see --hot_key_values and --hot_key_bytes in mince).
+
+Flags defined by this module:
+    --intermediate_dir: the directory where the intermediate data is saved
+        at the end of the map phase, and loaded from with --reduce_only.
+        Default "", i.e. the intermediate data is not saved.
+    --intermediate_partitions: the number of partition files. Default 16.
+    --reduce_only: if set, load the intermediate data from
+        --intermediate_dir and only run the reduce phase. Default False.
+"""
+
+# python modules
+import gflags
+import logging
+import os
+import pickle
+import time
+
+from . import storage
+
+gflags.DEFINE_string("intermediate_dir", "",
+    "The directory where the intermediate data is saved and loaded")
+gflags.DEFINE_integer("intermediate_partitions", 16,
+    "The number of partition files of the intermediate data")
+gflags.DEFINE_bool("reduce_only", False,
+    "If set, run the reduce phase on the saved intermediate data")
+gflags.RegisterValidator('intermediate_partitions', lambda x: x > 0,
+                         message='--intermediate_partitions must be positive.')
+FLAGS = gflags.FLAGS
+
+FORMAT_VERSION = 1
+INDEX_NAME = 'index'
+
+
+def partition_name(directory, partition):
+    return os.path.join(directory, "part-%05d" % partition)
+
+
+def save(map_results, directory=None):
+    """Saves the intermediate data, a dictionary from keys to lists of
+    values, to the given directory (FLAGS.intermediate_dir by default).
+    """
+    if directory is None:
+        directory = FLAGS.intermediate_dir
+    start_time = time.time()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    index_name = os.path.join(directory, INDEX_NAME)
+    if os.path.exists(index_name):
+        # the partition files are about to be rewritten under the index of
+        # the previous save
+        os.remove(index_name)
+    num_partitions = FLAGS.intermediate_partitions
+    files = [open(partition_name(directory, partition), 'wb')
+             for partition in range(num_partitions)]
+    # (key, partition, offset, size, number of values) of each key
+    entries = []
+    try:
+        for key, values in map_results.items():
+            partition = hash(key) % num_partitions
+            fid = files[partition]
+            offset = fid.tell()
+            pickle.dump((key, values), fid, pickle.HIGHEST_PROTOCOL)
+            entries.append((key, partition, offset, fid.tell() - offset,
+                            len(values)))
+    finally:
+        for fid in files:
+            fid.close()
+    with open(index_name + '.tmp', 'wb') as fid:
+        pickle.dump({'version': FORMAT_VERSION,
+                     'num_partitions': num_partitions,
+                     'entries': entries,
+                    }, fid, pickle.HIGHEST_PROTOCOL)
+    os.rename(index_name + '.tmp', index_name)
+    logging.info("Saved %d intermediate keys to %s in %.2f seconds." % \
+                 (len(entries), directory, time.time() - start_time))
+
+
+def load(directory=None):
+    """Loads the index of the intermediate data saved in the given directory
+    (FLAGS.intermediate_dir by default), and returns an IntermediateResults.
+    """
+    if directory is None:
+        directory = FLAGS.intermediate_dir
+    with open(os.path.join(directory, INDEX_NAME), 'rb') as fid:
+        index = pickle.load(fid)
+    if index['version'] != FORMAT_VERSION:
+        raise ValueError("Unsupported intermediate data version %r in %s" % \
+                         (index['version'], directory))
+    logging.info("Loaded the index of %d intermediate keys from %s." % \
+                 (len(index['entries']), directory))
+    return IntermediateResults(directory, index['entries'])
+
+
+class IntermediateResults(object):
+    """A read-only dictionary view of saved intermediate data, with the
+    count(), slice() and chunks() methods of the stores (see
+    mincepie.storage).
+
+    The values of a key are read from its partition file when the key is
+    looked up. The keys are listed partition by partition, so the reduce
+    tasks read the partition files in order.
+    """
+    def __init__(self, directory, entries):
+        self.directory = directory
+        entries = sorted(entries, key=lambda entry: entry[1:3])
+        self._keys = [entry[0] for entry in entries]
+        self._index = dict((entry[0], entry[1:]) for entry in entries)
+        # the open partition files of this process: forked processes open
+        # their own, as they would otherwise share the file offsets.
+        self._files = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._keys)
+
+    def __getitem__(self, key):
+        partition, offset, _, _ = self._index[key]
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if partition not in self._files:
+            self._files[partition] = open(
+                    partition_name(self.directory, partition), 'rb')
+        fid = self._files[partition]
+        fid.seek(offset)
+        return pickle.load(fid)[1]
+
+    def count(self, key):
+        return self._index[key][3]
+
+    def slice(self, key, start, end):
+        return self[key][start:end]
+
+    def chunks(self, key, size):
+        # the values of a key are saved as a single record
+        return storage.chunk_columns([self[key]], size)
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self[key]
+
+    items = iteritems
+
+    def hot_keys(self, max_values, max_bytes):
+        """Returns the keys with at least max_values values, or whose record
+        takes at least max_bytes bytes. A limit of 0 is not checked.
+        """
+        return set(key for key, (_, _, size, count) in self._index.items()
+                   if (max_values > 0 and count >= max_values) or
+                      (max_bytes > 0 and size >= max_bytes))
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,152 @@
+"""
+The largevalue module keeps large map output values, such as the features or
+the images produced for each record, out of the messages and of the server
+memory.
+
+With --large_value_bytes set, every map output value that is a byte string
+(or has an nbytes attribute, like a numpy array, in which case it is pickled)
+of at least that many bytes is appended by the client to its own file in
+--large_value_dir, FLAGS.large_value_dir/large-HOST-PID, and replaced by a
+small LargeValue reference to it. Only the reference travels to the server
+and is kept in the intermediate data, so --large_value_dir must be visible to
+the server and to the reduce clients, e.g. on a shared filesystem.
+
+Reducers get the references among their values. Reducers that only pass
+values on, like IdentityReducer or FirstElementReducer, need no change; the
+others can call largevalue.resolve() on their values. The writers of
+mapreducer load the referenced values one at a time when writing the output,
+so the server never holds more than one of them. The files in
+--large_value_dir can be removed once the output is written.
+
+Flags defined by this module:
+    --large_value_bytes: the size above which the map output values are
+        stored in files. Default 0, which means never.
+    --large_value_dir: the directory of the large value files, shared by the
+        server and the clients. Default ".".
+"""
+
+# python modules
+import collections
+import gflags
+import os
+import pickle
+import socket
+
+gflags.DEFINE_integer("large_value_bytes", 0,
+    "The size above which the map output values are stored in files")
+gflags.DEFINE_string("large_value_dir", ".",
+    "The directory of the large value files, shared by the server and clients")
+FLAGS = gflags.FLAGS
+
+# the large value file of this process
+_FILE = []
+
+
+class LargeValue(object):
+    """A reference to a value stored in a large value file.
+    """
+    def __init__(self, path, offset, size, pickled):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.pickled = pickled
+
+    def load(self):
+        """Reads the referenced value.
+        """
+        with open(self.path, 'rb') as fid:
+            fid.seek(self.offset)
+            data = fid.read(self.size)
+        if len(data) != self.size:
+            raise IOError("Large value file %s is truncated." % self.path)
+        if self.pickled:
+            return pickle.loads(data)
+        return data
+
+    def __repr__(self):
+        return "LargeValue(%r, %d, %d)" % (self.path, self.offset, self.size)
+
+
+def _file():
+    if not _FILE:
+        filename = os.path.abspath(os.path.join(FLAGS.large_value_dir,
+                "large-%s-%d" % (socket.gethostname(), os.getpid())))
+        _FILE.append(open(filename, 'ab'))
+    return _FILE[0]
+
+
+def spill(value):
+    """Stores the value in the large value file if it is large enough, and
+    returns the reference to it. Otherwise returns the value.
+    """
+    if isinstance(value, bytes):
+        if len(value) < FLAGS.large_value_bytes:
+            return value
+        data, pickled = value, False
+    elif getattr(value, 'nbytes', 0) >= FLAGS.large_value_bytes:
+        data, pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL), True
+    else:
+        return value
+    fid = _file()
+    fid.seek(0, os.SEEK_END)
+    offset = fid.tell()
+    fid.write(data)
+    return LargeValue(fid.name, offset, len(data), pickled)
+
+
+def flush():
+    """Flushes the large value file, so the values written so far can be
+    read by the other processes.
+    """
+    if _FILE:
+        _FILE[0].flush()
+
+
+def resolve(value):
+    """Returns the value, with the large value references loaded. Lists and
+    tuples of values are resolved element-wise.
+    """
+    if isinstance(value, LargeValue):
+        return value.load()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(resolve(item) for item in value)
+    return value
+
+
+def has_references(result):
+    """Tells if some values of a dictionary are, or hold, large value
+    references.
+    """
+    for value in result.values():
+        if isinstance(value, LargeValue) or (
+                isinstance(value, (list, tuple)) and
+                any(isinstance(item, LargeValue) for item in value)):
+            return True
+    return False
+
+
+def dump_resolved(result, fid):
+    """Pickles the dictionary result to fid, like pickle.dump, with the large
+    value references resolved, while only loading one value at a time.
+
+    The key and the value of each item are pickled on their own, without
+    their protocol header and stop opcode, and added with SETITEM to an empty
+    dictionary, or an OrderedDict if the result is ordered (see
+    storage.new_store), so the order of --total_order is kept. Each piece
+    only refers to the memo entries it defines itself, so reusing the memo
+    indices across pieces is harmless.
+    """
+    if isinstance(result, collections.OrderedDict) or \
+            getattr(result, 'ordered', False):
+        empty = collections.OrderedDict()
+    else:
+        empty = {}
+    fid.write(pickle.dumps(empty, 2)[:-1])
+    for key in result:
+        for obj in (key, resolve(result[key])):
+            fid.write(pickle.dumps(obj, 2)[2:-1])
+        fid.write(pickle.SETITEM)
+    fid.write(pickle.STOP)
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -7,13 +7,33 @@ refer to the documentation for details about each launch mode.
 Flags defined by this module:
     --loglevel: the level for logging output. 20 for logging.INFO and 10 for
         logging.DEBUG. Refer to the logging module for more details.
-    --launch: the launch mode. can be "local" (default), "server", "client", 
-        "mpi", or "slurm".
+    --launch: the launch mode. can be "local" (default), "fork", "inline",
+        "server", "client", "subserver", "mpi", or "slurm". "status" prints
+        the progress of a running job instead (see mincepie.progress).
     --num_clients: the number of clients. Only used when the launch mode is 
-        local or slurm (in which this number of slurm jobs are submitted, 
+        local, fork or slurm (in which this number of slurm jobs are submitted, 
         although the actual number of running clients are also constrained by
         the slurm resource limit). Default 1.
 
+Inline-specific flags (--launch=inline runs the whole job in one process):
+    --inline_profile: if set, the map() and reduce() calls are profiled with
+        cProfile, the stats are saved to this file and the top functions are
+        printed to stderr. Default "".
+    --inline_memory: if positive, the resident and peak memory of the
+        process and this many most common types of the objects tracked by
+        the garbage collector are logged after the map and reduce phases.
+        Default 0.
+
+MPI-specific flags:
+    --mpi_group_size: if larger than 1, the non-root mpi hosts are split into
+        groups of this size. The first host of each group runs a sub-server
+        (see mincepie.subserver) and the others connect to it as clients, so
+        the server only talks to the sub-servers. Default 0, i.e. all hosts
+        connect to the server directly.
+    --mpi_native: if set, the server and the clients communicate with MPI
+        messages instead of TCP sockets (see mincepie.mpitransport).
+        --mpi_group_size is ignored in this case. Default False.
+
 Slurm-specific flags:
     --slurm_shebang: the shebang used to create the slurm command. Default 
         "#!/bin/bash".
@@ -25,20 +45,59 @@ Slurm-specific flags:
         multiple arguments, such as
             --sbatch_args=--mem=1000 --sbatch_args=--partition=default
         See the sbatch man page for the list of sbatch arguments.
+    --slurm_elastic: if set, the server submits more slurm clients when there
+        is a large backlog of tasks, and releases idle clients early when the
+        remaining tasks of the reduce phase fall below the number of clients.
+        Default False.
+    --slurm_min_clients: the number of clients that are never released in
+        elastic mode. Default 1.
+    --slurm_max_clients: the maximum number of clients (connected or pending
+        in the slurm queue) in elastic mode. Default 0, which means 4 times
+        --num_clients.
+    --slurm_backlog_per_client: in elastic mode, more clients are requested
+        when the number of queued tasks per client exceeds this. Default 10.
+    --slurm_scale_interval: the minimum number of seconds between two elastic
+        scaling decisions. Default 30.
+    --slurm_lean_client: if set, the slurm clients run mincepie.leanclient,
+        which connects before importing the script, instead of running the
+        whole script. Default False.
 
 Yangqing jia, jiayq@eecs.berkeley.edu
 """
 
 # python modules
+import collections
+import cProfile
+import gc
 import gflags
 import hashlib
 import logging
-from mincepie import mince
-from multiprocessing import Process
+from multiprocessing import Pool, Process
+import os
+import pstats
 import socket
 from subprocess import Popen, PIPE
 import sys
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import columnar
+from . import intermediate
+from . import mapreducer
+from . import mince
+from . import mpitransport
+from . import progress
+from . import sideoutput
+from . import subserver
+from . import usage
+
+# the default maximum number of clients in slurm elastic mode, as a multiple
+# of --num_clients
+ELASTIC_CLIENTS_FACTOR = 4
 
 gflags.DEFINE_integer("loglevel", 20,
         "The level for logging. 20 for INFO and 10 for DEBUG.")
@@ -48,6 +107,16 @@ gflags.DEFINE_integer("num_clients", 1,
         "The number of clients. Does not apply in the case of MPI.")
 gflags.RegisterValidator('num_clients', lambda x: x > 0,
                          message='--num_clients must be positive.')
+# inline flags
+gflags.DEFINE_string("inline_profile", "",
+        "If set, profile the map and reduce calls into this file.")
+gflags.DEFINE_integer("inline_memory", 0,
+        "The number of most common object types to log. 0 to disable.")
+# mpi flags
+gflags.DEFINE_integer("mpi_group_size", 0,
+        "The number of mpi hosts served by each sub-server. 0 for none.")
+gflags.DEFINE_bool("mpi_native", False,
+        "If set, use MPI messages instead of TCP sockets under MPI.")
 # slurm flags
 gflags.DEFINE_string("slurm_shebang", "#!/bin/bash",
         "The shebang of the slurm batch script")
@@ -59,6 +128,19 @@ gflags.DEFINE_string("scancel_bin", "scancel",
         "The command to call scancel")
 gflags.DEFINE_multistring("sbatch_args", [],
         "The sbatch arguments")
+gflags.DEFINE_bool("slurm_elastic", False,
+        "If set, add and release slurm clients based on the task backlog")
+gflags.DEFINE_integer("slurm_min_clients", 1,
+        "The minimum number of slurm clients in elastic mode")
+gflags.DEFINE_integer("slurm_max_clients", 0,
+        "The maximum number of slurm clients in elastic mode. 0 for "
+        "%d times --num_clients" % ELASTIC_CLIENTS_FACTOR)
+gflags.DEFINE_integer("slurm_backlog_per_client", 10,
+        "The number of queued tasks per client that triggers more clients")
+gflags.DEFINE_float("slurm_scale_interval", 30.,
+        "The minimum number of seconds between elastic scaling decisions")
+gflags.DEFINE_bool("slurm_lean_client", False,
+        "If set, the slurm clients import the script only when needed")
 # easy access to FLAGS
 FLAGS = gflags.FLAGS
 
@@ -85,6 +167,10 @@ def launch(argv=None):
     process_argv(argv)
     if FLAGS.launch == 'local':
         launch_local()
+    elif FLAGS.launch == 'fork':
+        launch_fork()
+    elif FLAGS.launch == 'inline':
+        launch_inline()
     elif FLAGS.launch == "server":
         # server mode
         server = mince.Server()
@@ -93,16 +179,36 @@ def launch(argv=None):
         # client mode
         client = mince.Client()
         client.run_client()
+    elif FLAGS.launch == "subserver":
+        # sub-server mode
+        server = subserver.SubServer()
+        server.run_subserver()
     elif FLAGS.launch == "mpi":
         launch_mpi()
     elif FLAGS.launch == "slurm":
         launch_slurm(argv)
+    elif FLAGS.launch == "status":
+        launch_status()
+        return
     else:
         logging.fatal("Unable to recognize the launch mode: "+ FLAGS.launch)
         sys.exit(1)
     logging.info("Mapreduce terminated.")
     return
 
+def launch_status():
+    """Prints the progress of a running job, queried from the status
+    endpoint of its server at FLAGS.status_address:FLAGS.status_port.
+    """
+    try:
+        status = progress.query()
+    except (IOError, socket.error) as e:
+        logging.fatal("Cannot get the status from %s:%d: %s" % \
+                      (FLAGS.status_address, FLAGS.status_port, e))
+        sys.exit(1)
+    for line in progress.format_status(status):
+        print(line)
+
 def launch_local():
     """ launches both the server and the clients on the local machine.
     
@@ -123,6 +229,367 @@ def launch_local():
         clientprocess[i].join()
     return
 
+# The state shared with the workers of launch_fork(). It is set before the
+# workers are forked, so they read it through copy-on-write memory.
+_FORK_STATE = {}
+
+
+class _LocalWorker(mince.Client):
+    """Runs tasks in the current process, keeping the reply of each task
+    instead of sending it to a server.
+    """
+    def send_command(self, command, data=None, arg=None):
+        self.reply = data
+
+
+def _fork_worker():
+    if 'worker' not in _FORK_STATE:
+        _FORK_STATE['worker'] = _LocalWorker()
+    return _FORK_STATE['worker']
+
+
+def _fork_map(indices):
+    """Maps the inputs with the given indices in a forked worker.
+    """
+    keys, datasource = _FORK_STATE['keys'], _FORK_STATE['datasource']
+    worker = _fork_worker()
+    worker.process_command(mince.COMMAND.mapbatch,
+                           [(keys[i], datasource[keys[i]]) for i in indices])
+    # the results and the counters
+    return worker.reply[1], worker.reply[3]
+
+
+def _fork_reduce(indices):
+    """Reduces the intermediate keys with the given indices in a forked
+    worker.
+    """
+    keys, map_results = _FORK_STATE['keys'], _FORK_STATE['map_results']
+    worker = _fork_worker()
+    worker.process_command(mince.COMMAND.reducebatch,
+                           [(keys[i], map_results[keys[i]]) for i in indices])
+    return worker.reply[1], worker.reply[3]
+
+
+def _fork_run(function, num_tasks):
+    """Runs function on chunks of range(num_tasks) in FLAGS.num_clients
+    forked workers, and yields the results as they are done.
+    """
+    chunk = max(1, min(FLAGS.batch_size,
+                       num_tasks // (4 * FLAGS.num_clients)))
+    chunks = [list(range(i, min(i + chunk, num_tasks)))
+              for i in range(0, num_tasks, chunk)]
+    pool = Pool(FLAGS.num_clients)
+    try:
+        for result in pool.imap_unordered(function, chunks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def launch_fork():
+    """Runs the whole mapreduce on the local machine with forked workers.
+
+    The input is read before the workers are forked, and the intermediate
+    values are gathered before the reduce workers are forked, so the workers
+    read them through copy-on-write memory and only the task indices and the
+    results are pickled. There are no sockets, speculative re-runs or hot
+    key handling. The number of workers is FLAGS.num_clients.
+    """
+    if not hasattr(os, 'fork'):
+        logging.warning("Forking is not supported, using launch_local.")
+        launch_local()
+        return
+    start_time = time.time()
+    counters = {}
+    if FLAGS.reduce_only:
+        map_results = intermediate.load()
+    else:
+        datasource = mince.read_input()
+        keys = list(datasource.keys())
+        logging.info("Number of input key value pairs: %d " % (len(keys)))
+        _FORK_STATE.clear()
+        _FORK_STATE.update(keys=keys, datasource=datasource)
+        map_results = {}
+        for results, task_counters in _fork_run(_fork_map, len(keys)):
+            sideoutput.add_counters(counters, task_counters)
+            for key, values in results.items():
+                map_results[key] = columnar.extend(map_results.get(key),
+                                                   values)
+        logging.info("Map phase done in %.2f seconds." % \
+                     (time.time() - start_time))
+        if FLAGS.intermediate_dir:
+            intermediate.save(map_results)
+    keys = list(map_results)
+    if FLAGS.total_order:
+        keys.sort()
+    _FORK_STATE.clear()
+    _FORK_STATE.update(keys=keys, map_results=map_results)
+    results = {}
+    for reduced, task_counters in _fork_run(_fork_reduce, len(keys)):
+        sideoutput.add_counters(counters, task_counters)
+        results.update(reduced)
+    if FLAGS.total_order:
+        results = collections.OrderedDict(
+                (key, results[key]) for key in keys if key in results)
+    _FORK_STATE.clear()
+    logging.info("Mapreduce done in %.2f seconds." % \
+                 (time.time() - start_time))
+    sideoutput.report(counters)
+    mapreducer.WRITER(FLAGS.writer)().write(results)
+
+
+def _log_memory(phase):
+    """Logs the memory of the process and the most common types of the
+    objects tracked by the garbage collector.
+    """
+    gc.collect()
+    counts = collections.Counter(type(obj).__name__
+                                 for obj in gc.get_objects())
+    logging.info("Memory after the %s phase: %.1f MB resident, %.1f MB peak, "
+                 "%d objects." % (phase, usage.current_rss() or 0.,
+                                  usage.peak_rss(), sum(counts.values())))
+    for name, count in counts.most_common(FLAGS.inline_memory):
+        logging.info("  %d %s" % (count, name))
+
+
+def launch_inline():
+    """Runs the whole mapreduce serially in the current process.
+
+    The tasks go through the same client code as in the distributed modes
+    (one map task per input, with the combiner applied to each), so the
+    results are the same. With --inline_profile and --inline_memory, the
+    map and reduce calls are profiled, which is handy to tune a mapper
+    without the server and the sockets getting in the way.
+    """
+    profiler = None
+    if FLAGS.inline_profile:
+        profiler = cProfile.Profile()
+    worker = _LocalWorker()
+    counters = {}
+
+    def run_task(command, data):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            worker.process_command(command, data)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        sideoutput.add_counters(counters, worker.reply[3])
+        return worker.reply
+
+    start_time = time.time()
+    datasource = mince.read_input()
+    logging.info("Number of input key value pairs: %d " % \
+                 (len(datasource.keys())))
+    if FLAGS.reduce_only:
+        map_results = intermediate.load()
+    else:
+        map_results = {}
+    for key in datasource.keys():
+        results = run_task(mince.COMMAND.map, (key, datasource[key]))[1]
+        for out_key, values in results.items():
+            map_results[out_key] = columnar.extend(
+                    map_results.get(out_key), values)
+    logging.info("Map phase done in %.2f seconds." % \
+                 (time.time() - start_time))
+    if FLAGS.intermediate_dir and not FLAGS.reduce_only:
+        intermediate.save(map_results)
+    if FLAGS.inline_memory > 0:
+        _log_memory("map")
+    keys = list(map_results)
+    if FLAGS.total_order:
+        keys.sort()
+    results = collections.OrderedDict()
+    for key in keys:
+        result = run_task(mince.COMMAND.reduce, (key, map_results[key]))[1]
+        if result is not None:
+            results[key] = result
+    logging.info("Mapreduce done in %.2f seconds." % \
+                 (time.time() - start_time))
+    sideoutput.report(counters)
+    if FLAGS.inline_memory > 0:
+        _log_memory("reduce")
+    if profiler is not None:
+        profiler.dump_stats(FLAGS.inline_profile)
+        logging.info("Profile saved to %s." % FLAGS.inline_profile)
+        pstats.Stats(profiler, stream=sys.stderr)\
+              .sort_stats('cumulative').print_stats(20)
+    mapreducer.WRITER(FLAGS.writer)().write(results)
+
+
+class SlurmElasticPool(object):
+    """A pool of slurm client jobs that grows and shrinks with the backlog.
+
+    The pool is attached to the server as server.elastic. The server calls
+    update() periodically, which submits more sbatch jobs when there are many
+    queued tasks per client, and release() whenever a client asks for a new
+    task, which tells whether the client is idle and should be let go. The job
+    of a released client is scancelled so its allocation is freed early.
+
+    sbatch and scancel run in a background thread, so the server keeps
+    serving its clients meanwhile, hence the lock around the job sets. Failed
+    submissions are retried at a later update.
+    """
+    def __init__(self, jobname, command):
+        self.jobname = jobname
+        self.command = command
+        self.submitted = set()
+        self.registered = set()
+        self.released = set()
+        self.last_update = 0
+        self.lock = threading.Lock()
+        # the number of jobs waiting to be submitted by the background thread
+        self.submitting = 0
+        # the slurm calls for the background thread, which starts on the
+        # first one
+        self.calls = None
+
+    def max_clients(self):
+        if FLAGS.slurm_max_clients > 0:
+            return FLAGS.slurm_max_clients
+        return ELASTIC_CLIENTS_FACTOR * FLAGS.num_clients
+
+    def num_pending(self):
+        """Returns the number of requested jobs that have not connected yet.
+        """
+        with self.lock:
+            return len(self.submitted - self.registered - self.released) + \
+                    self.submitting
+
+    def submit(self, count):
+        """Submits count sbatch jobs, and returns the list of job ids.
+
+        Raises a RuntimeError if sbatch fails.
+        """
+        jobids = []
+        for i in range(count):
+            args = [FLAGS.sbatch_bin, '--job-name=%s' % (self.jobname,)]
+            if len(FLAGS.sbatch_args) > 0:
+                args += FLAGS.sbatch_args
+            proc = Popen(args, stdin = PIPE, stdout = PIPE, stderr = PIPE)
+            out, err = proc.communicate(self.command)
+            if err != "":
+                # sbatch seem to have returned an error
+                logging.fatal("Sbatch does not run as expected.")
+                logging.fatal("Stdout:\n" + out)
+                logging.fatal("Stderr:\n" + err)
+                raise RuntimeError("sbatch failed.")
+            # sbatch outputs "Submitted batch job JOBID"
+            jobid = str(out).strip().split(' ')[-1]
+            with self.lock:
+                logging.debug("Slurm job #%d: %s", len(self.submitted), jobid)
+                self.submitted.add(jobid)
+            jobids.append(jobid)
+        return jobids
+
+    def submit_later(self, count):
+        """Submits count sbatch jobs in the background thread.
+        """
+        with self.lock:
+            self.submitting += count
+        self.call_later(self.submit_pending, count)
+
+    def submit_pending(self, count):
+        for i in range(count):
+            try:
+                self.submit(1)
+            except (OSError, RuntimeError):
+                logging.error("Failed to submit %d slurm clients, retrying "
+                              "later.", count - i)
+                with self.lock:
+                    self.submitting -= count - i
+                return
+            with self.lock:
+                self.submitting -= 1
+
+    def cancel(self, jobid=None):
+        """Cancels the given slurm job, or all the jobs if jobid is None.
+        """
+        if jobid is None:
+            args = [FLAGS.scancel_bin, '--name=%s' % (self.jobname,)]
+        else:
+            args = [FLAGS.scancel_bin, str(jobid)]
+        proc = Popen(args, stdin = PIPE, stdout = PIPE, stderr = PIPE)
+        # Here we simply do a communicate and discard the results
+        # We may want to handle the case when scancel fails?
+        proc.communicate()
+
+    def call_later(self, function, *args):
+        """Runs a slurm call in the background thread.
+        """
+        if self.calls is None:
+            self.calls = queue.Queue()
+            thread = threading.Thread(target=self.run_calls)
+            thread.daemon = True
+            thread.start()
+        self.calls.put((function, args))
+
+    def run_calls(self):
+        while True:
+            function, args = self.calls.get()
+            try:
+                function(*args)
+            # pylint: disable=W0703
+            except Exception:
+                logging.exception("Slurm call failed.")
+
+    def update(self, server):
+        """Requests more clients if the task backlog is large.
+        """
+        now = time.time()
+        if now - self.last_update < FLAGS.slurm_scale_interval:
+            return
+        self.last_update = now
+        with self.lock:
+            for channel in server.channels:
+                jobid = channel.info.get('slurm_job_id')
+                if jobid is not None:
+                    self.registered.add(jobid)
+            num_requested = len(self.submitted) + self.submitting
+        if num_requested < FLAGS.num_clients:
+            # the initial clients, until they have all been submitted
+            self.submit_later(FLAGS.num_clients - num_requested)
+            return
+        if server.taskmanager is None:
+            return
+        num_clients = len(server.channels) + self.num_pending()
+        backlog = server.taskmanager.num_queued()
+        wanted = backlog // max(FLAGS.slurm_backlog_per_client, 1)
+        count = min(wanted, self.max_clients()) - num_clients
+        if count > 0:
+            logging.info("%d tasks queued for %d clients, requesting %d more.",
+                         backlog, num_clients, count)
+            self.submit_later(count)
+
+    def release(self, channel):
+        """Decides whether the given client, which is asking for a new task,
+        should be released. If so, its slurm job gets cancelled.
+
+        Clients are kept while the reduce tasks are still to come, as the
+        remaining tasks of the map phase say nothing about them.
+        """
+        server = channel.server
+        if server.taskmanager is None:
+            return False
+        taskmanager = server.taskmanager
+        if taskmanager.later_phase_pending() or \
+                taskmanager.num_queued() > 0 or \
+                taskmanager.num_remaining() >= len(server.channels) or \
+                len(server.channels) <= FLAGS.slurm_min_clients:
+            return False
+        # remove it now so the next decision sees the right client count
+        server.channels.discard(channel)
+        jobid = channel.info.get('slurm_job_id')
+        if jobid is not None:
+            logging.info("Releasing idle slurm client %s.", jobid)
+            with self.lock:
+                self.released.add(jobid)
+            self.call_later(self.cancel, jobid)
+        return True
+
+
 def launch_slurm(argv):
     """ launches the server on the local machine, and sbatch slurm clients
 
@@ -132,20 +599,37 @@ def launch_slurm(argv):
         --sbatch_args
         --slurm_shebang
         --slurm_python_bin
+        --slurm_elastic
+        --slurm_min_clients
+        --slurm_max_clients
+        --slurm_backlog_per_client
+        --slurm_scale_interval
+        --slurm_lean_client
     """
     address = socket.gethostbyname(socket.gethostname())
+    if FLAGS.slurm_lean_client:
+        # the lean client imports the script on its first task
+        program = "-m mincepie.leanclient --map_module=%s %s" \
+                % (argv[0], " ".join(argv[1:]))
+    else:
+        program = " ".join(argv)
     command = "%s\n%s %s --address=%s --launch=client" \
                 % (FLAGS.slurm_shebang,
                    FLAGS.slurm_python_bin,
-                   " ".join(argv),
+                   program,
                    address)
     jobname = hashlib.md5(argv[0] + str(FLAGS.port) + str(time.time()))\
                      .hexdigest()
     if (FLAGS.num_clients <= 0):
         logging.fatal("The number of slurm clients should be positive.")
         sys.exit(1)
+    pool = SlurmElasticPool(jobname, command)
     # first, run server
     server = mince.Server()
+    if FLAGS.slurm_elastic:
+        # in elastic mode the server process submits all the clients itself,
+        # so it knows which jobs are still pending.
+        server.elastic = pool
     serverprocess = Process(target = server.run_server, args=())
     serverprocess.start()
     # now, submit slurm jobs
@@ -156,29 +640,16 @@ def launch_slurm(argv):
         fid.close()
     logging.info('Command saved to %s.sh', jobname)
     logging.info('Use sbatch %s.sh to add jobs if you want.', jobname)
-    for i in range(FLAGS.num_clients):
-        args = [FLAGS.sbatch_bin, '--job-name=%s' % (jobname,)]
-        if len(FLAGS.sbatch_args) > 0:
-            args += FLAGS.sbatch_args
-        proc = Popen(args, stdin = PIPE, stdout = PIPE, stderr = PIPE)
-        out, err = proc.communicate(command)
-        if err != "":
-            # sbatch seem to have returned an error
-            logging.fatal("Sbatch does not run as expected.")
-            logging.fatal("Stdout:\n" + out)
-            logging.fatal("Stderr:\n" + err)
+    if not FLAGS.slurm_elastic:
+        try:
+            pool.submit(FLAGS.num_clients)
+        except RuntimeError:
             serverprocess.terminate()
             sys.exit(1)
-        else:
-            logging.debug("Slurm job #%d: %s", i, str(out).strip())
     # wait for server process to finish
     serverprocess.join()
     logging.debug("Removing any pending jobs.")
-    proc = Popen([FLAGS.scancel_bin, '--name=%s' % (jobname,)],
-                stdin = PIPE, stdout = PIPE, stderr = PIPE)
-    # Here we simply do a communicate and discard the results
-    # We may want to handle the case when scancel fails?
-    proc.communicate()
+    pool.cancel()
     return
 
 
@@ -187,6 +658,11 @@ def launch_mpi():
 
     The mpi root host runs in server mode, and others run in client mode.
     Note that you need to have more than 1 mpi host for this to work.
+
+    With --mpi_native, all the communication goes through MPI messages.
+    Otherwise, if --mpi_group_size is larger than 1, the first host of each
+    group of non-root hosts runs in sub-server mode instead, and the other
+    hosts of the group connect to it.
     """
     try:
         from mpi4py import MPI
@@ -197,10 +673,17 @@ def launch_mpi():
     if comm.Get_size() == 1:
         logging.error('You need to specify more than one MPI host.')
         sys.exit(1)
-    # get the server address
+    if FLAGS.mpi_native:
+        if comm.Get_rank() == 0:
+            mpitransport.MPIServer(comm).run_server()
+        else:
+            mpitransport.MPIClient(comm).run_client()
+        return
+    # get the addresses of all hosts
     address = socket.gethostbyname(socket.gethostname())
-    address = comm.bcast(address)
-    if comm.Get_rank() == 0:
+    addresses = comm.allgather(address)
+    rank = comm.Get_rank()
+    if rank == 0:
         # server mode
         server = mince.Server()
         server.run_server()
@@ -208,10 +691,22 @@ def launch_mpi():
         # some clients still running, and MPI does not exit very elegantly. 
         # However, with asynchat and the current implementation we have no 
         # trace of running clients, so this is probably inevitable.
+    elif FLAGS.mpi_group_size > 1:
+        # two-level mode: each group of hosts is served by its first host.
+        # Groups get different ports in case they share a machine.
+        group = (rank - 1) // FLAGS.mpi_group_size
+        leader = 1 + group * FLAGS.mpi_group_size
+        port = FLAGS.subserver_port + group
+        if rank == leader:
+            server = subserver.SubServer()
+            server.run_subserver(addresses[0], port)
+        else:
+            client = mince.Client()
+            client.run_client(addresses[leader], port)
     else:
         # client mode
         client = mince.Client()
-        client.run_client(address)
+        client.run_client(addresses[0])
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+"""
+The leanclient module implements a client entry point that starts fast.
+
+A regular client runs the whole user script, so it imports every module the
+script needs (numpy, models, data libraries...) before it even connects to the
+server. The lean client only imports mincepie, connects, and imports the
+module defining the mapper when the first map task arrives, and the module
+defining the reducer when the first reduce task arrives. This cuts the time to
+the first task for large fleets of clients, such as the ones submitted with
+--launch=slurm (see --slurm_lean_client in launcher).
+
+To run a lean client manually, run
+    python -m mincepie.leanclient --map_module=wordcount.py --address=SERVER_IP
+with the same flags as the server. The modules are imported under their own
+names, so the launcher.launch() call of a script guarded by
+    if __name__ == "__main__":
+is not executed. Flags defined by the user modules are parsed once the modules
+are imported.
+
+The time spent starting the client, since the python process started, and
+importing each module is logged, and sent to the server with the client
+information (see mince.client_info). The lean client parses its flags itself
+rather than running through mincepie.launcher as the regular clients do.
+Batch mappers and reducers only get batches of tasks once both modules are
+imported; before that, they run on single tasks.
+
+Flags defined by this module:
+    --map_module: the python file or module name that defines the mapper (and
+        the combiner, if any).
+    --reduce_module: the python file or module name that defines the reducer.
+        Default "", which means the same as --map_module.
+"""
+
+import time
+# the start time if the process start time is not known (see
+# process_seconds)
+_START_TIME = time.time()
+
+# python modules
+import gflags
+import importlib
+import logging
+import os
+import sys
+
+from . import mince
+from .mince import COMMAND
+
+gflags.DEFINE_string("map_module", "",
+    "The python file or module name that defines the mapper")
+gflags.DEFINE_string("reduce_module", "",
+    "The python file or module name that defines the reducer")
+FLAGS = gflags.FLAGS
+
+MAP_COMMANDS = (COMMAND.map, COMMAND.mapbatch)
+REDUCE_COMMANDS = (COMMAND.reduce, COMMAND.reducebatch,
+                   COMMAND.reducepartition, COMMAND.reducechunk,
+                   COMMAND.reduceend)
+
+
+def import_module(name):
+    """Imports a module given by its name or the path to its python file.
+    """
+    if name.endswith('.py') or os.path.isfile(name):
+        dirname, filename = os.path.split(os.path.abspath(name))
+        if dirname not in sys.path:
+            sys.path.insert(0, dirname)
+        name = os.path.splitext(filename)[0]
+    return importlib.import_module(name)
+
+
+def process_seconds():
+    """Returns the number of seconds since the process started, read from
+    /proc on Linux so that starting python and importing mincepie count.
+    Elsewhere, returns the number of seconds since this module was imported.
+    """
+    try:
+        with open('/proc/self/stat') as fid:
+            stat = fid.read()
+        with open('/proc/uptime') as fid:
+            uptime = float(fid.read().split()[0])
+        # the fields after the command name, which may contain spaces. The
+        # start time, in clock ticks after boot, is the 22nd field.
+        start_ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+        return uptime - start_ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (EnvironmentError, ValueError, IndexError):
+        return time.time() - _START_TIME
+
+
+def log_level(argv):
+    """Returns the value of --loglevel in argv, or logging.INFO. The flag is
+    defined by mincepie.launcher, which the lean client does not run through.
+    """
+    level = logging.INFO
+    for i, arg in enumerate(argv):
+        if arg.startswith('--loglevel='):
+            level = int(arg.split('=', 1)[1])
+        elif arg == '--loglevel' and i + 1 < len(argv):
+            level = int(argv[i + 1])
+    return level
+
+
+def known_argv(argv, names=None):
+    """Returns argv with only the given flags, which default to the flags
+    that are defined.
+
+    The values of the other flags given as two arguments (--flag value) are
+    removed as well.
+    """
+    flags = FLAGS.FlagDict() if names is None else names
+    result = argv[:1]
+    skip_value = False
+    for arg in argv[1:]:
+        if skip_value and not arg.startswith('-'):
+            skip_value = False
+            continue
+        skip_value = False
+        if not arg.startswith('-'):
+            result.append(arg)
+            continue
+        name = arg.lstrip('-').split('=', 1)[0]
+        if name in flags or (name.startswith('no') and name[2:] in flags):
+            result.append(arg)
+        elif '=' not in arg:
+            skip_value = True
+    return result
+
+
+class LeanClient(mince.Client):
+    """A client that imports the user modules on demand
+    """
+    def __init__(self, argv):
+        mince.Client.__init__(self)
+        self.argv = argv
+        self.startup_seconds = None
+        self.import_seconds = {}
+
+    def map_modules(self):
+        modules = [FLAGS.map_module]
+        if FLAGS.combiner:
+            modules.append(FLAGS.reduce_module or FLAGS.map_module)
+        return modules
+
+    def reduce_modules(self):
+        return [FLAGS.reduce_module or FLAGS.map_module]
+
+    def import_modules(self, names):
+        """Imports the given modules if they are not imported yet, and tells
+        the server how long it took.
+        """
+        names = [name for name in names if name not in self.import_seconds]
+        if not names:
+            return
+        defined = set(FLAGS.FlagDict())
+        for name in names:
+            start = time.time()
+            import_module(name)
+            self.import_seconds[name] = time.time() - start
+            logging.info("Imported %s in %.3f seconds." % \
+                         (name, self.import_seconds[name]))
+        # parse the flags defined by the new modules only, as parsing the
+        # others again would repeat the values of the multistring flags
+        FLAGS(known_argv(self.argv, set(FLAGS.FlagDict()) - defined))
+        if self.supports(COMMAND.register):
+            self.send_command(COMMAND.register, self.register_info())
+
+    def register_info(self):
+        if self.startup_seconds is None:
+            self.startup_seconds = process_seconds()
+            logging.info("Client started in %.3f seconds." % \
+                         self.startup_seconds)
+        if all(name in self.import_seconds
+               for name in self.map_modules() + self.reduce_modules()):
+            # the mapper and reducer classes are known now
+            info = mince.Client.register_info(self)
+        else:
+            info = mince.client_info()
+        info['startup_seconds'] = self.startup_seconds
+        info['import_seconds'] = dict(self.import_seconds)
+        return info
+
+    def process_command(self, command, data=None):
+        if command in MAP_COMMANDS:
+            self.import_modules(self.map_modules())
+        elif command in REDUCE_COMMANDS:
+            self.import_modules(self.reduce_modules())
+        mince.Client.process_command(self, command, data)
+
+
+def main(argv=None):
+    """Runs a lean client with the commandline flags
+    """
+    if argv is None:
+        argv = sys.argv
+    try:
+        FLAGS(known_argv(argv))
+    except gflags.FlagsError as message:
+        print('%s\nUsage: %s ARGS\n%s' % (message, argv[0], FLAGS))
+        sys.exit(1)
+    logging.basicConfig(level=log_level(argv))
+    if not FLAGS.map_module:
+        logging.fatal("The lean client needs --map_module.")
+        sys.exit(1)
+    client = LeanClient(argv)
+    client.run_client()
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,26 @@ cases.
 Flags defined by this module:
     --mapper, --reducer, --reader, --writer: the class names for the mapper,
         reducer, reader and writer respectively.
+    --combiner: the class name of a reducer that combines partial map outputs
+        before they are sent to the server. Default "", no combining.
     --input: the input pattern that gets passed to the reader.
     --output: the output that gets passed to the writer.
+    --num_shards: the number of files ShardedFileWriter writes. Default 1.
 
 Yangqing Jia, jiayq@eecs.berkeley.edu
 """
 
+import array
 import pickle
 import gflags
-import glob
 import logging
+import os
+import socket
 import sys
 
+from . import inputcache
+from . import largevalue
+
 # flags we are going to use
 gflags.DEFINE_string("mapper", "",
                      "The mapper class for the mapreduce task")
@@ -26,10 +34,14 @@ gflags.DEFINE_string("reader", "",
                      "The reader class for the mapreduce task")
 gflags.DEFINE_string("writer", "",
                      "The reader class for the mapreduce task")
+gflags.DEFINE_string("combiner", "",
+                     "The reducer class used to combine partial map outputs")
 gflags.DEFINE_string("output", "",
                      "The string passed to the writer")
 gflags.DEFINE_string("input", "",
                      "The input pattern.")
+gflags.DEFINE_integer("num_shards", 1,
+                     "The number of output files of ShardedFileWriter")
 FLAGS = gflags.FLAGS
 
 
@@ -98,6 +110,34 @@ READER  = lambda name: _get_registered(_READERS,  name)
 WRITER  = lambda name: _get_registered(_WRITERS,  name)
 
 
+def COMBINER(name):
+    """Returns an instance of the registered reducer used as a combiner, or
+    None if name is empty.
+
+    Different from the other registered objects, there is no default combiner
+    since combining only makes sense if the reducer output can be reduced
+    again, like sum() or max().
+    """
+    if name is None or name == "":
+        return None
+    return REDUCER(name)()
+
+def combine(combiner, results):
+    """Combines partial map outputs in place.
+
+    Input:
+        combiner: a reducer instance returned by COMBINER(), or None.
+        results: a dictionary mapping each key to a list of values.
+    Output:
+        the same dictionary, where each list of values is replaced by a list
+        containing the single reduced value.
+    """
+    if combiner is not None:
+        for key in results:
+            results[key] = [combiner.reduce(key, results[key])]
+    return results
+
+
 # pylint: disable=R0922
 class BasicMapper(object):
     """The basic mapper class. 
@@ -139,7 +179,20 @@ class BasicReducer(object):
     """The basic reducer class. 
     
     All your reducerss are belong to this.
+
+    Set associative to True if reducing the results of reducing parts of the
+    values gives the same result as reducing all the values at once, like
+    sum() or max(). Keys with a huge number of values are then reduced in
+    parallel parts (see --hot_key_values in mince).
+
+    Set streaming to True if reduce() only loops over the values once, without
+    indexing them or taking their length. It may then receive an iterator
+    instead of a list, which yields the values as they arrive from the server,
+    so a reducer that folds over the values (like sum()) runs in constant
+    memory however many values a key has.
     """
+    associative = False
+    streaming = False
 
     def __init__(self):
         """The default initialization: calls set_up()
@@ -158,7 +211,8 @@ class BasicReducer(object):
     def reduce(self, key, values):
         """The reduce function for mapreduce.
 
-        The input should be one key and one value. The output should be a list
+        The input should be one key and a list of values, or an iterable of
+        values if the reducer is streaming. The output should be a list
         of (key, value) pairs, or a yield command that emits key value pairs.
 
         You should implement your own map function in your derived class.
@@ -168,12 +222,141 @@ class BasicReducer(object):
 REGISTER_REDUCER(BasicReducer)
 
 
+def _import_numpy():
+    """Imports numpy, which is only needed by the batch mappers and reducers
+    """
+    try:
+        import numpy
+    except ImportError:
+        logging.fatal('To use batch mappers or reducers, you need numpy.')
+        sys.exit(1)
+    return numpy
+
+
+def _as_array(numpy, values):
+    """Returns the values as a numpy array. The typed columns of --value_type
+    are viewed in place instead of being converted value by value.
+    """
+    if isinstance(values, array.array):
+        if not len(values):
+            return numpy.empty(0, numpy.dtype(values.typecode))
+        return numpy.frombuffer(values, numpy.dtype(values.typecode))
+    return numpy.asarray(values)
+
+
+class BatchMapper(BasicMapper):
+    """The base class of vectorized mappers.
+
+    Instead of map(), implement map_batch(), which maps many input values at
+    once with numpy. Clients running a BatchMapper get their map tasks in
+    batches of --batch_size, and send the outputs back as numpy arrays (one
+    per output key) instead of lists of python objects.
+    """
+    def map_batch(self, keys, values):
+        """The vectorized map function.
+
+        Input:
+            keys: the list of input keys.
+            values: a numpy array stacking the input values along the first
+                axis, i.e. values[i] is the value of keys[i].
+        Output:
+            a tuple (out_keys, out_values), where out_keys is a 1-d array (or
+            list) of output keys and out_values an array whose first axis has
+            the same length, so out_values[i] is emitted under out_keys[i].
+        """
+        raise NotImplementedError
+
+    def map(self, key, value):
+        """Maps a single input as a batch of one.
+        """
+        numpy = _import_numpy()
+        out_keys, out_values = self.map_batch([key], numpy.asarray([value]))
+        for out_key, out_value in zip(out_keys, out_values):
+            yield out_key, out_value
+
+    def map_batch_grouped(self, keys, values):
+        """Runs map_batch() and groups its outputs by key.
+
+        Output:
+            a dictionary mapping each output key to the numpy array of its
+            values, in the order they were emitted.
+        """
+        numpy = _import_numpy()
+        out_keys, out_values = self.map_batch(keys, numpy.asarray(values))
+        out_keys = numpy.asarray(out_keys)
+        out_values = numpy.asarray(out_values)
+        if len(out_keys) == 0:
+            return {}
+        # a stable sort keeps the values of each key in the emitted order
+        order = numpy.argsort(out_keys, kind='mergesort')
+        sorted_keys = out_keys[order]
+        starts = numpy.flatnonzero(
+                numpy.concatenate(([True],
+                                   sorted_keys[1:] != sorted_keys[:-1])))
+        groups = numpy.split(out_values[order], starts[1:])
+        return dict(zip(sorted_keys[starts].tolist(), groups))
+
+REGISTER_MAPPER(BatchMapper)
+
+
+class BatchReducer(BasicReducer):
+    """The base class of vectorized reducers.
+
+    Instead of reduce(), implement reduce_batch(), which reduces many keys at
+    once with numpy. Clients running a BatchReducer get their reduce tasks in
+    batches of --batch_size.
+    """
+    def reduce_batch(self, keys, values, counts):
+        """The vectorized reduce function.
+
+        Input:
+            keys: the list of keys to reduce.
+            values: a numpy array with the values of all the keys concatenated
+                along the first axis: the first counts[0] values belong to
+                keys[0], the next counts[1] values to keys[1], and so on.
+            counts: a numpy array with the number of values of each key.
+        Output:
+            an array (or list) with the result of each key.
+        """
+        raise NotImplementedError
+
+    def reduce(self, key, values):
+        """Reduces a single key as a batch of one.
+        """
+        numpy = _import_numpy()
+        values = _as_array(numpy, values)
+        return self.reduce_batch([key], values, numpy.array([len(values)]))[0]
+
+    def reduce_batch_list(self, keys, values_list):
+        """Runs reduce_batch() on a list of value arrays. The outputs of batch
+        mappers arrive as numpy arrays already (see columnar.ArrayColumn),
+        and the typed columns of --value_type are viewed as arrays, so the
+        values are only copied once, into the concatenated array.
+
+        Output:
+            the list of results, one for each key.
+        """
+        numpy = _import_numpy()
+        arrays = [_as_array(numpy, values) for values in values_list]
+        counts = numpy.array([len(array) for array in arrays])
+        results = self.reduce_batch(keys, numpy.concatenate(arrays), counts)
+        if getattr(results, 'ndim', None) == 1:
+            # scalar results, one per key, are sent as python numbers
+            # instead of numpy ones
+            results = results.tolist()
+        return list(results)
+
+REGISTER_REDUCER(BatchReducer)
+
+
 class BasicReader(object):
     """The basic reader class
 
     The default BasicReader assumes that the input is a string specifying
     a certain file pattern, uses glob to retrieve a list of files, and 
-    emits each filename. The key would be an index starting from 0.
+    emits each filename. The key would be an index starting from 0. The
+    expanded patterns can be cached with --input_cache (see
+    mincepie.inputcache).
     """
     def __init__(self):
         self.set_up()
@@ -195,10 +378,24 @@ class BasicReader(object):
         a certain file pattern, uses glob to retrieve a list of files, and 
         emits each filename. The key would be an index starting from 0.
         """
-        inputlist = glob.glob(input_string)
-        inputlist.sort()
+        inputlist = inputcache.glob_files(input_string)
         return dict(enumerate(inputlist))
 
+    def sources(self, input_string):
+        """Returns the list of the parts of the input that can be read
+        independently, such as files, which the server reads in parallel
+        threads (see mincepie.prefetch). By default, the whole input is a
+        single source.
+        """
+        return [input_string]
+
+    def read_source(self, source):
+        """Yields the (key, value) pairs of a source returned by sources().
+        It may be called from several threads at a time. By default, the
+        pairs returned by read() are yielded.
+        """
+        return self.read(source).items()
+
 # If the user does not override the reader option, BasicReader is the default
 # reader.
 REGISTER_DEFAULT_READER(BasicReader)
@@ -209,7 +406,15 @@ class BasicWriter(object):
 
     Different from the mapper and reducer base classes, you can directly
     use BasicWriter - it simply spits all the dictionary entries.
+
+    Set sharded to True if the writer implements write_shard() and
+    write_shards(). In total order mode (see --total_order in mince), each
+    client then writes the shard of the key range it reduces, and the server
+    only gets the names of the shards instead of the results. The clients
+    must be able to write to the output then.
     """
+    sharded = False
+
     def __init__(self):
         self.set_up()
     
@@ -228,7 +433,27 @@ class BasicWriter(object):
             a dictionary containing (key,value) pairs.
         """
         for key in result:
-            print(repr(key), ":", repr(result[key]))
+            print(repr(key), ":", repr(largevalue.resolve(result[key])))
+
+    def write_shard(self, shard, num_shards, pairs):
+        """Writes one shard of the results, on a client.
+
+        Input:
+            shard: the index of the shard, from 0 to num_shards - 1, in key
+                order.
+            num_shards: the number of shards.
+            pairs: the list of (key, result) pairs of the shard, sorted by
+                key.
+        Output:
+            the name of the shard, which is passed to write_shards().
+        """
+        raise NotImplementedError
+
+    def write_shards(self, names):
+        """Called on the server once the clients have written all the shards,
+        with the list of their names in key order.
+        """
+        raise NotImplementedError
 
 # If the user does not override the writer option, BasicWriter is the default
 # writer.
@@ -258,6 +483,8 @@ REGISTER_REDUCER(IdentityReducer)
 class SumReducer(BasicReducer):
     """SumReducer is a reducer that returns the sum of the values
     """
+    associative = True
+    streaming = True
     
     def reduce(self, key, values):
         return sum(values)
@@ -265,13 +492,29 @@ class SumReducer(BasicReducer):
 REGISTER_REDUCER(SumReducer)
 
 
+class ArraySumReducer(BatchReducer):
+    """ArraySumReducer is the vectorized version of SumReducer: it sums the
+    values of all the keys of a batch with a single numpy call.
+    """
+    associative = True
+
+    def reduce_batch(self, keys, values, counts):
+        numpy = _import_numpy()
+        offsets = numpy.cumsum(counts) - counts
+        return numpy.add.reduceat(values, offsets, axis=0)
+
+REGISTER_REDUCER(ArraySumReducer)
+
+
 class FirstElementReducer(BasicReducer):
     """FirstElementReducer is a reducer that takes the first value and ignores
     others
     """
+    associative = True
+    streaming = True
     
     def reduce(self, key, values):
-        return values[0]
+        return next(iter(values))
 
 REGISTER_REDUCER(FirstElementReducer)
 
@@ -281,6 +524,7 @@ class NoPassReducer(BasicReducer):
     
     "You shall not pass!" - Gandalf the Grey
     """
+    streaming = True
 
     def reduce(self, key, values):
         return
@@ -293,15 +537,19 @@ class FileReader(BasicReader):
     a value. The key is in the format filename:lineid
     """
     def read(self, input_string):
-        inputlist = glob.glob(input_string)
-        inputlist.sort()
         data = {}
-        for filename in inputlist:
-            with open(filename, 'r') as fid:
-                for index, line in enumerate(fid):
-                    data[filename+":"+str(index)] = line.strip()
+        for filename in self.sources(input_string):
+            data.update(self.read_source(filename))
         return data
 
+    def sources(self, input_string):
+        return inputcache.glob_files(input_string)
+
+    def read_source(self, filename):
+        with open(filename, 'r') as fid:
+            for index, line in enumerate(fid):
+                yield filename+":"+str(index), line.strip()
+
 REGISTER_READER(FileReader)
 
 
@@ -332,18 +580,63 @@ class FileWriter(BasicWriter):
     def write(self, result):
         with open(FLAGS.output,'w') as fid:
             for key in result:
-                fid.write(repr(key) + ":" + repr(result[key])+'\n')
+                fid.write(repr(key) + ":" +
+                          repr(largevalue.resolve(result[key])) + '\n')
 
 REGISTER_WRITER(FileWriter)
 
 
+class ShardedFileWriter(BasicWriter):
+    """The class that dumps the key value pairs to FLAGS.num_shards files
+    named FLAGS.output-00000-of-NNNNN, etc, in the same format as FileWriter.
+
+    Each shard holds a contiguous run of the result. With --total_order, each
+    client writes the shard of the key range it reduces instead, so there is
+    one shard per key range (see --num_partitions in mince) and
+    --num_shards is not used. Every shard is then sorted, and the shards are
+    ordered with respect to each other.
+    """
+    sharded = True
+
+    def write(self, result):
+        num_shards = max(FLAGS.num_shards, 1)
+        keys = list(result)
+        for shard in range(num_shards):
+            start = len(keys) * shard // num_shards
+            end = len(keys) * (shard + 1) // num_shards
+            self.write_shard(shard, num_shards,
+                             ((key, result[key]) for key in keys[start:end]))
+
+    def write_shard(self, shard, num_shards, pairs):
+        filename = "%s-%05d-of-%05d" % (FLAGS.output, shard, num_shards)
+        # another client may write the same key range if the task is run
+        # again, so the shard is written under a name of its own first.
+        temp_name = "%s.%s-%d" % (filename, socket.gethostname(), os.getpid())
+        with open(temp_name, 'w') as fid:
+            for key, value in pairs:
+                fid.write(repr(key) + ":" +
+                          repr(largevalue.resolve(value)) + '\n')
+        os.rename(temp_name, filename)
+        return filename
+
+    def write_shards(self, names):
+        logging.info("%d shards written to %s-*." % (len(names),
+                                                     FLAGS.output))
+
+REGISTER_WRITER(ShardedFileWriter)
+
+
 class PickleWriter(BasicWriter):
     """The class that dumps the key values pair to FLAGS.output as picked
-    objects.
+    objects. Large values (see mincepie.largevalue) are loaded one at a time
+    as they are written.
     """
     def write(self, result):
         with open(FLAGS.output,'w') as fid:
-            pickle.dump(result, fid)
+            if largevalue.has_references(result):
+                largevalue.dump_resolved(result, fid)
+            else:
+                pickle.dump(result, fid)
 
 REGISTER_WRITER(PickleWriter)
 
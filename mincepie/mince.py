@@ -42,6 +42,69 @@ Flags defined by this module:
     --report_interval: the percentage interval between which we report the 
         progress of mapping. Default 10 (i.e. we report the elapsed time at
         10%, 20%, ...).
+    --tick_interval: the number of seconds the server waits on its sockets
+        before running its periodic housekeeping (such as elastic scaling).
+        Default 1.
+    --total_order: if set, the results are ordered by key. The server samples
+        the intermediate keys to split them into key ranges, and each reduce
+        task reduces and sorts one key range. With a sharded writer (see
+        mapreducer.BasicWriter), the clients write the shard of each key range
+        themselves, and the server only keeps the shard names. Default False.
+    --num_partitions: the number of key ranges in total order mode. Default
+        0, which means 4 per connected client.
+    --partition_sample_size: the number of intermediate keys sampled to
+        compute the key ranges. Default 10000.
+    --hot_key_values, --hot_key_bytes: an intermediate key is hot if it has
+        at least this many values, or if its values take at least this many
+        bytes when pickled. If the reducer is associative, a hot key is
+        reduced in parts that are merged with a final reduce. Otherwise, its
+        values are streamed to the client in chunks instead of one message.
+        Hot keys are not treated specially in total order mode. Defaults
+        100000 and 64MB. Use 0 to disable the check.
+    --reduce_chunk_size: the number of values per chunk when streaming the
+        values of a key, which happens for hot keys, and for any key with more
+        values than this if the reducer is streaming (see
+        mapreducer.BasicReducer). Default 10000.
+    --batch_size: the number of tasks sent at a time to a client that runs a
+        mapreducer.BatchMapper or BatchReducer. Default 1000.
+    --task_timeout: the number of seconds after which a client still running
+        a task is considered stuck: it is disconnected, and its task counts as
+        a failed attempt. Default 0, i.e. no timeout. Not used with the native
+        MPI transport.
+    --max_attempts: the number of failed attempts (the client disconnected
+        or timed out while running it) after which a task is quarantined:
+        the rest of the job goes on without it. Default 0, i.e. tasks are
+        retried forever.
+    --quarantine_output: the file to which the quarantined map inputs and
+        reduce values are pickled at the end of the job, as a dictionary
+        {'map': {key: value}, 'reduce': {key: values}}. Default "", in which
+        case the quarantined keys are only logged.
+    --send_buffer_bytes: the maximum number of bytes the server buffers for
+        sending to all its clients. Clients asking for a task while the
+        buffers are full wait until they drain. Default 512MB. 0 for no limit.
+    --receive_buffer_bytes: the maximum number of bytes of partially received
+        replies the server holds. Beyond this, the server only keeps reading
+        the replies it has started receiving, and the other clients are held
+        back by TCP flow control. Default 512MB. 0 for no limit.
+    --client_credit_bytes: the number of bytes of task data a client accepts
+        at a time. The client advertises it to the server, which stops adding
+        tasks to a batch for the client once their estimated size reaches it.
+        Default 0, i.e. batches are only limited by --batch_size.
+    --binary_protocol: if set, a client switches to binary frames (see
+        Protocol) once it has checked that the server supports them. Servers
+        always accept them, and still talk the text protocol to clients that
+        do not ask for frames. Frames carry a task token that lets the server
+        drop stale replies unread; they do not multiplex tasks, and a client
+        still has one task or batch outstanding at a time. Default True.
+    --frame_checksum: if set, the binary frames carry a CRC32 of their
+        payload, which the receiver checks. Default False.
+    --target_task_seconds: if positive, the server measures the time each
+        client takes per task, and sends it batches of tasks that should take
+        about this many seconds, up to --batch_size tasks (or the batch size
+        of a sub-server). Once no task is queued, an idle client takes the
+        unstarted tail of the batch of the client expected to finish last.
+        Default 0, i.e. clients get single tasks unless they run batch
+        mappers or reducers.
 
 Modified by Yangqing Jia (jiayq@eecs.berkeley.edu)
 """
@@ -49,23 +112,55 @@ Modified by Yangqing Jia (jiayq@eecs.berkeley.edu)
 # python modules
 import asynchat
 import asyncore
+import bisect
+import collections
 import pickle
-import datetime
 import gflags
 import hashlib
 import hmac
 import logging
 import os
+import random
+import select
 import socket
+import struct
 import sys
+import threading
 import time
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
+from . import broadcast
+from . import columnar
+from . import intermediate
+from . import largevalue
 from . import mapreducer
+from . import prefetch
+from . import progress
+from . import sideoutput
+from . import storage
+from . import usage
 
 # constant variables
 SEPARATOR = ':'
 TERMINATOR = '\n'
 CONNECTION_WAIT_TIME = 1
+# the number of values of a key before we first check if it is hot, and the
+# number of values we pickle to estimate its size
+HOT_KEY_FIRST_CHECK = 1000
+HOT_KEY_SAMPLE = 100
+# the number of chunks a client buffers for a streaming reducer
+STREAM_QUEUE_SIZE = 4
+# the weight of the last task in the time per task of a client
+TASK_SECONDS_SMOOTHING = 0.3
+# the number of seconds between two checks of a client for stolen tasks
+STEAL_POLL_INTERVAL = 0.1
+# the number of seconds between two checks for new records while the input
+# is being read
+READER_POLL_INTERVAL = 0.1
 
 # we use an enum to define the commands, just in case some typo takes place
 # in coding.
@@ -77,14 +172,62 @@ class Enum(set):
             return name
         raise AttributeError
 
-COMMAND = Enum(['challenge',
+# the commands, in the order of their opcodes in binary frames: new commands
+# go at the end.
+COMMANDS = ['challenge',
                 'auth',
                 'disconnect',
                 'map',
                 'reduce',
                 'mapdone',
                 'reducedone',
-               ])
+                'register',
+                'mapbatch',
+                'reducebatch',
+                'mapbatchdone',
+                'reducebatchdone',
+                'reducepartition',
+                'reducechunk',
+                'reduceend',
+                # not sent over the wire: tells a ServerChannel to send a
+                # reduce task as reducechunk commands followed by reduceend.
+                'reducestream',
+                'broadcast',
+                'broadcastget',
+                'blobchunk',
+                'blobend',
+                'cancel',
+                'cancelled',
+                'protocol',
+                'steal',
+               ]
+COMMAND = Enum(COMMANDS)
+OPCODE = dict((command, code) for code, command in enumerate(COMMANDS))
+
+# the commands that carry the result of a task
+RESULT_COMMANDS = (COMMAND.mapdone, COMMAND.reducedone,
+                   COMMAND.mapbatchdone, COMMAND.reducebatchdone)
+
+# the batch version of each single task command
+BATCH_COMMAND = {COMMAND.map: COMMAND.mapbatch,
+                 COMMAND.reduce: COMMAND.reducebatch,
+                }
+
+# the binary frames: a header with the protocol version, the opcode, flags,
+# the task token (which tells stale replies apart, see Protocol), the length
+# of the payload and its CRC32 (or 0), followed by the payload.
+PROTOCOL_VERSION = 2
+# the version of the peers whose challenge does not end with a version. They
+# only know the commands below, and the commands added since need version 2.
+BASELINE_VERSION = 1
+BASELINE_COMMANDS = (COMMAND.challenge, COMMAND.auth, COMMAND.disconnect,
+                     COMMAND.map, COMMAND.reduce, COMMAND.mapdone,
+                     COMMAND.reducedone)
+FRAME_HEADER = struct.Struct('!BBBxIQI')
+# the payload is a string argument instead of pickled data
+FRAME_ARG = 1
+# the CRC32 of the payload is set
+FRAME_CHECKSUM = 2
 
 TASK = Enum(['START',
              'MAPPING',
@@ -104,6 +247,41 @@ gflags.DEFINE_integer("timeout", 60,
     "The number of seconds before a client stops reconnecting")
 gflags.DEFINE_integer("report_interval", 10,
     "The interval between which we report the elapsed time of mapping")
+gflags.DEFINE_float("tick_interval", 1.,
+    "The number of seconds between the server's periodic housekeeping")
+gflags.DEFINE_bool("total_order", False,
+    "If set, reduce sorted key ranges so the results are ordered by key")
+gflags.DEFINE_integer("num_partitions", 0,
+    "The number of key ranges in total order mode. 0 for 4 per client")
+gflags.DEFINE_integer("partition_sample_size", 10000,
+    "The number of keys sampled to compute the key ranges")
+gflags.DEFINE_integer("hot_key_values", 100000,
+    "The number of values that makes an intermediate key hot. 0 to disable")
+gflags.DEFINE_integer("hot_key_bytes", 64 << 20,
+    "The number of pickled bytes that makes an intermediate key hot")
+gflags.DEFINE_integer("reduce_chunk_size", 10000,
+    "The number of values per chunk when streaming the values of a key")
+gflags.DEFINE_integer("batch_size", 1000,
+    "The number of tasks sent at a time to clients with batch mappers")
+gflags.DEFINE_float("task_timeout", 0.,
+    "The number of seconds before a running task is considered stuck")
+gflags.DEFINE_integer("max_attempts", 0,
+    "The number of failed attempts before a task is quarantined. 0 for none")
+gflags.DEFINE_string("quarantine_output", "",
+    "The file to which the quarantined records are pickled")
+gflags.DEFINE_integer("send_buffer_bytes", 512 << 20,
+    "The maximum number of bytes buffered for sending to the clients")
+gflags.DEFINE_integer("receive_buffer_bytes", 512 << 20,
+    "The maximum number of bytes of partially received replies")
+gflags.DEFINE_integer("client_credit_bytes", 0,
+    "The number of bytes of task data a client accepts at a time")
+gflags.DEFINE_bool("binary_protocol", True,
+    "If set, clients use binary frames (one task at a time, with a token "
+    "that detects stale replies) with the servers supporting them")
+gflags.DEFINE_bool("frame_checksum", False,
+    "If set, the binary frames carry a CRC32 of their payload")
+gflags.DEFINE_float("target_task_seconds", 0.,
+    "If positive, the duration of the task batches sent to each client")
 
 # FLAGS
 FLAGS = gflags.FLAGS
@@ -119,6 +297,22 @@ class Protocol(asynchat.async_chat, object):
         * send command with possible arguments and data
         * deal with incoming data
         * Two-way authentication
+
+    Messages start as text: a "command:length" line followed by length bytes
+    of pickled data, or a "command:argument" line for the authentication
+    commands. Each end appends its protocol version to its challenge, and
+    only sends the commands that the version of the other end supports (see
+    BASELINE_COMMANDS), so older peers keep working. A client that supports
+    binary frames sends a protocol command right after its auth answer, and
+    the server answers with the same command.
+    Each end sends binary frames (see FRAME_HEADER) after sending the
+    protocol command, and reads binary frames after receiving it. A frame
+    header has a fixed size, so no terminator scan is needed, and carries a
+    task token: the server stamps each task with a new token, which the
+    client echoes in its reply, so late replies are told apart from the
+    current one before their payload is read. A client still has a single
+    task (or batch) outstanding at a time: the token only detects stale
+    replies, and frames do not interleave several tasks on a connection.
     """
     def __init__(self, conn=None):
         if conn:
@@ -130,30 +324,114 @@ class Protocol(asynchat.async_chat, object):
         self.buffer = []
         self.auth = None
         self.mid_command = None
+        # whether the data of the current command is dropped unread
+        self.skipping = False
+        # whether the incoming and outgoing messages are binary frames
+        self.frame_input = False
+        self.frame_output = False
+        # the header fields of the frame whose payload is being read
+        self.frame = None
+        # the task token of the outgoing frames
+        self.task_token = 0
+        # the protocol version of the other end, known once we have answered
+        # its challenge
+        self.peer_version = BASELINE_VERSION
 
     def collect_incoming_data(self, data):
         """Collect the incoming data and put it under buffer
         """
-        self.buffer.append(data)
+        if not self.skipping:
+            self.buffer.append(data)
 
     def send_command(self, command, data=None, arg=None):
         """Send the command with optional data
         """
+        self.push(self.encode_command(command, data, arg))
+
+    def encode_command(self, command, data=None, arg=None):
+        """Encode the command with optional data into the string to send
+        """
+        if self.frame_output:
+            return self.encode_frame(command, data, arg)
         encoded = command + SEPARATOR
         if arg:
             # this command contains some arguments
             encoded += arg
             #logging.debug("<- " + encoded)
-            self.push(encoded + TERMINATOR)
+            return encoded + TERMINATOR
         elif data:
             # this command contains pickled data
             pdata = pickle.dumps(data)
             encoded += str(len(pdata))
             #logging.debug("<- " + encoded + " (pickle)")
-            self.push(encoded + TERMINATOR + pdata)
+            return encoded + TERMINATOR + pdata
         else:
             #logging.debug("<- " + encoded)
-            self.push(encoded + TERMINATOR)
+            return encoded + TERMINATOR
+
+    def encode_frame(self, command, data=None, arg=None):
+        """Encode the command with optional data into a binary frame
+        """
+        flags = 0
+        if arg:
+            payload = arg
+            flags |= FRAME_ARG
+        elif data:
+            payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        else:
+            payload = ''
+        checksum = 0
+        if FLAGS.frame_checksum and payload:
+            flags |= FRAME_CHECKSUM
+            checksum = zlib.crc32(payload) & 0xffffffff
+        return FRAME_HEADER.pack(PROTOCOL_VERSION, OPCODE[command], flags,
+                                 self.task_token, len(payload),
+                                 checksum) + payload
+
+    def start_framing(self, command, data):
+        """Reads binary frames from now on, as the other end announced. The
+        announcement is returned if this end has not sent it yet.
+        """
+        self.frame_input = True
+        self.set_terminator(FRAME_HEADER.size)
+        if not self.frame_output:
+            self.send_command(COMMAND.protocol, arg=str(PROTOCOL_VERSION))
+            self.frame_output = True
+
+    def negotiate(self, challenge):
+        """Called after answering the challenge of the other end, which ends
+        with its protocol version. Clients override this to ask for frames.
+        """
+        pass
+
+    def supports(self, command):
+        """Tells if the other end understands the given command.
+        """
+        return command in BASELINE_COMMANDS or \
+                self.peer_version >= PROTOCOL_VERSION
+
+    def in_message(self):
+        """Tells if part of a message has been received.
+        """
+        return self.mid_command is not None or self.frame is not None or \
+                bool(self.buffer)
+
+    def count_buffered(self, nbytes):
+        """Called with the size of the data queued for sending. Subclasses
+        that bound their send buffers override this.
+        """
+        pass
+
+    def send_chunks(self, key, chunks, more=False):
+        """Send the values of a reduce task, given as an iterable of chunks.
+
+        The chunks are only read and pickled when the socket is ready for
+        them, so we never hold the whole value list in memory. If more is
+        True, the rest of the chunks and reduceend are sent later on (see
+        subserver.BatchTaskManager).
+        """
+        self.push_with_producer(
+                ChunkProducer(self, chunk_commands(key, chunks, more)))
 
     def decode_command(self, message):
         """decode the command to the command and the data
@@ -163,9 +441,32 @@ class Protocol(asynchat.async_chat, object):
             raise ValueError("Unrecognized command: " + message)
         return message[:idx], message[idx+1:]
 
+    def skip_data(self, command):
+        """Tells if the data of the given command should be dropped without
+        being unpickled. Subclasses that drop late results override this.
+        """
+        return False
+
+    def data_skipped(self, command):
+        """Called instead of process_command when the data of a command has
+        been dropped.
+        """
+        pass
+
+    def frame_received(self, task_token):
+        """Called with the task token of each incoming frame. Replies carry
+        the task token of the last frame received.
+        """
+        self.task_token = task_token
+
     def found_terminator(self):
         message = "".join(self.buffer)
-        if not self.auth == "Done":
+        # clean the buffer (before processing the command, which may read
+        # more data, see Client.check_cancelled)
+        self.buffer = []
+        if self.frame_input:
+            self.found_frame_part(message)
+        elif not self.auth == "Done":
             # before authentication, call process_unauthed_command
             command, data = self.decode_command(message)
             self.process_unauthed_command(command, data)
@@ -174,7 +475,7 @@ class Protocol(asynchat.async_chat, object):
             # and process it, and also check if this command comes with a
             # data string
             command, length = self.decode_command(message)
-            if command == COMMAND.challenge:
+            if command in (COMMAND.challenge, COMMAND.protocol):
                 # deal with challenge string
                 #logging.debug("-> " + message)
                 self.process_command(command, length)
@@ -183,6 +484,7 @@ class Protocol(asynchat.async_chat, object):
                 #logging.debug("-> " + message + " (pickle)")
                 self.set_terminator(int(length))
                 self.mid_command = command
+                self.skipping = self.skip_data(command)
             else:
                 # otherwise, simply process this command
                 self.process_command(command)
@@ -191,22 +493,74 @@ class Protocol(asynchat.async_chat, object):
             if not self.auth == "Done":
                 logging.fatal("Recieved pickled data from unauthed source")
                 sys.exit(1)
-            data = pickle.loads(message)
             # reset the terminator and mid_command for the next command
             self.set_terminator(TERMINATOR)
             command = self.mid_command
             self.mid_command = None
+            if self.skipping:
+                self.skipping = False
+                self.data_skipped(command)
+            else:
+                self.process_command(command, pickle.loads(message))
+
+    def found_frame_part(self, message):
+        """Processes a frame header, or the payload of the current frame.
+        """
+        if self.frame is None:
+            version, opcode, flags, task_token, length, checksum = \
+                    FRAME_HEADER.unpack(message)
+            if opcode >= len(COMMANDS):
+                logging.critical("Unknown opcode received: %d" % opcode)
+                self.handle_close()
+                return
+            command = COMMANDS[opcode]
+            self.frame_received(task_token)
+            if length == 0:
+                # asynchat has set the terminator to 0
+                self.set_terminator(FRAME_HEADER.size)
+                self.process_frame(command, flags, None)
+                return
+            self.frame = (command, flags, checksum)
+            self.set_terminator(length)
+            self.skipping = self.auth == "Done" and self.skip_data(command)
+            return
+        command, flags, checksum = self.frame
+        self.frame = None
+        self.set_terminator(FRAME_HEADER.size)
+        if self.skipping:
+            self.skipping = False
+            self.data_skipped(command)
+            return
+        if flags & FRAME_CHECKSUM and \
+                zlib.crc32(message) & 0xffffffff != checksum:
+            logging.critical("Corrupted %s frame received." % command)
+            self.handle_close()
+            return
+        self.process_frame(command, flags, message)
+
+    def process_frame(self, command, flags, payload):
+        if flags & FRAME_ARG or payload is None:
+            data = payload
+        elif not self.auth == "Done":
+            logging.fatal("Recieved pickled data from unauthed source")
+            sys.exit(1)
+        else:
+            data = pickle.loads(payload)
+        if self.auth == "Done":
             self.process_command(command, data)
-        # clean the buffer
-        self.buffer = []
+        else:
+            self.process_unauthed_command(command, data)
 
     def send_challenge(self):
-        self.auth = os.urandom(20).encode("hex")
+        # the protocol version we support follows the random string
+        self.auth = "%s/%d" % (os.urandom(20).encode("hex"), PROTOCOL_VERSION)
         self.send_command(COMMAND.challenge, arg=self.auth)
 
     def respond_to_challenge(self, command, data):
         mac = hmac.new(FLAGS.password, data, hashlib.sha1)
         self.send_command(COMMAND.auth, arg=mac.digest().encode("hex"))
+        self.peer_version = challenge_version(data)
+        self.negotiate(data)
         self.post_auth_init()
 
     def verify_auth(self, command, data):
@@ -221,6 +575,7 @@ class Protocol(asynchat.async_chat, object):
         handlers = {
             COMMAND.challenge: self.respond_to_challenge,
             COMMAND.disconnect: lambda x,y: self.handle_close(),
+            COMMAND.protocol: self.start_framing,
             }
         if command in handlers:
             handlers[command](command, data)
@@ -233,6 +588,7 @@ class Protocol(asynchat.async_chat, object):
             COMMAND.challenge: self.respond_to_challenge,
             COMMAND.auth: self.verify_auth,
             COMMAND.disconnect: lambda x, y: self.handle_close(),
+            COMMAND.protocol: self.start_framing,
             }
         if command in handlers:
             handlers[command](command, data)
@@ -241,29 +597,174 @@ class Protocol(asynchat.async_chat, object):
             self.handle_close()
         
 
+def challenge_version(challenge):
+    """Returns the protocol version at the end of a challenge, or
+    BASELINE_VERSION if there is none.
+    """
+    _, separator, version = challenge.rpartition('/')
+    if separator and version.isdigit():
+        return int(version)
+    return BASELINE_VERSION
+
+
+def chunk_commands(key, chunks, more=False):
+    """Yields the (command, data) pairs that stream the values of a reduce
+    task: a reducechunk command for each chunk, followed by reduceend unless
+    more is True.
+    """
+    for chunk in chunks:
+        yield (COMMAND.reducechunk, (key, chunk))
+    if not more:
+        yield (COMMAND.reduceend, (key,))
+
+
+def blob_commands(names):
+    """Yields the (command, data) pairs that send the given broadcast blobs:
+    a blobchunk command for each chunk of a blob, followed by blobend.
+    """
+    for name in names:
+        for data in broadcast.read_chunks(name):
+            yield (COMMAND.blobchunk, (name, data))
+        yield (COMMAND.blobend, (name,))
+
+
+class ChunkProducer(object):
+    """An asynchat producer that encodes the chunk commands on demand
+    """
+    def __init__(self, protocol, commands):
+        self.protocol = protocol
+        self.commands = commands
+
+    def more(self):
+        try:
+            command, data = next(self.commands)
+        except StopIteration:
+            return ''
+        encoded = self.protocol.encode_command(command, data)
+        self.protocol.count_buffered(len(encoded))
+        return encoded
+
+
+class ReduceStream(object):
+    """Runs a streaming reducer on the chunks of a streamed reduce task.
+
+    reduce() runs in its own thread, and iterates over the values as the
+    chunks arrive. Only a few chunks are buffered: if the reducer falls
+    behind, put() blocks, which stops reading from the socket.
+    """
+    def __init__(self, reducer, key):
+        self.chunks = queue.Queue(STREAM_QUEUE_SIZE)
+        self.ended = False
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(reducer, key))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def values(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.ended = True
+                return
+            for value in chunk:
+                yield value
+
+    def run(self, reducer, key):
+        try:
+            self.result = reducer.reduce(key, self.values())
+        # pylint: disable=W0703
+        except Exception as error:
+            logging.exception("Error reducing %s" % str(key))
+            self.error = error
+        # the reducer may not read all the values, e.g. FirstElementReducer
+        while not self.ended:
+            if self.chunks.get() is None:
+                self.ended = True
+
+    def put(self, chunk):
+        self.chunks.put(chunk)
+
+    def finish(self):
+        """Waits for the reducer and returns its result
+        """
+        self.chunks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SplitTask(object):
+    """The task key of one part of a hot key that is reduced in parts.
+
+    The client reduces the part under the original key, and the partial
+    results are merged by reducing them again.
+    """
+    def __init__(self, key, part):
+        self.key = key
+        self.part = part
+
+    def __eq__(self, other):
+        return isinstance(other, SplitTask) and \
+                (self.key, self.part) == (other.key, other.part)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.key, self.part))
+
+    def __repr__(self):
+        return "SplitTask(%r, %d)" % (self.key, self.part)
+
+
 class Client(Protocol):
     def __init__(self):
         Protocol.__init__(self)
         self.mapper = None
+        self.combiner = None
         self.reducer = None
+        self.stream_values = []
+        self.stream = None
+        self.meter = usage.TaskMeter()
+        self.blobs = broadcast.BlobReceiver()
+        # the tasks received while broadcast blobs are still arriving
+        self.deferred = []
+        # the keys of the tasks cancelled by the server
+        self.cancelled = set()
+        # the keys of the tasks of the running batch that the server gave to
+        # another client, and when to check for more
+        self.stolen = set()
+        self.next_poll = 0
 
-    def run_client(self, address = None):
+    def run_client(self, address = None, port = None):
         """Runs the client
 
         If address is None, the server address is obtaind from the commandline
         flags. Otherwise (e.g. we are running the whole mapreduce under MPI),
-        the server address is the passed-in address.
+        the server address is the passed-in address. The same goes for port.
+        """
+        if self.connect_server(address, port):
+            asyncore.loop()
+
+    def connect_server(self, address = None, port = None):
+        """Connects to the server, retrying for at most FLAGS.timeout seconds.
+
+        Returns True if the connection is established.
         """
         if address is None:
             address = FLAGS.address
-        logging.debug("Connecting to %s:%d" % (address, FLAGS.port))
+        if port is None:
+            port = FLAGS.port
+        logging.debug("Connecting to %s:%d" % (address, port))
         # connect, with possible failure
         time_spent = 0
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect((address, FLAGS.port))
+        self.connect((address, port))
         while (not self.connected) and time_spent < FLAGS.timeout:
             try:
-                self.connect((address, FLAGS.port))
+                self.connect((address, port))
             except socket.error as message:
                 logging.debug("Conection failed, retry... " + str(message))
                 # Calling __init__ is quite ugly, but there seems to be some 
@@ -275,9 +776,10 @@ class Client(Protocol):
                 time_spent += CONNECTION_WAIT_TIME
         if self.connected:
             logging.debug('Connected!')
-            asyncore.loop()
+            return True
         else:
             self.close()
+            return False
 
     def handle_connect(self):
         pass
@@ -297,16 +799,60 @@ class Client(Protocol):
         if self.mapper is None:
             # create the mapper instance
             self.mapper = mapreducer.MAPPER(FLAGS.mapper)()
-        for kvpair in self.mapper.map(data[0], data[1]):
+            self.combiner = mapreducer.COMBINER(FLAGS.combiner)
+        self.run_map(data[0], data[1], results)
+        mapreducer.combine(self.combiner, results)
+        self.send_result(COMMAND.mapdone,
+                         (data[0], columnar.encode(results)),
+                         count_values(results))
+
+    def run_map(self, key, value, results):
+        """Runs the mapper on one input, and adds the outputs to results
+        """
+        # large values are stored in files (see mincepie.largevalue)
+        spill = largevalue.spill if FLAGS.large_value_bytes > 0 else None
+        for kvpair in self.mapper.map(key, value):
             # if the mapper returns nothing, do nothing
             if kvpair is None:
                 continue
             key, val = kvpair
+            if spill is not None:
+                val = spill(val)
             try:
                 results[key].append(val)
             except KeyError:
                 results[key] = [val]
-        self.send_command(COMMAND.mapdone, (data[0], results))
+
+    def call_map_batch(self, command, data):
+        """Calls the map function on a batch of (key, value) pairs.
+
+        A BatchMapper maps the whole batch at once, and its outputs are numpy
+        arrays instead of lists.
+        """
+        logging.debug("Mapping %d inputs" % len(data))
+        if self.mapper is None:
+            # create the mapper instance
+            self.mapper = mapreducer.MAPPER(FLAGS.mapper)()
+            self.combiner = mapreducer.COMBINER(FLAGS.combiner)
+        if isinstance(self.mapper, mapreducer.BatchMapper):
+            keys = [item[0] for item in data]
+            results = self.mapper.map_batch_grouped(
+                    keys, [item[1] for item in data])
+        else:
+            # the tasks are run one by one, so the ones that have not
+            # started can be given to another client. The reply lists the
+            # tasks that have been run.
+            keys = []
+            results = {}
+            for key, value in data:
+                if self.check_stolen(key):
+                    continue
+                keys.append(key)
+                self.run_map(key, value, results)
+        mapreducer.combine(self.combiner, results)
+        self.send_result(COMMAND.mapbatchdone,
+                         (keys, columnar.encode(results)),
+                         count_values(results))
 
     def call_reduce(self, command, data):
         """Calls the reduce function.
@@ -317,23 +863,258 @@ class Client(Protocol):
         if self.reducer is None:
             # create the reducer instance
             self.reducer = mapreducer.REDUCER(FLAGS.reducer)()
-        results = self.reducer.reduce(data[0], data[1])
-        self.send_command(COMMAND.reducedone, (data[0], results))
-        
+        key = data[0]
+        if isinstance(key, SplitTask):
+            key = key.key
+        results = self.reducer.reduce(key, data[1])
+        self.send_result(COMMAND.reducedone, (data[0], results),
+                         int(results is not None))
+
+    def call_reduce_batch(self, command, data):
+        """Calls the reduce function on a batch of (key, values) pairs.
+
+        A BatchReducer reduces the whole batch at once.
+        """
+        logging.debug("Reducing %d keys" % len(data))
+        if self.reducer is None:
+            # create the reducer instance
+            self.reducer = mapreducer.REDUCER(FLAGS.reducer)()
+        if isinstance(self.reducer, mapreducer.BatchReducer):
+            tasks = [item[0] for item in data]
+            keys = [task.key if isinstance(task, SplitTask) else task
+                    for task in tasks]
+            results = self.reducer.reduce_batch_list(
+                    keys, [item[1] for item in data])
+        else:
+            # see call_map_batch
+            tasks = []
+            results = []
+            for task, values in data:
+                if self.check_stolen(task):
+                    continue
+                tasks.append(task)
+                key = task.key if isinstance(task, SplitTask) else task
+                results.append(self.reducer.reduce(key, values))
+        results = dict((task, result)
+                       for task, result in zip(tasks, results)
+                       if result is not None)
+        self.send_result(COMMAND.reducebatchdone, (tasks, results),
+                         len(results))
+
+    def call_reduce_chunk(self, command, data):
+        """Collects a chunk of the values of a streamed reduce task.
+
+        If the reducer is streaming, the chunk is passed on to it right away.
+        """
+        if self.reducer is None:
+            # create the reducer instance
+            self.reducer = mapreducer.REDUCER(FLAGS.reducer)()
+        if getattr(self.reducer, 'streaming', False):
+            if self.stream is None:
+                key = data[0]
+                if isinstance(key, SplitTask):
+                    key = key.key
+                logging.debug("Streaming reduce %s" % str(data[0]))
+                self.stream = ReduceStream(self.reducer, key)
+            self.stream.put(data[1])
+        else:
+            self.stream_values.extend(data[1])
+
+    def call_reduce_end(self, command, data):
+        """Reduces the streamed values once they have all arrived
+        """
+        if self.stream is not None:
+            stream = self.stream
+            self.stream = None
+            result = stream.finish()
+            self.send_result(COMMAND.reducedone, (data[0], result),
+                             int(result is not None))
+            return
+        values = self.stream_values
+        self.stream_values = []
+        self.call_reduce(COMMAND.reduce, (data[0], values))
+
+    def call_reduce_partition(self, command, data):
+        """Reduces a key range, in total order mode.
+
+        Input:
+            command: a dummy variable that equals to COMMAND.reducepartition
+            data: a tuple containing the partition index, and a tuple of the
+                list of (key, values) pairs in the key range and the number
+                of partitions.
+        The reply is the list of (key, result) pairs, sorted by key. If the
+        writer is sharded, the pairs are written as the shard of the
+        partition, and the reply is the name of the shard instead.
+        """
+        logging.debug("Reducing partition %d" % data[0])
+        if self.reducer is None:
+            # create the reducer instance
+            self.reducer = mapreducer.REDUCER(FLAGS.reducer)()
+        pairs, num_partitions = data[1]
+        results = []
+        for key, values in sorted(pairs, key=lambda item: item[0]):
+            result = self.reducer.reduce(key, values)
+            if result is not None:
+                results.append((key, result))
+        num_results = len(results)
+        writer = mapreducer.WRITER(FLAGS.writer)
+        if writer.sharded:
+            results = writer().write_shard(data[0], num_partitions, results)
+        self.send_result(COMMAND.reducedone, (data[0], results), num_results)
+
+    def send_result(self, command, data, outputs):
+        """Sends the result of a task, with the resources it used (see
+        mincepie.usage) and the counters it incremented (see
+        mincepie.sideoutput) appended to the reply.
+        """
+        sideoutput.flush()
+        largevalue.flush()
+        task_usage = self.meter.end(outputs)
+        counters = sideoutput.take_counters()
+        keys = data[0] if isinstance(data[0], list) else [data[0]]
+        if self.check_cancelled(keys):
+            logging.debug("Task %s cancelled." % usage.task_name(data[0]))
+            self.send_command(COMMAND.cancelled)
+        else:
+            self.send_command(command, data + (task_usage, counters))
+
+    def read_pending(self):
+        """Reads the commands that arrived while the task is running.
+        """
+        if self.socket is not None and \
+                select.select([self.socket], [], [], 0)[0]:
+            self.handle_read()
+
+    def check_cancelled(self, keys):
+        """Reads the commands that arrived while the task was running, and
+        tells if the server has cancelled the task with the given keys, in
+        which case its result is not sent.
+        """
+        self.read_pending()
+        return any(key in self.cancelled for key in keys)
+
+    def check_stolen(self, key):
+        """Tells if the server gave the task with the given key, which is
+        part of the running batch and has not started yet, to another
+        client. The commands from the server are read every
+        STEAL_POLL_INTERVAL seconds.
+        """
+        now = time.time()
+        if now >= self.next_poll:
+            self.next_poll = now + STEAL_POLL_INTERVAL
+            self.read_pending()
+        return key in self.stolen
+
+    def announce_blobs(self, command, data):
+        """Asks the server for the broadcast blobs that are not cached yet.
+        """
+        missing = self.blobs.announce(data or [])
+        if missing:
+            logging.debug("Receiving blobs %s." % ", ".join(missing))
+            self.send_command(COMMAND.broadcastget, missing)
+
+    def end_blob(self, command, data):
+        self.blobs.end(data[0])
+        if not self.blobs.pending:
+            deferred = self.deferred
+            self.deferred = []
+            for command, data in deferred:
+                self.process_command(command, data)
+
+    def receive_blobs(self, command, data):
+        """Handles the broadcast commands, and defers the tasks received
+        while blobs are still arriving. Returns True if the command has been
+        handled.
+        """
+        handlers = {
+            COMMAND.broadcast: self.announce_blobs,
+            COMMAND.blobchunk: lambda x, y: self.blobs.chunk(y[0], y[1]),
+            COMMAND.blobend: self.end_blob,
+            }
+        if command in handlers:
+            handlers[command](command, data)
+            return True
+        if command != COMMAND.protocol:
+            # the server only announces its blobs, before the first task, if
+            # it has any
+            self.blobs.announced = True
+        if self.blobs.pending and command != COMMAND.disconnect:
+            self.deferred.append((command, data))
+            return True
+        return False
+
     def process_command(self, command, data=None):
+        if self.receive_blobs(command, data):
+            return
+        if command == COMMAND.cancel:
+            # the result of the task has been sent already if the task is
+            # not running anymore; the server drops it then.
+            self.cancelled.update(data)
+            return
+        if command == COMMAND.steal:
+            self.stolen.update(data)
+            return
         handlers = {
             COMMAND.map: self.call_map,
             COMMAND.reduce: self.call_reduce,
+            COMMAND.mapbatch: self.call_map_batch,
+            COMMAND.reducebatch: self.call_reduce_batch,
+            COMMAND.reducepartition: self.call_reduce_partition,
+            COMMAND.reducechunk: self.call_reduce_chunk,
+            COMMAND.reduceend: self.call_reduce_end,
             }
         if command in handlers:
+            # a cancel always arrives before the next task
+            self.cancelled.clear()
+            self.stolen.clear()
+            self.meter.begin()
             handlers[command](command, data)
         else:
             # If key not recognized, fall back to the super class
             Protocol.process_command(self, command, data)
 
+    def negotiate(self, challenge):
+        """Asks for binary frames if the server supports them.
+        """
+        if FLAGS.binary_protocol and self.supports(COMMAND.protocol):
+            self.send_command(COMMAND.protocol, arg=str(PROTOCOL_VERSION))
+            self.frame_output = True
+
     def post_auth_init(self):
         if not self.auth:
             self.send_challenge()
+            if self.supports(COMMAND.register):
+                self.send_command(COMMAND.register, self.register_info())
+
+    def register_info(self):
+        """Returns the information sent to the server after connecting.
+
+        Clients with batch mappers or reducers ask for batches of tasks.
+        """
+        info = client_info()
+        if FLAGS.client_credit_bytes > 0:
+            info['credit_bytes'] = FLAGS.client_credit_bytes
+        if issubclass(mapreducer.MAPPER(FLAGS.mapper),
+                      mapreducer.BatchMapper) or \
+                issubclass(mapreducer.REDUCER(FLAGS.reducer),
+                           mapreducer.BatchReducer):
+            info['batch_size'] = FLAGS.batch_size
+        # the tasks of a batch can only be stolen if the commands from the
+        # server can be read while the batch runs
+        info['steal'] = self.socket is not None
+        return info
+
+
+def client_info():
+    """Returns a dictionary describing the current client process.
+
+    The server uses this to tell its clients apart, e.g. to scancel the slurm
+    job of a specific client when releasing it.
+    """
+    return {'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'slurm_job_id': os.environ.get('SLURM_JOB_ID'),
+           }
 
 
 class Server(asyncore.dispatcher, object):
@@ -341,6 +1122,20 @@ class Server(asyncore.dispatcher, object):
         asyncore.dispatcher.__init__(self)
         self._datasource = None
         self.taskmanager = None
+        # the connected ServerChannels
+        self.channels = set()
+        # an optional elastic client pool (see launcher.SlurmElasticPool).
+        # It should implement update(server) and release(channel).
+        self.elastic = None
+        self.usage = usage.UsageReport()
+        self.progress = progress.Progress()
+        # the bytes buffered for sending to all the clients and received from
+        # them, and the clients waiting for the send buffers to drain.
+        self.send_buffer = 0
+        self.receive_buffer = 0
+        self.blocked = set()
+        # task key -> the channels running a task with this key
+        self.runners = {}
 
     def set_datasource(self, datasource):
         self._datasource = datasource
@@ -353,28 +1148,162 @@ class Server(asyncore.dispatcher, object):
 
     def run_server(self):
         logging.info("Starting server.")
-        self.datasource = mapreducer.READER(FLAGS.reader)().read(FLAGS.input)
+        reader = start_reader()
+        if reader is None:
+            self.datasource = read_input()
+            logging.info("Number of input key value pairs: %d " % \
+                         (len(self.datasource.keys())))
+        else:
+            # the map tasks are added as the records are read
+            self.datasource = {}
+            self.taskmanager.reader = reader
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        logging.info("Number of input key value pairs: %d " % \
-                     (len(self.datasource.keys())))
         self.bind(("", FLAGS.port))
         self.listen(1)
         logging.info("Starting listening on %d" % (FLAGS.port))
+        self.serve_status()
         try:
-            asyncore.loop()
+            self.loop()
         except:
             asyncore.close_all()
             raise
         logging.info("Mapreduce done.")
-        mapreducer.WRITER(FLAGS.writer)().write(self.taskmanager.results)
+        self.usage.report()
+        sideoutput.report(self.taskmanager.counters)
+        self.taskmanager.write_quarantine()
+        self.taskmanager.write_results()
+        self.taskmanager.close_storage()
+
+    def serve_status(self):
+        """Starts the status endpoint if FLAGS.status_port is set (see
+        mincepie.progress).
+        """
+        if FLAGS.status_port > 0:
+            progress.StatusServer(self.status)
+
+    def status(self):
+        """Returns the progress of the job as a dictionary.
+        """
+        if self.taskmanager is None:
+            return {'phase': None}
+        status = self.taskmanager.status()
+        status['num_clients'] = len(self.channels)
+        return status
+
+    def loop(self):
+        """Runs the asyncore loop, calling tick() between polls.
+        """
+        while asyncore.socket_map:
+            timeout = FLAGS.tick_interval
+            if self.taskmanager.reading():
+                # the idle clients get the records as soon as they are read
+                timeout = min(timeout, READER_POLL_INTERVAL)
+            asyncore.loop(timeout=timeout, count=1)
+            self.tick()
+
+    def tick(self):
+        """Periodic housekeeping of the server.
+        """
+        if self.elastic is not None:
+            self.elastic.update(self)
+        if FLAGS.task_timeout > 0:
+            self.check_timeouts()
+        self.taskmanager.poll_reader()
+        self.unblock()
+
+    def send_buffer_full(self):
+        return FLAGS.send_buffer_bytes > 0 and \
+                self.send_buffer >= FLAGS.send_buffer_bytes
+
+    def receive_buffer_full(self):
+        return FLAGS.receive_buffer_bytes > 0 and \
+                self.receive_buffer >= FLAGS.receive_buffer_bytes
+
+    def unblock(self):
+        """Gives tasks to the clients that wait for the send buffers to drain,
+        as long as the buffers are not full.
+        """
+        while self.blocked and not self.send_buffer_full():
+            channel = self.blocked.pop()
+            if channel in self.channels:
+                channel.start_new_task()
+
+    def check_timeouts(self):
+        """Disconnects the clients that have been running their task for more
+        than FLAGS.task_timeout seconds. Their tasks count as failed, unless
+        they have been cancelled.
+        """
+        now = time.time()
+        for channel in list(self.channels):
+            start_time = channel.task_start()
+            if start_time is not None and \
+                    now - start_time > FLAGS.task_timeout:
+                if channel.running is not None:
+                    task = usage.task_name(channel.running[0])
+                else:
+                    task = "a cancelled task"
+                logging.warning("Client %s timed out on %s." % \
+                                (channel.name(), task))
+                channel.handle_close()
+
+    def steal_tasks(self, thief):
+        """Gives an idle client part of the batch of the client expected to
+        finish last, once no task is queued. The tasks taken are the ones at
+        the end of the batch, which have not started yet, and are split so
+        that both clients should finish at the same time. Returns the task
+        command for the idle client, or None.
+        """
+        if self.taskmanager.num_queued() > 0:
+            return None
+        now = time.time()
+        victim = None
+        victim_left = 0
+        for channel in self.channels:
+            if channel is thief or channel.running is None or \
+                    channel.cancelling or channel.task_seconds is None or \
+                    not channel.info.get('steal') or \
+                    len(channel.running[0]) < 2:
+                continue
+            left = channel.task_seconds * len(channel.running[0]) - \
+                    (now - channel.running[1])
+            if left > victim_left:
+                victim = channel
+                victim_left = left
+        if victim is None:
+            return None
+        keys, start_time = victim.running
+        victim_seconds = max(victim.task_seconds, 1e-6)
+        # the tasks that are done, and the one that is running
+        started = int((now - start_time) / victim_seconds) + 1
+        thief_seconds = thief.task_seconds or victim_seconds
+        count = int((len(keys) - started) * victim_seconds /
+                    (victim_seconds + thief_seconds))
+        if count < 1:
+            return None
+        stolen = keys[-count:]
+        task = self.taskmanager.steal(stolen)
+        if task is not None:
+            victim.release_tasks(stolen)
+        return task
+
+    def cancel_copies(self, keys):
+        """Cancels the tasks that are still running on other clients and
+        contain any of the given keys, which have just been finished.
+        """
+        channels = set()
+        for key in keys:
+            channels.update(self.runners.get(key, ()))
+        for channel in channels:
+            channel.cancel_task()
 
     def handle_accept(self):
         pair = self.accept()
         if pair is None:
-            pass
+            return
         conn, addr = pair
         logging.debug("New client arrived at " + str(addr))
         sc = ServerChannel(conn, addr, self)
+        self.channels.add(sc)
 
     def handle_close(self):
         self.close()
@@ -385,51 +1314,464 @@ class ServerChannel(Protocol):
         Protocol.__init__(self, conn)
         self.server = server
         self.addr = str(addr)
+        self.info = {}
+        # the keys of the task being run by the client, and its start time
+        self.running = None
+        # whether the task of the client has been cancelled, and its reply
+        # (a result or cancelled) is still to come, and when that task started
+        self.cancelling = False
+        self.cancel_start = None
+        # the task token of the last frame received
+        self.reply_token = 0
+        # the smoothed number of seconds the client takes per task
+        self.task_seconds = None
+        # the bytes buffered for sending, and of the message being received
+        self.send_buffer = 0
+        self.receive_buffer = 0
         self.start_auth()
 
+    def push(self, data):
+        self.count_buffered(len(data))
+        Protocol.push(self, data)
+
+    def count_buffered(self, nbytes):
+        self.send_buffer += nbytes
+        self.server.send_buffer += nbytes
+
+    def send(self, data):
+        num_sent = Protocol.send(self, data)
+        if num_sent:
+            self.send_buffer -= num_sent
+            self.server.send_buffer -= num_sent
+            if self.server.blocked:
+                self.server.unblock()
+        return num_sent
+
+    def readable(self):
+        # when the receive buffers are full, only finish reading the messages
+        # that have started arriving.
+        if not self.in_message() and self.server.receive_buffer_full():
+            return False
+        return Protocol.readable(self)
+
+    def collect_incoming_data(self, data):
+        if self.skipping:
+            return
+        Protocol.collect_incoming_data(self, data)
+        self.receive_buffer += len(data)
+        self.server.receive_buffer += len(data)
+
+    def found_terminator(self):
+        self.server.receive_buffer -= self.receive_buffer
+        self.receive_buffer = 0
+        Protocol.found_terminator(self)
+
     def handle_close(self):
         logging.debug("Client %s disconnected" % (self.addr))
+        self.server.channels.discard(self)
         self.close()
+        # whatever is left in the buffers is dropped
+        self.server.send_buffer -= self.send_buffer
+        self.server.receive_buffer -= self.receive_buffer
+        self.send_buffer = self.receive_buffer = 0
+        # the client died or got stuck while running its task
+        for key in self.stop_running():
+            self.server.taskmanager.task_failed(key)
 
     def start_auth(self):
         self.send_challenge()
 
+    def register(self, command, data):
+        """Records the client information sent by the client.
+        """
+        self.info = data
+        logging.debug("Client %s registered: %s" % (self.addr, repr(data)))
+
     def start_new_task(self):
-        command, data = self.server.taskmanager.next_task(self)
+        if self.server.elastic is not None and \
+                self.server.elastic.release(self):
+            logging.debug("Releasing idle client %s" % (self.addr))
+            self.send_command(COMMAND.disconnect)
+            return
+        if self.server.send_buffer_full():
+            # wait for the buffers to drain (see Server.unblock)
+            logging.debug("Send buffers full, client %s waits." % self.addr)
+            self.server.blocked.add(self)
+            return
+        # sub-servers register with a batch size, and get a batch of tasks
+        # each time.
+        batch_size = self.batch_size()
+        task = None
+        if FLAGS.target_task_seconds > 0 and batch_size > 0:
+            task = self.server.steal_tasks(self)
+        if task is not None:
+            command, data = task
+        elif batch_size > 0:
+            command, data = self.server.taskmanager.next_batch(
+                    self, batch_size, self.info.get('credit_bytes', 0))
+        else:
+            command, data = self.server.taskmanager.next_task(self)
         if command == None:
             return
-        self.send_command(command, data)
+        if not self.can_run(command):
+            self.reject_task(command, data)
+            return
+        if command != COMMAND.disconnect:
+            self.start_running(task_keys(command, data))
+            # a new task token, which the reply to the task carries
+            self.task_token += 1
+        self.send_task(command, data)
 
-    def map_done(self, command, data):
-        self.server.taskmanager.map_done(data)
+    def batch_size(self):
+        """Returns the number of tasks sent to the client at a time, or 0 to
+        send single tasks. With FLAGS.target_task_seconds, the batches are
+        sized from the time per task of the client, which gets single tasks
+        until it has been measured.
+        """
+        if not self.supports(COMMAND.mapbatch):
+            return 0
+        batch_size = self.info.get('batch_size', 0)
+        if FLAGS.target_task_seconds <= 0:
+            return batch_size
+        batch_size = batch_size or FLAGS.batch_size
+        if self.task_seconds is None:
+            return 1
+        return max(1, min(batch_size, int(FLAGS.target_task_seconds /
+                                          max(self.task_seconds, 1e-6))))
+
+    def can_run(self, command):
+        """Tells if the client understands the given task command. Older
+        clients get streamed reduce tasks at once (see send_task).
+        """
+        if command == COMMAND.reducestream:
+            command = COMMAND.reduce
+        return self.supports(command)
+
+    def reject_task(self, command, data):
+        """Gives back a task the client is too old to run, and lets the
+        client go.
+        """
+        logging.error("Client %s is too old to run %s tasks." % \
+                      (self.name(), command))
+        for key in task_keys(command, data):
+            self.server.taskmanager.task_cancelled(key)
+        self.send_command(COMMAND.disconnect)
+
+    def measure_task(self):
+        """Updates the time per task of the client with the task it has
+        just finished.
+        """
+        keys, start_time = self.running
+        if not keys:
+            return
+        seconds = (time.time() - start_time) / len(keys)
+        if self.task_seconds is None:
+            self.task_seconds = seconds
+        else:
+            self.task_seconds += TASK_SECONDS_SMOOTHING * \
+                    (seconds - self.task_seconds)
+
+    def release_tasks(self, keys):
+        """Takes the given tasks, which have not started yet, off the batch
+        run by the client, as another client runs them instead.
+        """
+        stolen = set(keys)
+        self.running = ([key for key in self.running[0] if key not in stolen],
+                        self.running[1])
+        for key in keys:
+            runners = self.server.runners.get(key)
+            if runners is not None:
+                runners.discard(self)
+                if not runners:
+                    del self.server.runners[key]
+        logging.debug("Taking %d tasks from %s." % (len(keys), self.name()))
+        self.send_command(COMMAND.steal, keys)
+
+    def start_running(self, keys):
+        self.running = (keys, time.time())
+        for key in keys:
+            self.server.runners.setdefault(key, set()).add(self)
+
+    def task_start(self):
+        """Returns the start time of the task run by the client, which may
+        have been cancelled, or None if the client is not running any task.
+        """
+        if self.running is not None:
+            return self.running[1]
+        elif self.cancelling:
+            return self.cancel_start
+        return None
+
+    def stop_running(self):
+        """Forgets the task run by the client, and returns its keys.
+        """
+        if self.running is None:
+            return []
+        keys = self.running[0]
+        self.running = None
+        for key in keys:
+            runners = self.server.runners.get(key)
+            if runners is not None:
+                runners.discard(self)
+                if not runners:
+                    del self.server.runners[key]
+        return keys
+
+    def cancel_task(self):
+        """Tells the client to drop its task, which another client has
+        finished. The client replies with cancelled, or with the result if it
+        has sent it already, which is then dropped before being unpickled.
+        """
+        if self.running is not None:
+            # the client still times out if it is stuck in the task
+            self.cancel_start = self.running[1]
+        keys = self.stop_running()
+        logging.debug("Cancelling %s on %s." % \
+                      (usage.task_name(keys), self.name()))
+        self.cancelling = True
+        if self.supports(COMMAND.cancel):
+            # older clients run the task to the end
+            self.send_command(COMMAND.cancel, keys)
+        for key in keys:
+            self.server.taskmanager.task_cancelled(key)
+
+    def frame_received(self, task_token):
+        self.reply_token = task_token
+
+    def skip_data(self, command):
+        if command not in RESULT_COMMANDS:
+            return False
+        if self.frame_input and self.reply_token != self.task_token:
+            logging.debug("Dropping a late %s from %s." % \
+                          (command, self.name()))
+            return True
+        return self.cancelling
+
+    def data_skipped(self, command):
+        self.cancel_done(command)
+
+    def cancel_done(self, command, data=None):
+        """Called once the reply to a cancelled task has arrived. A sub-server
+        also replies with cancelled, unasked, when it gives up on a streamed
+        task (see subserver.BatchTaskManager.give_up_stream).
+        """
+        if not self.cancelling:
+            for key in self.stop_running():
+                self.server.taskmanager.task_failed(key)
+        self.cancelling = False
         self.start_new_task()
 
-    def reduce_done(self, command, data):
-        self.server.taskmanager.reduce_done(data)
+    def send_task(self, command, data):
+        if self.peer_version < PROTOCOL_VERSION and \
+                command in (COMMAND.reduce, COMMAND.reducestream):
+            # older clients reduce the part of a hot key under the key
+            # itself (see reduce_done), and get all the values at once.
+            if isinstance(data[0], SplitTask):
+                data = (data[0].key,) + tuple(data[1:])
+            if command == COMMAND.reducestream:
+                data = (data[0], columnar.concatenate(data[1]))
+            command = COMMAND.reduce
+        if command == COMMAND.reducestream:
+            self.send_chunks(*data)
+        else:
+            self.send_command(command, data)
+
+    def name(self):
+        """Returns a readable name of the client.
+        """
+        if 'host' in self.info:
+            return "%s:%s" % (self.info['host'], self.info.get('pid'))
+        return self.addr
+
+    def record_usage(self, data):
+        # replies carry the usage of the task as their third element
+        if len(data) > 2:
+            self.server.usage.add(self.name(), data[0], data[2])
+
+    def task_done(self, done, data):
+        """Passes the result of the task to the given task manager method,
+        cancels the other copies of the task, and starts the next task.
+        """
+        if self.running is not None:
+            self.measure_task()
+        keys = self.stop_running()
+        self.record_usage(data)
+        self.server.progress.client_done(self.name(), len(keys))
+        done(data)
+        self.server.cancel_copies(keys)
         self.start_new_task()
 
+    def map_done(self, command, data):
+        self.task_done(self.server.taskmanager.map_done, data)
+
+    def reduce_done(self, command, data):
+        if self.peer_version < PROTOCOL_VERSION and self.running is not None:
+            # the reply of an older client carries the key it reduced, which
+            # is not the task key for the parts of a hot key
+            data = (self.running[0][0],) + tuple(data[1:])
+        self.task_done(self.server.taskmanager.reduce_done, data)
+
+    def map_batch_done(self, command, data):
+        self.task_done(self.server.taskmanager.map_batch_done, data)
+
+    def reduce_batch_done(self, command, data):
+        self.task_done(self.server.taskmanager.reduce_batch_done, data)
+
     def process_command(self, command, data=None):
+        if self.cancelling and command in RESULT_COMMANDS:
+            # the late result of a cancelled task (see skip_data), which
+            # could not be skipped, e.g. under the native MPI transport.
+            self.cancel_done(command)
+            return
         handlers = {
             COMMAND.mapdone: self.map_done,
             COMMAND.reducedone: self.reduce_done,
+            COMMAND.register: self.register,
+            COMMAND.mapbatchdone: self.map_batch_done,
+            COMMAND.reducebatchdone: self.reduce_batch_done,
+            COMMAND.broadcastget: self.send_blobs,
+            COMMAND.cancelled: self.cancel_done,
             }
         if command in handlers:
             handlers[command](command, data)
         else:
             super(ServerChannel, self).process_command(command, data)
 
+    def send_blobs(self, command, data):
+        self.push_with_producer(ChunkProducer(self, blob_commands(data)))
+
     def post_auth_init(self):
+        blobs = broadcast.manifest()
+        if blobs:
+            if not self.supports(COMMAND.broadcast):
+                logging.error("Client %s is too old to receive the broadcast "
+                              "blobs." % self.name())
+                self.send_command(COMMAND.disconnect)
+                return
+            # the client defers its tasks until it has all the blobs
+            self.send_command(COMMAND.broadcast, blobs)
         self.start_new_task()
     
 
+def read_input():
+    """Returns the input of the job, read by the reader one source at a time
+    (see BasicReader.sources in mincepie.mapreducer). There is no input
+    with --reduce_only (see mincepie.intermediate).
+    """
+    if FLAGS.reduce_only:
+        if not FLAGS.intermediate_dir:
+            logging.fatal("--reduce_only needs --intermediate_dir.")
+            sys.exit(1)
+        return {}
+    reader = mapreducer.READER(FLAGS.reader)()
+    data = {}
+    for source in reader.sources(FLAGS.input):
+        data.update(reader.read_source(source))
+    return data
+
+
+def start_reader():
+    """Starts reading the input in background threads, and returns the
+    prefetch.Prefetcher, or None if read_input() should read it at once:
+    with --reader_threads=0 or --reduce_only.
+    """
+    if FLAGS.reader_threads <= 0 or FLAGS.reduce_only:
+        return None
+    reader = prefetch.Prefetcher(mapreducer.READER(FLAGS.reader)(),
+                                 FLAGS.input)
+    reader.start()
+    return reader
+
+
+def task_keys(command, data):
+    """Returns the list of the task keys in the data of a task command
+    """
+    if command in (COMMAND.mapbatch, COMMAND.reducebatch):
+        return [item[0] for item in data]
+    return [data[0]]
+
+
+def count_values(results):
+    """Returns the number of values in a dictionary of map outputs
+    """
+    return sum(len(values) for values in results.values())
+
+
+def estimate_bytes(values, count=None):
+    """Estimates the pickled size of a list of values from a sample. If
+    count is given, values are the first values of a list of count values.
+    """
+    if count is None:
+        count = len(values)
+    sample = values[:HOT_KEY_SAMPLE]
+    if not count or not len(sample):
+        return 0
+    size = len(pickle.dumps(sample, pickle.HIGHEST_PROTOCOL))
+    return size * count // len(sample)
+
+
+def estimate_task_bytes(value):
+    """Estimates the pickled size of the value of a task: a list of values
+    for reduce tasks, or a map input.
+    """
+    if isinstance(value, (list, tuple)) or hasattr(value, 'tolist'):
+        return estimate_bytes(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def range_partitions(map_results, num_partitions, sample_size):
+    """Splits the intermediate keys into key ranges.
+
+    The split points are picked from a sorted sample of the keys, so the
+    ranges hold roughly the same number of keys. All the keys should be
+    comparable with each other.
+    Input:
+        map_results: a dictionary mapping each key to a list of values. Only
+            its keys are read.
+        num_partitions: the number of key ranges.
+        sample_size: the number of keys to sample.
+    Output:
+        a list of key ranges in increasing order, each being a list of keys.
+        Empty ranges are removed.
+    """
+    keys = list(map_results)
+    sample = sorted(random.sample(keys, min(sample_size, len(keys))))
+    splits = []
+    for i in range(1, num_partitions if sample else 1):
+        split = sample[len(sample) * i // num_partitions]
+        if not splits or splits[-1] < split:
+            splits.append(split)
+    partitions = [[] for i in range(len(splits) + 1)]
+    for key in keys:
+        partitions[bisect.bisect_right(splits, key)].append(key)
+    return [partition for partition in partitions if partition]
+
+
 class TaskManager(object):
     def __init__(self, datasource, server):
         self.datasource = datasource
         self.num_maps = len(self.datasource.keys())
         self.num_done_maps = 0
+        self.num_sent_maps = 0
+        # the prefetch.Prefetcher adding records to the datasource while the
+        # maps run, or None if the datasource is complete
+        self.reader = None
         self.server = server
         self.state = TASK.START
         self.next_report_point = FLAGS.report_interval
+        # the number of failed attempts of each task, and the quarantined
+        # tasks of each phase
+        self.attempts = {}
+        # the number of clients running each task
+        self.copies = {}
+        # the clients waiting for a task to run
+        self.idle = set()
+        self.quarantine = {COMMAND.map: {}, COMMAND.reduce: {}}
+        # the names of the shards written by the clients, in total order
+        # mode with a sharded writer
+        self.shards = None
+        # the totals of the counters of the tasks (see mincepie.sideoutput)
+        self.counters = {}
 
     def next_task(self, channel):
         """Returns the next task to carry out
@@ -437,51 +1779,451 @@ class TaskManager(object):
         if self.state == TASK.START:
             logging.info("Start mapreduce.")
             self.map_iter = iter(self.datasource)
+            self.retry_maps = collections.deque()
             self.working_maps = {}
-            self.map_results = {}
+            self.map_results = storage.new_store()
+            self.hot_keys = set()
+            self.next_hot_check = {}
+            self.first_hot_check = HOT_KEY_FIRST_CHECK
+            if FLAGS.hot_key_values > 0:
+                self.first_hot_check = min(self.first_hot_check,
+                                           FLAGS.hot_key_values)
+            if FLAGS.reduce_only:
+                # there is no input: the map phase ends right away
+                self.map_results.close()
+                self.map_results = intermediate.load()
+                self.hot_keys = self.map_results.hot_keys(
+                        FLAGS.hot_key_values, FLAGS.hot_key_bytes)
             logging.info("Start map phase.")
-            self.map_start_time = time.time()
+            self.server.progress.start_phase('map')
             self.state = TASK.MAPPING
         
         if self.state == TASK.MAPPING:
             try:
-                # get next map task
-                map_key = self.map_iter.next()
-                self.working_maps[map_key] = time.time()
+                # get next map task, starting with the failed ones
+                if self.retry_maps:
+                    map_key = self.retry_maps.popleft()
+                elif self.reader is not None:
+                    map_key = self.next_read_key()
+                else:
+                    map_key = self.map_iter.next()
+                self.num_sent_maps += 1
+                self.dispatch(self.working_maps, map_key)
                 return (COMMAND.map, (map_key, self.datasource[map_key]))
             except StopIteration:
                 # if we finished sending out all map tasks, select one task
                 # from the existing pools (in case some of the jobs died for
                 # some reason). If all maps are done, we go on to reduce
-                if self.working_maps:
-                    key = min(self.working_maps, key=self.working_maps.get)
-                    self.working_maps[key] = time.time()
+                if self.reading():
+                    # more records are coming (see poll_reader)
+                    self.idle.add(channel)
+                    return (None, None)
+                elif self.working_maps:
+                    key = self.rerun_key(self.working_maps)
+                    if key is None:
+                        self.idle.add(channel)
+                        return (None, None)
+                    self.dispatch(self.working_maps, key)
                     return (COMMAND.map, (key, self.datasource[key]))
                 else:
                     logging.info("Map done. Start Reduce phase.")
+                    if FLAGS.intermediate_dir and not FLAGS.reduce_only:
+                        intermediate.save(self.map_results)
                     self.state = TASK.REDUCING
-                    self.reduce_iter = self.map_results.iteritems()
-                    self.working_reduces = {}
-                    self.results = {}
+                    self.server.progress.start_phase('reduce')
+                    self.next_report_point = FLAGS.report_interval
+                    self.start_reduce()
 
         if self.state == TASK.REDUCING:
-            try:
-                reduce_item = self.reduce_iter.next()
-                self.working_reduces[reduce_item[0]] = time.time()
-                return (COMMAND.reduce, reduce_item)
-            except StopIteration:
-                if self.working_reduces:
-                    key = min(self.working_reduces,
-                            key=self.working_reduces.get)
-                    self.working_reduces[key] = time.time()
-                    return (COMMAND.reduce, (key, self.map_results[key]))
-                else:
-                    logging.info("Reduce phase done.")
-                    self.state = TASK.FINISHED
+            if self.reduce_queue:
+                key = self.reduce_queue.popleft()
+                self.dispatch(self.working_reduces, key)
+                return self.reduce_task(key)
+            elif self.working_reduces:
+                key = self.rerun_key(self.working_reduces)
+                if key is None:
+                    self.idle.add(channel)
+                    return (None, None)
+                self.dispatch(self.working_reduces, key)
+                return self.reduce_task(key)
+            else:
+                logging.info("Reduce phase done.")
+                self.state = TASK.FINISHED
+                self.finish_reduce()
         if self.state == TASK.FINISHED:
             self.server.handle_close()
             return (COMMAND.disconnect, None)
+
+    def start_reduce(self):
+        """Sets up the reduce tasks.
+
+        Normally each intermediate key is a reduce task. In total order mode,
+        each task is instead a key range: the task key is the index of the
+        range and the task value is the list of (key, values) pairs in it,
+        with the number of ranges. Hot keys are either split into parts or
+        streamed (see split_reduce). The values are only read from the store
+        when a task is sent (see reduce_task).
+        """
+        self.working_reduces = {}
+        self.results = storage.new_store()
+        # the merges of the parts of the split hot keys, keyed by task key
+        self.extra_reduces = {}
+        self.split_results = {}
+        # the (start, end) of the values of each part of a split hot key, and
+        # the hot keys that are streamed
+        self.split_parts = {}
+        self.stream_keys = set()
+        if FLAGS.total_order:
+            num_partitions = FLAGS.num_partitions
+            if num_partitions <= 0:
+                num_partitions = 4 * max(len(self.server.channels), 1)
+            self.partitions = range_partitions(
+                    self.map_results, num_partitions,
+                    FLAGS.partition_sample_size)
+            logging.info("Reducing %d key ranges." % len(self.partitions))
+            self.reduce_queue = collections.deque(
+                    range(len(self.partitions)))
+            self.stream_reduces = False
+        else:
+            reducer = mapreducer.REDUCER(FLAGS.reducer)
+            self.reduce_queue = collections.deque(
+                    key for key in self.map_results
+                    if key not in self.hot_keys)
+            # streaming reducers get long value lists in chunks
+            self.stream_reduces = getattr(reducer, 'streaming', False)
+            if self.hot_keys:
+                for key in self.hot_keys:
+                    self.split_reduce(key,
+                                      getattr(reducer, 'associative', False))
+
+    def split_reduce(self, key, associative):
+        """Sets up the tasks of a hot key.
+
+        If the reducer is associative, the values are split into parts that
+        are reduced separately, and split_done() queues the final reduce of
+        the partial results. Otherwise, the values are streamed in chunks.
+        Hot key tasks are queued first since they take the longest.
+        """
+        if not associative:
+            logging.info("Streaming hot key %r." % (key,))
+            self.stream_keys.add(key)
+            self.reduce_queue.appendleft(key)
+            return
+        count = self.map_results.count(key)
+        num_parts = 2
+        if FLAGS.hot_key_values > 0:
+            num_parts = max(num_parts, -(-count // FLAGS.hot_key_values))
+        if FLAGS.hot_key_bytes > 0:
+            sample = self.map_results.slice(key, 0, HOT_KEY_SAMPLE)
+            num_parts = max(num_parts, -(-estimate_bytes(sample, count) //
+                                         FLAGS.hot_key_bytes))
+        num_parts = min(num_parts, count)
+        logging.info("Splitting hot key %r into %d parts." % (key, num_parts))
+        self.split_results[key] = (num_parts, {})
+        for part in range(num_parts):
+            task = SplitTask(key, part)
+            self.split_parts[task] = (count * part // num_parts,
+                                      count * (part + 1) // num_parts)
+            self.reduce_queue.appendleft(task)
+
+    def split_done(self, task, result):
+        """Records a partial result of a hot key, and queues the final reduce
+        once all the parts are done.
+        """
+        num_parts, partials = self.split_results[task.key]
+        partials[task.part] = result
+        del self.split_parts[task]
+        if len(partials) == num_parts:
+            values = [partials[part] for part in range(num_parts)
+                      if partials[part] is not None]
+            self.extra_reduces[task.key] = (COMMAND.reduce,
+                                            (task.key, values))
+            self.reduce_queue.appendleft(task.key)
+
+    def task_command(self, key):
+        """Returns the command of the reduce task with the given key, without
+        reading its values.
+        """
+        if key in self.extra_reduces:
+            return self.extra_reduces[key][0]
+        elif isinstance(key, SplitTask):
+            return COMMAND.reduce
+        elif FLAGS.total_order:
+            return COMMAND.reducepartition
+        elif key in self.stream_keys or (self.stream_reduces and
+                self.map_results.count(key) > FLAGS.reduce_chunk_size):
+            return COMMAND.reducestream
+        return COMMAND.reduce
+
+    def reduce_task(self, key):
+        """Returns the (command, data) of the reduce task with the given key,
+        reading its values from the store.
+        """
+        command = self.task_command(key)
+        if key in self.extra_reduces:
+            return self.extra_reduces[key]
+        elif isinstance(key, SplitTask):
+            start, end = self.split_parts[key]
+            values = self.map_results.slice(key.key, start, end)
+        elif command == COMMAND.reducepartition:
+            values = ([(k, self.map_results[k]) for k in self.partitions[key]],
+                      len(self.partitions))
+        elif command == COMMAND.reducestream:
+            # read from the store as the chunks are sent
+            size = max(FLAGS.reduce_chunk_size, 1)
+            values = self.map_results.chunks(key, size)
+        else:
+            values = self.map_results[key]
+        return (command, (key, values))
+
+    def next_command(self):
+        """Returns the command of the next queued task
+        """
+        if self.state == TASK.REDUCING:
+            return self.task_command(self.reduce_queue[0])
+        return COMMAND.map
+
+    def finish_reduce(self):
+        """In total order mode, concatenates the sorted key ranges, or lists
+        the names of their shards if the clients have written them.
+        """
+        if FLAGS.total_order and mapreducer.WRITER(FLAGS.writer).sharded:
+            self.shards = [self.results[index]
+                           for index in sorted(self.results)]
+        elif FLAGS.total_order:
+            ordered = storage.new_store(ordered=True)
+            for index in sorted(self.results):
+                for key, result in self.results[index]:
+                    ordered[key] = result
+            self.results.close()
+            self.results = ordered
+
+    def write_results(self):
+        """Writes the results with the writer, or passes it the names of the
+        shards written by the clients.
+        """
+        writer = mapreducer.WRITER(FLAGS.writer)()
+        if self.shards is not None:
+            writer.write_shards(self.shards)
+        else:
+            writer.write(self.results)
+
+    def next_batch(self, channel, size, max_bytes=0):
+        """Returns up to size tasks of the same kind to carry out.
+
+        The returned data is a list of (key, value) pairs, sent with the batch
+        version of the task command. Only the first task may be a re-run of a
+        running task, so a batch never mixes map and reduce tasks. If
+        max_bytes is positive, no task is added once the estimated size of
+        the batch reaches it.
+        """
+        command, data = self.next_task(channel)
+        if command not in BATCH_COMMAND:
+            return (command, data)
+        batch = [data]
+        nbytes = estimate_task_bytes(data[1]) if max_bytes > 0 else 0
+        while len(batch) < size and self.num_queued() > 0 and \
+                self.next_command() == command and \
+                (max_bytes <= 0 or nbytes < max_bytes):
+            batch.append(self.next_task(channel)[1])
+            if max_bytes > 0:
+                nbytes += estimate_task_bytes(batch[-1][1])
+        return (BATCH_COMMAND[command], batch)
+
+    def num_queued(self):
+        """Returns the number of tasks in the current phase that have not
+        been sent to any client yet.
+        """
+        num_ready = self.reader.num_ready() if self.reader else 0
+        if self.state == TASK.START:
+            return self.num_maps + num_ready
+        elif self.state == TASK.MAPPING:
+            return self.num_maps - self.num_sent_maps + num_ready
+        elif self.state == TASK.REDUCING:
+            return len(self.reduce_queue)
+        return 0
+
+    def num_remaining(self):
+        """Returns the number of tasks in the current phase that are not
+        finished yet, including the ones that are being carried out.
+        """
+        if self.state == TASK.MAPPING:
+            return self.num_queued() + len(self.working_maps)
+        elif self.state == TASK.REDUCING:
+            return self.num_queued() + len(self.working_reduces)
+        return self.num_queued()
     
+    def later_phase_pending(self):
+        """Tells if the tasks of a later phase are still to come: the reduce
+        tasks, until the map phase is done.
+        """
+        return self.state in (TASK.START, TASK.MAPPING)
+
+    def dispatch(self, working, key):
+        """Records that a task is sent to a client.
+        """
+        working[key] = time.time()
+        self.copies[key] = self.copies.get(key, 0) + 1
+
+    def rerun_key(self, working):
+        """Returns the running task to run again on an idle client: the one
+        that started the longest time ago. With FLAGS.max_attempts, a task
+        does not run on more clients than the attempts it has left, so a bad
+        record cannot take all the clients down at once. Returns None if no
+        task can run again.
+        """
+        if FLAGS.max_attempts > 0:
+            keys = [key for key in working
+                    if self.copies.get(key, 0) <
+                       FLAGS.max_attempts - self.attempts.get(key, 0)]
+        else:
+            keys = working
+        if not keys:
+            return None
+        return min(keys, key=working.get)
+
+    def next_read_key(self):
+        """Adds the next record read by the reader to the datasource, and
+        returns its key. Raises StopIteration if no record is ready.
+        """
+        record = self.reader.get()
+        if record is None:
+            raise StopIteration
+        key, value = record
+        self.datasource[key] = value
+        self.num_maps += 1
+        return key
+
+    def reading(self):
+        """Tells if the reader may still add map tasks.
+        """
+        return self.reader is not None and not self.reader.done()
+
+    def poll_reader(self):
+        """Gives the records read to the idle clients. Raises the error of
+        the reader if it failed.
+        """
+        if self.reader is None:
+            return
+        self.reader.check()
+        if self.idle and self.state == TASK.MAPPING and \
+                (self.reader.num_ready() > 0 or self.reader.done()):
+            self.wake_up()
+
+    def wake_up(self):
+        """Gives a task to the idle clients, if there is one now.
+        """
+        idle = self.idle
+        self.idle = set()
+        for channel in idle:
+            if channel in self.server.channels:
+                channel.start_new_task()
+
+    def steal(self, keys):
+        """Moves running tasks of the current phase from the client running
+        them to another one (see Server.steal_tasks). Returns the batch task
+        command for the other client, or None if the tasks cannot be moved.
+        """
+        command, working = self.current_phase()
+        if working is None or any(key not in working for key in keys):
+            return None
+        if command == COMMAND.reduce:
+            if any(self.task_command(key) != COMMAND.reduce for key in keys):
+                return None
+            batch = [self.reduce_task(key)[1] for key in keys]
+        else:
+            batch = [(key, self.datasource[key]) for key in keys]
+        for key in keys:
+            # the copy of the first client is dropped
+            self.copies[key] = self.copies.get(key, 1) - 1
+            self.dispatch(working, key)
+        return (BATCH_COMMAND[command], batch)
+
+    def current_phase(self):
+        """Returns the task command of the current phase and its running
+        tasks, or (None, None) if no phase is running.
+        """
+        if self.state == TASK.MAPPING:
+            return COMMAND.map, self.working_maps
+        elif self.state == TASK.REDUCING:
+            return COMMAND.reduce, self.working_reduces
+        return None, None
+
+    def requeue(self, phase, working, key):
+        """Queues again a running task that no client runs anymore.
+        """
+        del working[key]
+        if phase == COMMAND.map:
+            self.num_sent_maps -= 1
+            self.retry_maps.append(key)
+        else:
+            self.reduce_queue.appendleft(key)
+
+    def task_failed(self, key):
+        """Records a failed attempt of a running task. Once no client runs the
+        task anymore, it is queued again, or quarantined if it has failed
+        FLAGS.max_attempts times.
+        """
+        phase, working = self.current_phase()
+        if working is None or key not in working:
+            # the task is done already
+            return
+        self.copies[key] -= 1
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if FLAGS.max_attempts > 0 and \
+                self.attempts[key] >= FLAGS.max_attempts:
+            logging.error("Quarantining %r after %d failed attempts." % \
+                          (key, self.attempts[key]))
+            if phase == COMMAND.map:
+                self.quarantine[phase][key] = self.datasource[key]
+                self.num_done_maps += 1
+            else:
+                command, data = self.reduce_task(key)
+                values = data[1]
+                if command == COMMAND.reducestream:
+                    values = columnar.concatenate(values)
+                self.quarantine[phase][key] = values
+            del working[key]
+            del self.copies[key]
+        else:
+            logging.warning("Task %r failed (attempt %d)." % \
+                            (key, self.attempts[key]))
+            if self.copies[key] == 0:
+                self.requeue(phase, working, key)
+        # there may be a task to retry, or the phase may be over
+        self.wake_up()
+
+    def task_cancelled(self, key):
+        """Records that a copy of a running task has been cancelled, which
+        is not a failed attempt. This happens to the other tasks of a batch
+        when one of them is finished by another client: once no client runs
+        such a task anymore, it is queued again.
+        """
+        phase, working = self.current_phase()
+        if working is None or key not in working:
+            return
+        self.copies[key] -= 1
+        if self.copies[key] == 0:
+            self.requeue(phase, working, key)
+            self.wake_up()
+
+    def write_quarantine(self):
+        """Logs the quarantined tasks, and writes them to
+        FLAGS.quarantine_output if it is set.
+        """
+        for phase, records in self.quarantine.items():
+            if records:
+                logging.error("%d %s tasks were quarantined: %s" % \
+                              (len(records), phase,
+                               ", ".join(repr(key) for key in records)))
+        if FLAGS.quarantine_output and any(self.quarantine.values()):
+            with open(FLAGS.quarantine_output, 'wb') as fid:
+                pickle.dump({'map': self.quarantine[COMMAND.map],
+                             'reduce': self.quarantine[COMMAND.reduce]},
+                            fid, pickle.HIGHEST_PROTOCOL)
+            logging.error("Quarantined records saved to %s." % \
+                          FLAGS.quarantine_output)
+
     def map_done(self, data):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_maps:
@@ -489,30 +2231,137 @@ class TaskManager(object):
         self.num_done_maps += 1 
         logging.debug('Map done (%d / %d): %s ' \
                       % (self.num_done_maps, self.num_maps, str(data[0])))
-        # for logging.info, we only output the reports periodically
-        ratio = int(self.num_done_maps * 100 / self.num_maps)
-        if ratio >= self.next_report_point:
-            elapsed = datetime.timedelta(
-                    seconds=time.time() - self.map_start_time)
-            logging.info("%d%% maps done. Elapsed %s." \
-                    % (ratio, str(elapsed)))
-            self.next_report_point += FLAGS.report_interval
-        if data[1] is not None:
-            for (key, values) in data[1].iteritems():
-                if key not in self.map_results:
-                    self.map_results[key] = []
-                self.map_results[key].extend(values)
+        self.merge_map_results(data[1])
+        self.add_counters(data)
         del self.working_maps[data[0]]
+        self.copies.pop(data[0], None)
+        self.server.progress.task_done()
+        self.report_progress("maps")
+        if not self.working_maps:
+            # the idle clients move on to the next phase
+            self.wake_up()
+
+    def merge_map_results(self, results):
+        """Merges a dictionary of map outputs into map_results
+        """
+        if results is not None:
+            for (key, values) in results.iteritems():
+                self.map_results.append(key, values)
+                if self.map_results.count(key) >= \
+                        self.next_hot_check.get(key, self.first_hot_check) \
+                        and key not in self.hot_keys:
+                    self.check_hot_key(key)
+
+    def check_hot_key(self, key):
+        """Checks if a key has too many values or bytes, and if so, marks it
+        as hot. Otherwise the key is checked again when its values double.
+        The size is estimated from the first values only.
+        """
+        count = self.map_results.count(key)
+        if (FLAGS.hot_key_values > 0 and count >= FLAGS.hot_key_values) or \
+                (FLAGS.hot_key_bytes > 0 and estimate_bytes(
+                        self.map_results.slice(key, 0, HOT_KEY_SAMPLE),
+                        count) >= FLAGS.hot_key_bytes):
+            logging.info("Hot key %r: %d values so far." % (key, count))
+            self.hot_keys.add(key)
+        else:
+            self.next_hot_check[key] = 2 * count
+
+    def map_batch_done(self, data):
+        """Finishes a batch of maps, whose outputs have been merged together.
+
+        Since the merged outputs cannot be split per input key, the batch is
+        only used if none of its keys has been finished by another client.
+        """
+        keys, results = data[0], data[1]
+        for key in keys:
+            if not key in self.working_maps:
+                logging.debug('Dropping a batch of %d maps.' % len(keys))
+                return
+        # the outputs are merged before the last map_done() ends the phase
+        self.merge_map_results(results)
+        self.add_counters(data)
+        for key in keys:
+            self.map_done((key, None))
                                 
     def reduce_done(self, data):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_reduces:
             return
         logging.debug('Reduce done: ' + repr(data[0]))
-        if data[1] is not None:
-            self.results[data[0]] = data[1]
+        self.add_counters(data)
         del self.working_reduces[data[0]]
+        self.copies.pop(data[0], None)
+        if isinstance(data[0], SplitTask):
+            self.split_done(data[0], data[1])
+        elif data[1] is not None:
+            self.results[data[0]] = data[1]
+        self.server.progress.task_done()
+        self.report_progress("reduces")
+        if not self.working_reduces:
+            # the result is recorded, and the merge of a split hot key
+            # queued, before the idle clients move on
+            self.wake_up()
 
-if __name__ == "__main__":
-    print(__doc__)
+    def reduce_batch_done(self, data):
+        """Finishes a batch of reduces. data is a list of the reduced keys and
+        a dictionary containing the reduce results.
+        """
+        keys, results = data[0], data[1]
+        if any(key in self.working_reduces for key in keys):
+            self.add_counters(data)
+        for key in keys:
+            self.reduce_done((key, results.get(key)))
 
+    def report_progress(self, tasks):
+        """Logs the progress of the current phase every
+        FLAGS.report_interval percent.
+        """
+        if self.reading():
+            # the number of map tasks is not known yet
+            return
+        done = self.server.progress.done
+        ratio = int(done * 100 / max(done + self.num_remaining(), 1))
+        if ratio >= self.next_report_point:
+            status = self.status()
+            logging.info("%d%% %s done. Elapsed %s, ETA %s." % \
+                         (ratio, tasks, progress.duration(status['elapsed']),
+                          progress.duration(status['eta'])))
+            self.next_report_point += FLAGS.report_interval
+            # skip the points passed while the input was being read
+            while 0 < FLAGS.report_interval and \
+                    self.next_report_point <= ratio:
+                self.next_report_point += FLAGS.report_interval
+
+    def status(self):
+        """Returns the progress of the current phase (see
+        progress.Progress.status). This is called by the status thread, so
+        it only reads the state of the task manager.
+        """
+        _, working = self.current_phase()
+        # list() copies the values at once, while the server thread may be
+        # changing the dictionary
+        starts = list(working.values()) if working else []
+        status = self.server.progress.status(
+                self.num_remaining(), len(starts),
+                min(starts) if starts else None)
+        if self.reader is not None:
+            status['reader'] = self.reader.status()
+        return status
+
+    def close_storage(self):
+        """Removes the files of the stores (see mincepie.storage) once the
+        results have been written.
+        """
+        for store in (getattr(self, 'map_results', None),
+                      getattr(self, 'results', None)):
+            if hasattr(store, 'close'):
+                store.close()
+
+    def add_counters(self, data):
+        # replies carry the counters of the task as their fourth element
+        if len(data) > 3:
+            sideoutput.add_counters(self.counters, data[3])
+
+if __name__ == "__main__":
+    print(__doc__)
\ No newline at end of file
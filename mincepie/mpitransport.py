@@ -0,0 +1,354 @@
+"""
+The mpitransport module runs the mapreduce over MPI messages instead of the
+TCP sockets used by mince.
+
+Under --launch=mpi, the default is to use MPI only to find the server address,
+after which every host talks to the server over TCP. With --mpi_native, the
+server (rank 0) and the clients (all other ranks) exchange the same map and
+reduce commands as mince.ServerChannel and mince.Client, but as mpi4py point
+to point messages, so they go through the fast interconnect and skip the
+authentication handshake that a trusted MPI environment does not need.
+
+Large numpy arrays inside the task data or results are not pickled: they are
+sent with the buffer interface (comm.Send / comm.Recv) right after the pickled
+command that refers to them.
+
+The server blocks waiting for the replies of the clients, unless
+--task_timeout is set: it then polls for them, so that the clients stuck in a
+task time out. If no client runs a task, no reply is coming, so the idle
+clients are given a task if there is one, or let go.
+
+LocalComm is a small in-process stand-in for an mpi4py communicator, and
+run_local() runs a whole mapreduce over it with one thread per client, which
+allows you to try out the transport without MPI.
+"""
+
+# python modules
+import gflags
+import io
+import logging
+import pickle
+import sys
+import threading
+import time
+
+from . import mince
+from . import sideoutput
+from .mince import COMMAND
+
+FLAGS = gflags.FLAGS
+
+# message tags
+TAG_COMMAND = 1
+TAG_ARRAY = 2
+# arrays smaller than this (in bytes) are simply pickled
+ARRAY_THRESHOLD = 1024
+# the number of seconds between two polls for replies, with --task_timeout
+POLL_INTERVAL = 0.01
+
+
+def _is_buffer_array(obj):
+    """Checks if obj is a numpy array that is worth sending as a raw buffer.
+
+    We check the type name so numpy is not imported unless it is being used.
+    """
+    cls = type(obj)
+    return cls.__name__ == 'ndarray' and cls.__module__ == 'numpy' \
+            and not obj.dtype.hasobject and obj.nbytes >= ARRAY_THRESHOLD
+
+
+class _ArrayPickler(pickle.Pickler):
+    """A pickler that leaves the large arrays out of the pickle
+    """
+    def __init__(self, fid):
+        pickle.Pickler.__init__(self, fid, pickle.HIGHEST_PROTOCOL)
+        self.arrays = []
+
+    def persistent_id(self, obj):
+        if _is_buffer_array(obj):
+            self.arrays.append(obj)
+            return len(self.arrays) - 1
+        return None
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """An unpickler that puts the separately received arrays back
+    """
+    def __init__(self, fid, arrays):
+        pickle.Unpickler.__init__(self, fid)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        return self.arrays[int(pid)]
+
+
+def send(comm, dest, command, data=None):
+    """Sends a command with optional data to the given rank
+    """
+    if data is None:
+        comm.send((comm.Get_rank(), command, None, []), dest=dest,
+                  tag=TAG_COMMAND)
+        return
+    fid = io.BytesIO()
+    pickler = _ArrayPickler(fid)
+    pickler.dump(data)
+    arrays = pickler.arrays
+    metas = [(array.dtype.str, array.shape) for array in arrays]
+    comm.send((comm.Get_rank(), command, fid.getvalue(), metas), dest=dest,
+              tag=TAG_COMMAND)
+    for array in arrays:
+        if not array.flags['C_CONTIGUOUS']:
+            import numpy
+            array = numpy.ascontiguousarray(array)
+        comm.Send(array, dest=dest, tag=TAG_ARRAY)
+
+
+def recv(comm, source):
+    """Receives a command from the given rank.
+
+    Returns a tuple (source, command, data).
+    """
+    source, command, pdata, metas = comm.recv(source=source, tag=TAG_COMMAND)
+    if pdata is None:
+        return (source, command, None)
+    arrays = []
+    if metas:
+        import numpy
+        for dtype, shape in metas:
+            array = numpy.empty(shape, dtype=numpy.dtype(dtype))
+            comm.Recv(array, source=source, tag=TAG_ARRAY)
+            arrays.append(array)
+    data = _ArrayUnpickler(io.BytesIO(pdata), arrays).load()
+    return (source, command, data)
+
+
+def _any_source(comm):
+    """Returns the wildcard source rank of the communicator
+    """
+    if isinstance(comm, LocalComm):
+        return LocalComm.ANY_SOURCE
+    from mpi4py import MPI
+    return MPI.ANY_SOURCE
+
+
+class MPIClient(mince.Client):
+    """A client that receives its tasks from rank 0
+    """
+    def __init__(self, comm):
+        mince.Client.__init__(self)
+        self.comm = comm
+        # all the ranks run the same code
+        self.peer_version = mince.PROTOCOL_VERSION
+
+    def send_command(self, command, data=None, arg=None):
+        send(self.comm, 0, command, data)
+
+    def run_client(self):
+        logging.debug("MPI client %d started." % self.comm.Get_rank())
+        self.send_command(COMMAND.register, self.register_info())
+        while True:
+            source, command, data = recv(self.comm, 0)
+            if command == COMMAND.disconnect:
+                break
+            self.process_command(command, data)
+        logging.debug("MPI client %d done." % self.comm.Get_rank())
+
+
+class MPIChannel(mince.ServerChannel):
+    """The server side of the communication with one client rank
+    """
+    def __init__(self, server, rank):
+        # no socket and no authentication
+        mince.Protocol.__init__(self)
+        self.server = server
+        self.rank = rank
+        self.addr = "rank %d" % rank
+        self.info = {}
+        self.running = None
+        self.cancelling = False
+        self.cancel_start = None
+        self.task_seconds = None
+        self.send_buffer = self.receive_buffer = 0
+        self.auth = "Done"
+        self.peer_version = mince.PROTOCOL_VERSION
+
+    def send_command(self, command, data=None, arg=None):
+        send(self.server.comm, self.rank, command, data)
+        if command == COMMAND.disconnect:
+            self.handle_close()
+
+    def send_chunks(self, key, chunks, more=False):
+        for command, data in mince.chunk_commands(key, chunks, more):
+            self.send_command(command, data)
+
+    def handle_close(self):
+        logging.debug("Client %s disconnected" % (self.addr))
+        self.server.channels.discard(self)
+        keys = self.stop_running()
+        if keys:
+            # the client timed out in its task (see Server.check_timeouts).
+            # The rank stops once it is done with the task.
+            send(self.server.comm, self.rank, COMMAND.disconnect)
+        for key in keys:
+            self.server.taskmanager.task_failed(key)
+
+
+class MPIServer(mince.Server):
+    """The server that runs on rank 0 and serves all the other ranks
+    """
+    def __init__(self, comm):
+        mince.Server.__init__(self)
+        self.comm = comm
+
+    def run_server(self):
+        logging.info("Starting MPI server.")
+        self.datasource = mince.read_input()
+        logging.info("Number of input key value pairs: %d " % \
+                     (len(self.datasource.keys())))
+        channels = dict((rank, MPIChannel(self, rank))
+                        for rank in range(1, self.comm.Get_size()))
+        self.channels = set(channels.values())
+        self.serve_status()
+        # every client rank registers first, so that the tasks sent to it
+        # match what it asked for.
+        for _ in channels:
+            source, command, data = recv(self.comm, _any_source(self.comm))
+            channels[source].process_command(command, data)
+        for channel in channels.values():
+            channel.start_new_task()
+        any_source = _any_source(self.comm)
+        # run until every client has been told to disconnect
+        while self.channels:
+            if not any(channel.task_start() is not None
+                       for channel in self.channels):
+                self.wake_up_idle()
+                continue
+            if FLAGS.task_timeout > 0 and \
+                    not self.comm.Iprobe(source=any_source, tag=TAG_COMMAND):
+                self.tick()
+                time.sleep(POLL_INTERVAL)
+                continue
+            source, command, data = recv(self.comm, any_source)
+            if channels[source] in self.channels:
+                channels[source].process_command(command, data)
+        if self.taskmanager.state != mince.TASK.FINISHED:
+            logging.fatal("The mapreduce stopped before it finished.")
+            sys.exit(1)
+        logging.info("Mapreduce done.")
+        self.usage.report()
+        sideoutput.report(self.taskmanager.counters)
+        self.taskmanager.write_quarantine()
+        self.taskmanager.write_results()
+        self.taskmanager.close_storage()
+
+    def wake_up_idle(self):
+        """Called when no client runs a task, so no reply is coming: gives a
+        task to the idle clients if there is one, and lets them go otherwise.
+        """
+        self.taskmanager.wake_up()
+        if not self.channels or any(channel.task_start() is not None
+                                    for channel in self.channels):
+            return
+        logging.error("No task for the %d idle clients, letting them go." % \
+                      len(self.channels))
+        for channel in list(self.channels):
+            channel.send_command(COMMAND.disconnect)
+
+    def handle_close(self):
+        # there is no listening socket to close: we stop once all the client
+        # ranks are disconnected.
+        pass
+
+
+class _Mailbox(object):
+    """The incoming messages of one LocalComm rank
+    """
+    def __init__(self):
+        self.messages = []
+        self.condition = threading.Condition()
+
+    def put(self, source, tag, obj):
+        with self.condition:
+            self.messages.append((source, tag, obj))
+            self.condition.notify_all()
+
+    def find(self, source, tag):
+        """Returns the index of the first matching message, or None.
+        """
+        for i, (msg_source, msg_tag, obj) in enumerate(self.messages):
+            if msg_tag == tag and (source == LocalComm.ANY_SOURCE
+                                   or source == msg_source):
+                return i
+        return None
+
+    def probe(self, source, tag):
+        with self.condition:
+            return self.find(source, tag) is not None
+
+    def get(self, source, tag):
+        with self.condition:
+            while True:
+                i = self.find(source, tag)
+                if i is not None:
+                    return self.messages.pop(i)[2]
+                self.condition.wait()
+
+
+class LocalComm(object):
+    """An in-process stand-in for an mpi4py communicator.
+
+    It implements the few communicator methods used in this module, with the
+    same ordering guarantee as MPI: messages between a pair of ranks with the
+    same tag arrive in the order they are sent. Use LocalComm.create(size) to
+    get the communicators of all ranks, and run each rank in its own thread.
+    """
+    ANY_SOURCE = -1
+
+    def __init__(self, rank, mailboxes):
+        self.rank = rank
+        self.mailboxes = mailboxes
+
+    @classmethod
+    def create(cls, size):
+        mailboxes = [_Mailbox() for i in range(size)]
+        return [cls(rank, mailboxes) for rank in range(size)]
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return len(self.mailboxes)
+
+    def send(self, obj, dest, tag=0):
+        # copy the object, as a real send would
+        self.mailboxes[dest].put(self.rank, tag,
+                                 pickle.loads(pickle.dumps(obj)))
+
+    def recv(self, buf=None, source=ANY_SOURCE, tag=0):
+        return self.mailboxes[self.rank].get(source, tag)
+
+    def Iprobe(self, source=ANY_SOURCE, tag=0):
+        return self.mailboxes[self.rank].probe(source, tag)
+
+    def Send(self, buf, dest, tag=0):
+        self.mailboxes[dest].put(self.rank, tag, buf.copy())
+
+    def Recv(self, buf, source, tag=0):
+        buf[...] = self.mailboxes[self.rank].get(source, tag)
+
+
+def run_local(num_clients):
+    """Runs the mapreduce over a LocalComm, with the server in the current
+    thread and num_clients clients in their own threads.
+    """
+    comms = LocalComm.create(num_clients + 1)
+    threads = [threading.Thread(target=MPIClient(comm).run_client)
+               for comm in comms[1:]]
+    for thread in threads:
+        thread.start()
+    MPIServer(comms[0]).run_server()
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,169 @@
+"""
+The prefetch module reads the input of the job in the background, so the
+server can start listening, and the clients mapping, while the reader is
+still at work. It is off by default: set --reader_threads to turn it on.
+
+The input is split by the reader into sources (see BasicReader.sources in
+mincepie.mapreducer), such as the files matching --input, which a pool of
+--reader_threads threads read in parallel with BasicReader.read_source. The
+records are put in a queue of at most --prefetch_records records, from which
+the server takes the map tasks as the clients ask for them, so the readers
+stay a bounded distance ahead of the mappers. The readers of the jobs that
+only implement read() have a single source, which one thread reads. Threads
+only read in parallel as far as the readers release the GIL, which file
+reads and decompression do.
+
+The number of records read and their rate are logged once the input is read,
+and are part of the status of the job (see mincepie.progress), apart from the
+map throughput.
+
+Flags defined by this module:
+    --reader_threads: the number of threads reading the input in the
+        background. Default 0, which reads all the input before the server
+        starts, as the MPI server and the local launch modes always do.
+    --prefetch_records: the maximum number of records read ahead of the map
+        tasks. Default 10000.
+"""
+
+# python modules
+import collections
+import gflags
+import logging
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+gflags.DEFINE_integer("reader_threads", 0,
+    "The number of threads reading the input in the background. 0 to read "
+    "it at once.")
+gflags.DEFINE_integer("prefetch_records", 10000,
+    "The maximum number of records read ahead of the map tasks")
+gflags.RegisterValidator('prefetch_records', lambda x: x > 0,
+                         message='--prefetch_records must be positive.')
+FLAGS = gflags.FLAGS
+
+
+class Prefetcher(object):
+    """Reads the input with a reader in background threads.
+
+    The server thread takes the records with get(), while the reader threads
+    add them, hence the lock around the counts.
+    """
+    def __init__(self, reader, input_string):
+        self.reader = reader
+        self.input_string = input_string
+        self.records = queue.Queue(FLAGS.prefetch_records)
+        self.sources = collections.deque()
+        self.lock = threading.Lock()
+        # the number of threads still reading, and of the records read
+        self.running = 0
+        self.num_read = 0
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    def start(self):
+        """Starts listing the sources, which then start the reader threads.
+        """
+        self.start_time = time.time()
+        self.running = 1
+        self._start_thread(self._list_sources)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def _list_sources(self):
+        try:
+            self.sources.extend(self.reader.sources(self.input_string))
+            num_threads = min(FLAGS.reader_threads, len(self.sources))
+            logging.info("Reading %d input sources with %d threads." % \
+                         (len(self.sources), num_threads))
+            with self.lock:
+                self.running += num_threads
+            for _ in range(num_threads):
+                self._start_thread(self._read_sources)
+        except Exception:
+            self._failed()
+        finally:
+            self._finished()
+
+    def _read_sources(self):
+        try:
+            while self.error is None:
+                try:
+                    source = self.sources.popleft()
+                except IndexError:
+                    break
+                for record in self.reader.read_source(source):
+                    # blocks while the queue is full
+                    self.records.put(record)
+                    with self.lock:
+                        self.num_read += 1
+        except Exception:
+            self._failed()
+        finally:
+            self._finished()
+
+    def _failed(self):
+        logging.exception("Failed to read the input.")
+        self.error = sys.exc_info()[1]
+
+    def _finished(self):
+        with self.lock:
+            self.running -= 1
+            if self.running > 0 or self.error is not None:
+                return
+            self.end_time = time.time()
+            elapsed = self.end_time - self.start_time
+        logging.info("Read %d input records in %.2f seconds (%.2f "
+                     "records/s)." % (self.num_read, elapsed,
+                                      self.num_read / max(elapsed, 1e-6)))
+
+    def check(self):
+        """Raises the error of the reader threads, if they failed.
+        """
+        if self.error is not None:
+            raise self.error
+
+    def get(self):
+        """Returns the next (key, value) record, or None if no record is
+        ready now.
+        """
+        try:
+            return self.records.get_nowait()
+        except queue.Empty:
+            return None
+
+    def num_ready(self):
+        """Returns the number of records read and not taken yet.
+        """
+        return self.records.qsize()
+
+    def done(self):
+        """Tells if all the records have been read and taken.
+        """
+        # the threads put their records before they stop running
+        return self.running == 0 and self.error is None and \
+                self.records.empty()
+
+    def status(self):
+        """Returns the progress of the readers as a dictionary.
+        """
+        with self.lock:
+            elapsed = (self.end_time or time.time()) - self.start_time
+            return {'records': self.num_read,
+                    'ready': self.records.qsize(),
+                    'elapsed': elapsed,
+                    'throughput': self.num_read / elapsed
+                                  if elapsed > 0 else 0.,
+                    'finished': self.end_time is not None,
+                   }
+
+if __name__ == "__main__":
+    print(__doc__)
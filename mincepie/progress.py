@@ -0,0 +1,258 @@
+"""
+The progress module keeps track of the progress of the job on the server,
+and serves it to the operators.
+
+For the current phase (map or reduce), the server counts the tasks that are
+done, running and remaining, and computes the throughput over the last
+--progress_window seconds, from which it predicts when the phase will end.
+It also tracks the rate at which each client finishes its tasks, and the
+age of the oldest running task, so a stalled tail or a slow client shows up.
+While the input is read in the background (see mincepie.prefetch), the
+number of records read and the reader throughput are reported as well.
+Both phases log their progress every --report_interval percent.
+
+With --status_port set, the server answers HTTP requests on that port with
+the progress as a JSON object, e.g.
+    curl http://localhost:PORT/
+or, formatted for humans,
+    python wordcount.py --launch=status --status_port=PORT
+The endpoint is served by a thread of its own, so it also answers when the
+server is busy, and under the MPI transport.
+
+Flags defined by this module:
+    --status_port: the port of the status endpoint. Default 0, which means
+        no endpoint.
+    --status_address: the address the status endpoint listens on, and that
+        --launch=status queries. Default "127.0.0.1".
+    --progress_window: the number of seconds over which the throughput is
+        measured. Default 60.
+"""
+
+# python modules
+import asynchat
+import asyncore
+import collections
+import datetime
+import gflags
+import json
+import logging
+import socket
+import threading
+import time
+
+gflags.DEFINE_integer("status_port", 0,
+    "The port of the status endpoint. 0 for none.")
+gflags.DEFINE_string("status_address", "127.0.0.1",
+    "The address of the status endpoint")
+gflags.DEFINE_float("progress_window", 60.,
+    "The number of seconds over which the throughput is measured")
+gflags.RegisterValidator('progress_window', lambda x: x > 0,
+                         message='--progress_window must be positive.')
+FLAGS = gflags.FLAGS
+
+# the number of clients listed, slowest first, in the formatted status
+STATUS_CLIENTS = 10
+# the number of seconds --launch=status waits for the endpoint
+QUERY_TIMEOUT = 10
+
+
+class Progress(object):
+    """The progress of the current phase, and the rate of each client.
+
+    The server thread records the finished tasks, and the status thread
+    reads the numbers, hence the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = None
+        self.start_time = time.time()
+        self.done = 0
+        # (time, number of tasks) of the recent task completions
+        self.recent = collections.deque()
+        # client -> [tasks done, time of the last one, deque of their times]
+        self.clients = {}
+        # (phase, seconds) of the finished phases
+        self.finished = []
+
+    def start_phase(self, phase):
+        with self.lock:
+            now = time.time()
+            if self.phase is not None:
+                self.finished.append((self.phase, now - self.start_time))
+            self.phase = phase
+            self.start_time = now
+            self.done = 0
+            self.recent.clear()
+            for client in self.clients.values():
+                client[2].clear()
+
+    def task_done(self, count=1):
+        """Records that tasks of the current phase are finished.
+        """
+        with self.lock:
+            self.done += count
+            self.recent.append((time.time(), count))
+
+    def client_done(self, client, count=1):
+        """Records that a client sent back the results of tasks.
+        """
+        with self.lock:
+            now = time.time()
+            if client not in self.clients:
+                self.clients[client] = [0, now, collections.deque()]
+            entry = self.clients[client]
+            entry[0] += count
+            entry[1] = now
+            entry[2].append((now, count))
+
+    def _rate(self, recent, now):
+        while recent and recent[0][0] < now - FLAGS.progress_window:
+            recent.popleft()
+        span = min(FLAGS.progress_window, now - self.start_time)
+        if span <= 0:
+            return 0.
+        return sum(count for _, count in recent) / span
+
+    def status(self, remaining, running, oldest):
+        """Returns the progress as a dictionary, given the number of tasks
+        of the phase that are not finished, how many of these are running,
+        and the start time of the oldest running one (or None).
+        """
+        with self.lock:
+            now = time.time()
+            throughput = self._rate(self.recent, now)
+            eta = remaining / throughput if throughput > 0 else None
+            clients = [{'name': name,
+                        'done': entry[0],
+                        'rate': self._rate(entry[2], now),
+                        'idle': now - entry[1]}
+                       for name, entry in self.clients.items()]
+            return {'phase': self.phase,
+                    'elapsed': now - self.start_time,
+                    'done': self.done,
+                    'running': running,
+                    'queued': remaining - running,
+                    'remaining': remaining,
+                    'throughput': throughput,
+                    'window': FLAGS.progress_window,
+                    'eta': eta,
+                    'oldest_running': None if oldest is None
+                                      else now - oldest,
+                    'clients': sorted(clients, key=lambda c: c['rate']),
+                    'finished_phases': list(self.finished),
+                   }
+
+
+def duration(seconds):
+    if seconds is None:
+        return "unknown"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def format_status(status):
+    """Returns the status dictionary as lines of text.
+    """
+    if status.get('phase') is None:
+        return ["The job has not started yet."]
+    total = status['done'] + status['remaining']
+    lines = ["Phase: %s, %d / %d tasks done (%d%%), %d running, %d queued." % \
+             (status['phase'], status['done'], total,
+              100 * status['done'] // max(total, 1), status['running'],
+              status['queued']),
+             "Elapsed %s, %.2f tasks/s over the last %d seconds, ETA %s." % \
+             (duration(status['elapsed']), status['throughput'],
+              status['window'], duration(status['eta']))]
+    reader = status.get('reader')
+    if reader is not None:
+        lines.append("Input: %d records read in %s, %.2f records/s%s." % \
+                     (reader['records'], duration(reader['elapsed']),
+                      reader['throughput'], "" if reader['finished'] else
+                      ", still reading (%d ready)" % reader['ready']))
+    if status['oldest_running'] is not None:
+        lines.append("The oldest running task started %s ago." % \
+                     duration(status['oldest_running']))
+    for phase, seconds in status['finished_phases']:
+        lines.append("The %s phase took %s." % (phase, duration(seconds)))
+    if status['clients']:
+        lines.append("Clients, slowest first:")
+        for client in status['clients'][:STATUS_CLIENTS]:
+            lines.append("  %.2f tasks/s %s (%d tasks, last one %s ago)" % \
+                         (client['rate'], client['name'], client['done'],
+                          duration(client['idle'])))
+    return lines
+
+
+class StatusChannel(asynchat.async_chat):
+    """Answers one HTTP request with the status, and closes.
+    """
+    def __init__(self, conn, status_map, get_status):
+        asynchat.async_chat.__init__(self, conn, map=status_map)
+        self.get_status = get_status
+        self.set_terminator(b'\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        pass
+
+    def found_terminator(self):
+        try:
+            body = json.dumps(self.get_status()).encode('utf-8')
+            header = "HTTP/1.0 200 OK"
+        except Exception as e:
+            logging.exception("Failed to get the status.")
+            body = repr(e).encode('utf-8')
+            header = "HTTP/1.0 500 Internal Server Error"
+        self.push(("%s\r\nContent-Type: application/json\r\n"
+                   "Content-Length: %d\r\n\r\n" % (header, len(body)))
+                  .encode('ascii') + body)
+        self.close_when_done()
+
+
+class StatusServer(asyncore.dispatcher):
+    """Serves the status returned by get_status() on FLAGS.status_port, in a
+    thread of its own with its own socket map.
+    """
+    def __init__(self, get_status):
+        self.status_map = {}
+        asyncore.dispatcher.__init__(self, map=self.status_map)
+        self.get_status = get_status
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((FLAGS.status_address, FLAGS.status_port))
+        self.listen(5)
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs={'timeout': 1.,
+                                          'map': self.status_map})
+        thread.daemon = True
+        thread.start()
+        logging.info("Serving the status on %s:%d" % \
+                     (FLAGS.status_address, FLAGS.status_port))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            StatusChannel(pair[0], self.status_map, self.get_status)
+
+
+def query():
+    """Gets the status from the endpoint at FLAGS.status_address and
+    FLAGS.status_port.
+    """
+    conn = socket.create_connection((FLAGS.status_address, FLAGS.status_port),
+                                    QUERY_TIMEOUT)
+    try:
+        conn.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        chunks = []
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        conn.close()
+    header, _, body = b''.join(chunks).partition(b'\r\n\r\n')
+    if not header.split(b'\r\n')[0].endswith(b'200 OK'):
+        raise IOError("The status endpoint failed: %s" % body)
+    return json.loads(body.decode('utf-8'))
+
+if __name__ == "__main__":
+    print(__doc__)
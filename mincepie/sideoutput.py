@@ -0,0 +1,89 @@
+"""
+The sideoutput module lets mappers and reducers count things and write
+records that do not go through the shuffle.
+
+Use
+    sideoutput.increment('bad_lines')
+to add to a named counter. The counters are added up on the client, and sent
+to the server with the reply of each task (as its fourth element). The server
+only adds the counters of the replies it uses, so the tasks that are run more
+than once are not counted twice. The totals are logged at the end of the job.
+
+Use
+    sideoutput.write('errors', key, value)
+to write a record to a side output. The records are written by the client
+straight to its own file, FLAGS.side_output_dir/NAME-HOST-PID, in the same
+format as mapreducer.FileWriter, and never reach the server or the reduce
+phase. The files are flushed before each task reports that it is done. Note
+that a task that is run more than once (e.g. after its client timed out)
+writes its records more than once.
+
+Flags defined by this module:
+    --side_output_dir: the directory of the side output files. Default ".".
+"""
+
+# python modules
+import gflags
+import logging
+import os
+import socket
+
+gflags.DEFINE_string("side_output_dir", ".",
+    "The directory of the side output files")
+FLAGS = gflags.FLAGS
+
+# the counters incremented since the last task reply
+_COUNTERS = {}
+# name -> the open side output file
+_FILES = {}
+
+
+def increment(name, amount=1):
+    """Adds amount to the counter with the given name.
+    """
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+
+def write(name, key, value):
+    """Writes a key, value record to the side output with the given name.
+    """
+    if name not in _FILES:
+        filename = os.path.join(FLAGS.side_output_dir, "%s-%s-%d" % \
+                (name, socket.gethostname(), os.getpid()))
+        _FILES[name] = open(filename, 'a')
+    _FILES[name].write(repr(key) + ":" + repr(value) + '\n')
+
+
+def flush():
+    """Flushes the side output files.
+    """
+    for fid in _FILES.values():
+        fid.flush()
+
+
+def take_counters():
+    """Returns the counters incremented since the last call, and resets them.
+    """
+    counters = dict(_COUNTERS)
+    _COUNTERS.clear()
+    return counters
+
+
+def add_counters(total, counters):
+    """Adds a dictionary of counters to the dictionary total.
+    """
+    for name, amount in counters.items():
+        total[name] = total.get(name, 0) + amount
+
+
+def report(counters):
+    """Logs the counter totals.
+    """
+    if not counters:
+        return
+    logging.info("Counters:")
+    for name in sorted(counters):
+        logging.info("  %s: %s" % (name, counters[name]))
+
+if __name__ == "__main__":
+    print(__doc__)
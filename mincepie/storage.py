@@ -0,0 +1,355 @@
+"""
+The storage module holds the key-value data of the server: the intermediate
+values gathered from the map tasks, and the results of the reduce tasks.
+
+The store is picked with --storage:
+    memory: python dictionaries, the fastest, and the default.
+    sqlite: the values are kept in a temporary sqlite3 database.
+    log: the values are appended to a temporary log file, with an index in
+        memory of where the records of each key are.
+With the file-based stores, the server only keeps the keys (and the number of
+values of each) in memory, so large jobs can trade some speed for bounded
+memory. The files are created in --storage_dir and removed at the end of the
+job.
+
+A store is a dictionary-like object: it supports len(), iteration over the
+keys, in, store[key] and store[key] = value, items() and values(), plus
+    store.append(key, values)
+which adds a list of values to the values of a key, and
+    store.count(key)
+which returns the number of values appended to a key,
+    store.slice(key, start, end)
+which returns the values from start to end of a key, and
+    store.chunks(key, size)
+which yields the values of a key in columns of size values (the last one may
+be shorter). The file-based stores read the values of a key back when
+store[key] is called, so changing the list returned does not change the
+store. slice() and chunks() only read the records they need, a few at a
+time, so the server can look at the values of a hot key, or stream them,
+without holding them all in memory. They list their keys in the order they
+were added, and are pickled (e.g. by mapreducer.PickleWriter) as plain
+dictionaries. Other stores can be added with register(), and then selected
+by name.
+
+Flags defined by this module:
+    --storage: the store of the intermediate values and the results. Default
+        "memory".
+    --storage_dir: the directory of the files of the file-based stores.
+        Default "", which means the system temporary directory.
+"""
+
+# python modules
+import collections
+import gflags
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+
+from . import columnar
+
+gflags.DEFINE_string("storage", "memory",
+    "The store of the intermediate values and the results")
+gflags.DEFINE_string("storage_dir", "",
+    "The directory of the files of the file-based stores")
+FLAGS = gflags.FLAGS
+
+# the number of records the sqlite store reads at a time
+READ_PAGE_SIZE = 64
+
+# name -> store class
+_STORES = {}
+
+
+def register(name, store_class):
+    """Registers a store class (or function returning a store), which takes
+    the ordered argument of new_store, under the given name.
+    """
+    _STORES[name] = store_class
+
+
+def new_store(ordered=False):
+    """Returns a new empty store of the type given by FLAGS.storage. If
+    ordered is True, the store lists its keys in the order they were added.
+    """
+    try:
+        store_class = _STORES[FLAGS.storage]
+    except KeyError:
+        logging.fatal("Unknown storage %s, use one of %s." % \
+                      (FLAGS.storage, ", ".join(sorted(_STORES))))
+        sys.exit(1)
+    return store_class(ordered)
+
+
+def storage_dir():
+    return FLAGS.storage_dir or tempfile.gettempdir()
+
+
+def chunk_columns(columns, size):
+    """Yields the values of the given sequence of columns as columns of size
+    values, except for the last one which may be shorter.
+    """
+    chunk = None
+    for column in columns:
+        start = 0
+        while start < len(column):
+            if chunk is None and len(column) - start >= size:
+                yield column[start:start + size]
+                start += size
+                continue
+            end = start + size - (len(chunk) if chunk is not None else 0)
+            chunk = columnar.extend(chunk, column[start:end])
+            start = min(end, len(column))
+            if len(chunk) == size:
+                yield chunk
+                chunk = None
+    if chunk is not None:
+        yield chunk
+
+
+def slice_columns(columns, start, end):
+    """Returns the values from start to end of the given sequence of
+    columns, reading no further than end.
+    """
+    values = None
+    offset = 0
+    for column in columns:
+        if offset >= end:
+            break
+        if offset + len(column) > start:
+            values = columnar.extend(values, column[max(start - offset, 0):
+                                                    end - offset])
+        offset += len(column)
+    if values is None:
+        return columnar.new_column()
+    return values
+
+
+class _MemoryStoreMixin(object):
+    """The store methods of the dictionaries of memory_store().
+    """
+    def append(self, key, values):
+        column = self.get(key)
+        extended = columnar.extend(column, values)
+        if extended is not column:
+            self[key] = extended
+
+    def count(self, key):
+        return len(self[key])
+
+    def slice(self, key, start, end):
+        return self[key][start:end]
+
+    def chunks(self, key, size):
+        return chunk_columns([self[key]], size)
+
+    def close(self):
+        pass
+
+    def __reduce__(self):
+        # pickled as a plain dictionary
+        return (self._plain, (), None, None, iter(self.items()))
+
+
+class _Dict(_MemoryStoreMixin, dict):
+    _plain = dict
+
+
+class _OrderedDict(_MemoryStoreMixin, collections.OrderedDict):
+    _plain = collections.OrderedDict
+
+
+def memory_store(ordered=False):
+    """Returns a dictionary (an ordered one if ordered is True) with the
+    store methods.
+    """
+    if ordered:
+        return _OrderedDict()
+    return _Dict()
+
+
+class FileStore(object):
+    """The base class of the file-based stores.
+
+    The values of a key are stored as a sequence of pickled records: either
+    ('extend', values), appended by append(), or ('set', value), which
+    replaces what was there before. Subclasses implement how the records are
+    written and read back.
+    """
+    def __init__(self, ordered=False):
+        self.ordered = ordered
+        # the keys in the order they were added, and key -> number of values
+        self._keys = []
+        self._counts = {}
+
+    def write_records(self, key, record, replace):
+        """Stores a record of the key. If replace is True, the previous
+        records of the key are dropped.
+        """
+        raise NotImplementedError
+
+    def read_records(self, key):
+        """Yields the records of the key, in the order they were stored.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Removes the files of the store.
+        """
+        pass
+
+    def _add_key(self, key):
+        if key not in self._counts:
+            self._keys.append(key)
+            self._counts[key] = 0
+
+    def append(self, key, values):
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        self._add_key(key)
+        self._counts[key] += len(values)
+        self.write_records(key, ('extend', values), False)
+
+    def count(self, key):
+        return self._counts[key]
+
+    def _columns(self, key):
+        # a set record is always the first record of the key
+        if key not in self._counts:
+            raise KeyError(key)
+        for _, data in self.read_records(key):
+            yield data
+
+    def slice(self, key, start, end):
+        return slice_columns(self._columns(key), start, end)
+
+    def chunks(self, key, size):
+        return chunk_columns(self._columns(key), size)
+
+    def __setitem__(self, key, value):
+        self._add_key(key)
+        self.write_records(key, ('set', value), True)
+
+    def __getitem__(self, key):
+        if key not in self._counts:
+            raise KeyError(key)
+        value = None
+        for operation, data in self.read_records(key):
+            if operation == 'set':
+                value = data
+            else:
+                value = columnar.extend(value, data)
+        return value
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self[key]
+
+    items = iteritems
+
+    def values(self):
+        for key in self._keys:
+            yield self[key]
+
+    def __reduce__(self):
+        # pickled as a plain dictionary, loading one value at a time
+        plain = collections.OrderedDict if self.ordered else dict
+        return (plain, (), None, None, self.iteritems())
+
+
+class SqliteStore(FileStore):
+    """A store keeping the records in a temporary sqlite3 database. Each key
+    gets a number, which the records are indexed by.
+    """
+    def __init__(self, ordered=False):
+        FileStore.__init__(self, ordered)
+        handle, self.path = tempfile.mkstemp(prefix='mincepie-',
+                                             suffix='.sqlite',
+                                             dir=storage_dir())
+        os.close(handle)
+        self.db = sqlite3.connect(self.path)
+        # the database is thrown away at the end, so it needs no journal
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE records (id INTEGER, data BLOB)")
+        self.db.execute("CREATE INDEX records_id ON records (id)")
+        self._ids = {}
+
+    def write_records(self, key, record, replace):
+        if key not in self._ids:
+            self._ids[key] = len(self._ids)
+        elif replace:
+            self.db.execute("DELETE FROM records WHERE id = ?",
+                            (self._ids[key],))
+        self.db.execute("INSERT INTO records VALUES (?, ?)",
+                        (self._ids[key], sqlite3.Binary(
+                                pickle.dumps(record, pickle.HIGHEST_PROTOCOL))))
+
+    def read_records(self, key):
+        # the rows are fetched a page at a time, so other queries can run
+        # while the records are being read
+        rowid = -1
+        while True:
+            rows = self.db.execute(
+                    "SELECT rowid, data FROM records WHERE id = ? AND "
+                    "rowid > ? ORDER BY rowid LIMIT ?",
+                    (self._ids[key], rowid, READ_PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            for rowid, data in rows:
+                yield pickle.loads(bytes(data))
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+class LogStore(FileStore):
+    """A store appending the records to a temporary log file, with a hash
+    index from each key to the offsets and sizes of its records.
+    """
+    def __init__(self, ordered=False):
+        FileStore.__init__(self, ordered)
+        self.log = tempfile.TemporaryFile(prefix='mincepie-', suffix='.log',
+                                          dir=storage_dir())
+        self._index = {}
+
+    def write_records(self, key, record, replace):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.log.seek(0, os.SEEK_END)
+        if replace or key not in self._index:
+            # the records replaced stay in the log as garbage
+            self._index[key] = []
+        self._index[key].append((self.log.tell(), len(data)))
+        self.log.write(data)
+
+    def read_records(self, key):
+        for offset, size in list(self._index[key]):
+            # other reads and writes may move the file offset in between
+            self.log.seek(offset)
+            yield pickle.loads(self.log.read(size))
+
+    def close(self):
+        self.log.close()
+
+
+register('memory', memory_store)
+register('sqlite', SqliteStore)
+register('log', LogStore)
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,467 @@
+"""
+The subserver module implements an optional second level between the server
+and the clients, for runs with more clients than a single server can handle.
+
+A sub-server connects to the server like a client does, but instead of running
+the tasks itself, it pulls a batch of tasks at a time and hands them out to its
+own local clients (e.g. the clients on the same rack or node). The map outputs
+of a batch are merged, and combined if --combiner is set, before they are sent
+upstream as a single message. The server thus only sees one connection per
+sub-server. Broadcast blobs (see mincepie.broadcast) are received once by the
+sub-server, which only accepts local clients once it has them, and serves them
+its own copies. Streamed reduce tasks are passed on to a local client chunk by
+chunk as they arrive, and the sub-server stops reading from the server while
+that client lags behind.
+
+To run a sub-server manually, run your program with --launch=subserver and
+--address pointing to the server, and start the local clients with
+--launch=client --address=SUBSERVER_IP --port=SUBSERVER_PORT. Under MPI, use
+--launch=mpi with --mpi_group_size (see launcher).
+
+Flags defined by this module:
+    --subserver_port: the port number on which a sub-server accepts its local
+        clients. Default 11236.
+    --subserver_batch_size: the number of tasks a sub-server pulls from the
+        server each time. Default 100.
+"""
+
+# python modules
+import asyncore
+import collections
+import gflags
+import logging
+import socket
+import sys
+import time
+
+from . import columnar
+from . import mapreducer
+from . import mince
+from . import sideoutput
+from .mince import COMMAND
+
+gflags.DEFINE_integer("subserver_port", 11236,
+    "The port number on which a sub-server accepts its local clients")
+gflags.DEFINE_integer("subserver_batch_size", 100,
+    "The number of tasks a sub-server pulls from the server each time")
+gflags.RegisterValidator('subserver_batch_size', lambda x: x > 0,
+                         message='--subserver_batch_size must be positive.')
+
+FLAGS = gflags.FLAGS
+
+# the bytes of a streamed task buffered for its local client, above which the
+# sub-server stops reading from the server
+STREAM_BUFFER_BYTES = 64 << 20
+
+
+class SubServer(mince.Server):
+    """A server whose tasks come from another server instead of a reader.
+    """
+    def __init__(self):
+        mince.Server.__init__(self)
+        self.taskmanager = BatchTaskManager(self)
+        self.upstream = None
+
+    def run_subserver(self, address = None, port = None):
+        """Runs the sub-server
+
+        The upstream server address is obtained from the commandline flags if
+        address is None. port is the port to listen on for local clients, and
+        defaults to FLAGS.subserver_port.
+        """
+        if port is None:
+            port = FLAGS.subserver_port
+        logging.info("Starting sub-server.")
+        self.upstream = UpstreamChannel()
+        self.upstream.subserver = self
+        if not self.upstream.connect_server(address):
+            logging.fatal("Unable to connect to the server.")
+            sys.exit(1)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind(("", port))
+        self.listen(socket.SOMAXCONN)
+        logging.info("Starting listening on %d" % (port))
+        try:
+            self.loop()
+        except:
+            asyncore.close_all()
+            raise
+        logging.info("Sub-server done.")
+        self.usage.report()
+
+    def readable(self):
+        # local clients are only accepted once the broadcast blobs are here,
+        # as the sub-server serves them its own copies.
+        return self.upstream.blobs.ready() and mince.Server.readable(self)
+
+    def steal_tasks(self, thief):
+        # the tasks of a batch from the server are handed out one batch of
+        # local tasks at a time already.
+        return None
+
+    def upstream_closed(self):
+        """Called when the server disconnects: stop accepting local clients,
+        and let the current ones go.
+        """
+        logging.debug("Server disconnected.")
+        self.close()
+        self.taskmanager.finish()
+
+
+class UpstreamChannel(mince.Client):
+    """The connection from a sub-server to its server.
+
+    Single map and reduce tasks (such as the first task, which the server
+    sends before the sub-server registers) are treated as batches of one.
+    """
+    def register_info(self):
+        info = mince.client_info()
+        info['batch_size'] = FLAGS.subserver_batch_size
+        return info
+
+    def handle_close(self):
+        self.close()
+        self.subserver.upstream_closed()
+
+    def readable(self):
+        # the chunks of a streamed task are not read faster than the local
+        # client gets them
+        return not self.subserver.taskmanager.stream_blocked() and \
+                mince.Client.readable(self)
+
+    def process_command(self, command, data=None):
+        if self.receive_blobs(command, data):
+            return
+        taskmanager = self.subserver.taskmanager
+        handlers = {
+            COMMAND.map: lambda x, y: taskmanager.add_tasks(
+                    COMMAND.map, [y], True),
+            COMMAND.reduce: lambda x, y: taskmanager.add_tasks(
+                    COMMAND.reduce, [y], True),
+            COMMAND.reducepartition: lambda x, y: taskmanager.add_tasks(
+                    COMMAND.reducepartition, [y], True),
+            COMMAND.mapbatch: lambda x, y: taskmanager.add_tasks(
+                    COMMAND.map, y, False),
+            COMMAND.reducebatch: lambda x, y: taskmanager.add_tasks(
+                    COMMAND.reduce, y, False),
+            COMMAND.reducechunk: lambda x, y: taskmanager.stream_chunk(*y),
+            COMMAND.reduceend: lambda x, y: taskmanager.end_stream(y[0]),
+            COMMAND.cancel: lambda x, y: taskmanager.cancel(y),
+            }
+        if command in handlers:
+            handlers[command](command, data)
+        else:
+            # skip Client.process_command, which runs the tasks itself
+            mince.Protocol.process_command(self, command, data)
+
+
+class BatchTaskManager(object):
+    """The task manager of a sub-server.
+
+    It hands out the tasks of the current batch to the local clients, and
+    sends the merged results upstream once the whole batch is done. Clients
+    asking for tasks while there are none are kept idle until the next batch
+    arrives.
+
+    A streamed reduce task is a batch of one, given to a single local client
+    which gets the chunks as they arrive. It is never run again locally: if
+    the client is lost, the rest of the stream is dropped and the server is
+    told the task is cancelled, so it runs it elsewhere.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.command = None
+        self.single = False
+        self.tasks = {}
+        self.keys = []
+        self.queue = collections.deque()
+        self.working = {}
+        self.results = {}
+        self.idle = set()
+        self.finished = False
+        self.combiner = None
+        self.start_time = None
+        self.usage = {}
+        self.counters = {}
+        # the local client of the streamed task, the chunks that arrived
+        # before it, whether reduceend has arrived, and the key of a stream
+        # whose chunks are dropped until its reduceend
+        self.stream_runner = None
+        self.stream_chunks = collections.deque()
+        self.stream_ended = False
+        self.skip_stream = None
+
+    def add_tasks(self, command, tasks, single):
+        """Starts a new batch of tasks, given as a list of (key, value) pairs.
+        """
+        logging.debug("Received %d tasks." % len(tasks))
+        self.command = command
+        self.single = single
+        self.keys = [task[0] for task in tasks]
+        self.tasks = dict(tasks)
+        self.queue = collections.deque(tasks)
+        self.working = {}
+        self.results = {}
+        self.start_time = time.time()
+        self.usage = {'cpu': 0., 'rss': 0., 'rss_growth': 0., 'outputs': 0}
+        self.counters = {}
+        self.stream_runner = None
+        self.stream_chunks.clear()
+        self.stream_ended = False
+        self.wake_up()
+
+    def stream_chunk(self, key, values):
+        """Passes a chunk of a streamed task on to its local client, or keeps
+        it until a client takes the task. The first chunk starts the task.
+        """
+        if self.skip_stream is not None:
+            return
+        if self.command != COMMAND.reducestream:
+            self.add_tasks(COMMAND.reducestream, [(key, None)], True)
+        if self.stream_runner is not None:
+            self.stream_runner.send_command(COMMAND.reducechunk, (key, values))
+        else:
+            self.stream_chunks.append(values)
+
+    def end_stream(self, key):
+        """Passes the end of a streamed task on to its local client.
+        """
+        if self.skip_stream is not None:
+            self.skip_stream = None
+            if self.command == COMMAND.reducestream:
+                # the local client was lost, rather than the task cancelled
+                self.give_up_stream()
+            return
+        if self.command != COMMAND.reducestream:
+            self.add_tasks(COMMAND.reducestream, [(key, None)], True)
+        self.stream_ended = True
+        if self.stream_runner is not None:
+            self.stream_runner.send_command(COMMAND.reduceend, (key,))
+        else:
+            # older clients only take the task once it has all arrived
+            self.wake_up()
+
+    def next_stream(self, channel):
+        """Gives the streamed task, with the chunks that have arrived so far,
+        to the first local client asking for a task.
+        """
+        if self.queue and (self.stream_ended or
+                           channel.supports(COMMAND.reducechunk)):
+            key, _ = self.queue.popleft()
+            self.working[key] = time.time()
+            self.stream_runner = channel
+            chunks = list(self.stream_chunks)
+            self.stream_chunks.clear()
+            return (COMMAND.reducestream,
+                    (key, chunks, not self.stream_ended))
+        self.idle.add(channel)
+        return (None, None)
+
+    def stream_blocked(self):
+        """Tells if the sub-server should stop reading the chunks of the
+        streamed task, as its local client has not taken them yet.
+        """
+        if self.command != COMMAND.reducestream:
+            return False
+        if self.stream_runner is not None:
+            return self.stream_runner.send_buffer >= STREAM_BUFFER_BYTES
+        # no bound if only older clients are here to wait for the whole task
+        return len(self.stream_chunks) >= mince.STREAM_QUEUE_SIZE and \
+                any(channel.supports(COMMAND.reducechunk)
+                    for channel in self.server.channels)
+
+    def give_up_stream(self):
+        """Tells the server that the streamed task is cancelled, after its
+        local client has been lost.
+        """
+        logging.warning("Lost the local client of streamed task %r." % \
+                        (self.keys[0],))
+        self.command = None
+        self.tasks = {}
+        self.results = {}
+        self.server.upstream.send_command(COMMAND.cancelled)
+
+    def finish(self):
+        self.finished = True
+        self.wake_up()
+
+    def reading(self):
+        # the tasks come in batches from the server, which reads the input
+        return False
+
+    def poll_reader(self):
+        pass
+
+    def wake_up(self):
+        idle = self.idle
+        self.idle = set()
+        for channel in idle:
+            channel.start_new_task()
+
+    def next_task(self, channel):
+        """Returns the next task to carry out
+        """
+        if self.finished:
+            return (COMMAND.disconnect, None)
+        if self.command == COMMAND.reducestream:
+            return self.next_stream(channel)
+        if self.queue:
+            key, value = self.queue.popleft()
+            self.working[key] = time.time()
+            return (self.command, (key, value))
+        elif self.working:
+            # re-run the oldest running task, in case its client died
+            key = min(self.working, key=self.working.get)
+            self.working[key] = time.time()
+            return (self.command, (key, self.tasks[key]))
+        else:
+            self.idle.add(channel)
+            return (None, None)
+
+    def task_failed(self, key):
+        """Queues again a task whose local client died or timed out. Failed
+        attempts are only counted by the server.
+        """
+        if self.command == COMMAND.reducestream:
+            if key in self.working:
+                del self.working[key]
+                self.stream_runner = None
+                if self.stream_ended:
+                    self.give_up_stream()
+                else:
+                    self.skip_stream = key
+            return
+        if key in self.working:
+            del self.working[key]
+            self.queue.appendleft((key, self.tasks[key]))
+
+    def task_cancelled(self, key):
+        """Queues again a task whose local copy has been cancelled, unless
+        another local client still runs it.
+        """
+        if key not in self.server.runners:
+            self.task_failed(key)
+
+    def cancel(self, keys):
+        """Drops the current batch if the server has cancelled it, as
+        another client finished some of its tasks. The local copies of its
+        tasks are cancelled too.
+        """
+        if self.command is None or not set(keys).intersection(self.keys):
+            # the results have been sent already
+            return
+        logging.debug("Batch of %d tasks cancelled." % len(self.keys))
+        if self.command == COMMAND.reducestream and not self.stream_ended:
+            self.skip_stream = self.keys[0]
+        self.queue.clear()
+        self.working = {}
+        self.command = None
+        self.tasks = {}
+        self.results = {}
+        self.server.cancel_copies(self.keys)
+        self.server.upstream.send_command(COMMAND.cancelled)
+
+    def next_batch(self, channel, size, max_bytes=0):
+        """Returns up to size tasks of the batch, for local clients that run
+        batch mappers or reducers. If max_bytes is positive, no task is added
+        once the estimated size of the tasks reaches it.
+        """
+        command, data = self.next_task(channel)
+        if command not in mince.BATCH_COMMAND:
+            return (command, data)
+        batch = [data]
+        nbytes = mince.estimate_task_bytes(data[1]) if max_bytes > 0 else 0
+        while len(batch) < size and self.queue and \
+                (max_bytes <= 0 or nbytes < max_bytes):
+            batch.append(self.next_task(channel)[1])
+            if max_bytes > 0:
+                nbytes += mince.estimate_task_bytes(batch[-1][1])
+        return (mince.BATCH_COMMAND[command], batch)
+
+    def add_usage(self, data):
+        """Adds up the usage and the counters of the local tasks, which are
+        sent upstream with the results of the batch.
+        """
+        if len(data) > 2:
+            usage = data[2]
+            self.usage['cpu'] += usage.get('cpu', 0)
+            self.usage['rss'] = max(self.usage['rss'], usage.get('rss', 0))
+            self.usage['rss_growth'] = max(self.usage['rss_growth'],
+                                           usage.get('rss_growth', 0))
+            self.usage['outputs'] += usage.get('outputs', 0)
+        if len(data) > 3:
+            sideoutput.add_counters(self.counters, data[3])
+
+    def map_done(self, data):
+        if not data[0] in self.working:
+            return
+        self.add_usage(data)
+        self.merge_results(data[1])
+        del self.working[data[0]]
+        self.check_batch_done()
+
+    def map_batch_done(self, data):
+        keys, results = data[0], data[1]
+        for key in keys:
+            if not key in self.working:
+                return
+        self.add_usage(data)
+        self.merge_results(results)
+        for key in keys:
+            del self.working[key]
+        self.check_batch_done()
+
+    def merge_results(self, results):
+        if results is not None:
+            for (key, values) in results.items():
+                self.results[key] = columnar.extend(self.results.get(key),
+                                                    values)
+
+    def reduce_done(self, data):
+        if not data[0] in self.working:
+            return
+        self.add_usage(data)
+        if data[1] is not None:
+            self.results[data[0]] = data[1]
+        del self.working[data[0]]
+        self.check_batch_done()
+
+    def reduce_batch_done(self, data):
+        keys, results = data[0], data[1]
+        self.add_usage(data)
+        for key in keys:
+            self.reduce_done((key, results.get(key)))
+
+    def check_batch_done(self):
+        """Sends the results upstream if all the tasks of the batch are done.
+        """
+        if self.queue or self.working:
+            return
+        upstream = self.server.upstream
+        usage = dict(self.usage, wall=time.time() - self.start_time)
+        if self.command == COMMAND.map:
+            if self.combiner is None:
+                self.combiner = mapreducer.COMBINER(FLAGS.combiner)
+            mapreducer.combine(self.combiner, self.results)
+            results = columnar.encode(self.results)
+            if self.single:
+                upstream.send_command(COMMAND.mapdone,
+                        (self.keys[0], results, usage, self.counters))
+            else:
+                upstream.send_command(COMMAND.mapbatchdone,
+                        (self.keys, results, usage, self.counters))
+        else:
+            if self.single:
+                upstream.send_command(COMMAND.reducedone,
+                        (self.keys[0], self.results.get(self.keys[0]),
+                         usage, self.counters))
+            else:
+                upstream.send_command(COMMAND.reducebatchdone,
+                        (self.keys, self.results, usage, self.counters))
+        logging.debug("Finished %d tasks." % len(self.keys))
+        self.command = None
+        self.tasks = {}
+        self.results = {}
+
+if __name__ == "__main__":
+    print(__doc__)
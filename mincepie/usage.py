@@ -0,0 +1,202 @@
+"""
+The usage module measures the resources used by each task.
+
+When the summary is enabled with --usage_top, each client measures the wall
+time, the cpu time and the memory of the tasks it runs, counts the values
+they output, and attaches these numbers to the mapdone / reducedone replies
+(as the third element of the reply). The server gathers them, and logs a
+summary at the end of the job: the totals, the slowest tasks, the tasks during
+which the memory of their client grew the most, and the clients with the
+lowest throughput. This helps finding the inputs or keys that make the job
+tail long. Sub-servers report the usage of their local clients this way, and
+send the summed usage of each batch upstream with its results.
+
+The memory growth of a task is the resident memory of its client at the end
+of the task, or at the highest point the task reached if it raised the peak
+of the process, minus the resident memory at its start. The current resident
+memory is read from /proc/self/statm, so the growth is only measured on
+Linux; elsewhere it is reported as 0. The peak memory is measured with the
+resource module, which is not available on Windows; it is then reported as 0.
+
+Flags defined by this module:
+    --usage_top: the number of tasks and clients listed in each part of the
+        summary. Default 0, which disables the measures and the summary.
+"""
+
+# python modules
+import gflags
+import heapq
+import logging
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+gflags.DEFINE_integer("usage_top", 0,
+    "The number of tasks and clients listed in the resource usage summary")
+FLAGS = gflags.FLAGS
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def cpu_time():
+    """Returns the user and system cpu time of the process, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_rss():
+    """Returns the peak resident memory of the process, in megabytes.
+    """
+    if resource is None:
+        return 0.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes instead of kilobytes
+        maxrss /= 1024.
+    return maxrss / 1024.
+
+
+def current_rss():
+    """Returns the current resident memory of the process, in megabytes, or
+    None if it cannot be read.
+    """
+    try:
+        with open('/proc/self/statm') as fid:
+            pages = int(fid.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * PAGE_SIZE / 1048576.
+
+
+class TaskMeter(object):
+    """Measures the resources used by the task running on a client.
+    """
+    def __init__(self):
+        self.start = None
+
+    def begin(self):
+        """Starts measuring, unless a task (such as a streamed reduce, which
+        spans several messages) is already being measured, or the usage
+        summary is disabled.
+        """
+        if self.start is None and FLAGS.usage_top > 0:
+            self.start = (time.time(), cpu_time(), peak_rss(), current_rss())
+
+    def end(self, outputs):
+        """Stops measuring, and returns the usage of the task as a dictionary
+        with the wall and cpu seconds, the peak memory of the process and the
+        growth of its resident memory during the task in megabytes, and the
+        given number of outputs. The dictionary is empty if the usage summary
+        is disabled.
+        """
+        if FLAGS.usage_top <= 0:
+            self.start = None
+            return {}
+        if self.start is None:
+            self.begin()
+        wall, cpu, peak_before, rss_before = self.start
+        self.start = None
+        peak = peak_rss()
+        rss = current_rss()
+        if rss is None or rss_before is None:
+            growth = 0.
+        elif peak > peak_before:
+            # the task raised the peak of the process: the memory it reached
+            # is higher than what remains at its end
+            growth = max(peak, rss) - rss_before
+        else:
+            growth = rss - rss_before
+        return {'wall': time.time() - wall,
+                'cpu': cpu_time() - cpu,
+                'rss': peak,
+                'rss_growth': max(growth, 0.),
+                'outputs': outputs,
+               }
+
+
+def task_name(task):
+    """Returns a short description of a task key, or of a batch of keys.
+    """
+    if isinstance(task, list):
+        if len(task) == 1:
+            return repr(task[0])
+        return "%r (+%d more)" % (task[0] if task else None, len(task) - 1)
+    return repr(task)
+
+
+class UsageReport(object):
+    """Gathers the task usages received by the server.
+
+    Only the top FLAGS.usage_top tasks by wall time and by memory growth are
+    kept, so the report uses little memory for jobs with many tasks.
+    """
+    def __init__(self):
+        self.num_tasks = 0
+        self.totals = {'wall': 0., 'cpu': 0., 'outputs': 0}
+        self.peak_rss = 0.
+        self.slowest = []
+        self.hungriest = []
+        # client name -> [number of tasks, outputs, busy seconds]
+        self.clients = {}
+
+    def add(self, client, task, usage):
+        """Adds the usage of a task run by the given client.
+        """
+        self.num_tasks += 1
+        for name in self.totals:
+            self.totals[name] += usage.get(name, 0)
+        self.peak_rss = max(self.peak_rss, usage.get('rss', 0))
+        stats = self.clients.setdefault(client, [0, 0, 0.])
+        stats[0] += 1
+        stats[1] += usage.get('outputs', 0)
+        stats[2] += usage.get('wall', 0)
+        if FLAGS.usage_top > 0:
+            self._push(self.slowest, usage.get('wall', 0), task, client)
+            self._push(self.hungriest, usage.get('rss_growth', 0), task,
+                       client)
+
+    def _push(self, heap, value, task, client):
+        # a min-heap of the top values; the task description is only
+        # computed for the tasks that make it to the heap.
+        if len(heap) < FLAGS.usage_top:
+            heapq.heappush(heap, (value, task_name(task), client))
+        elif value > heap[0][0]:
+            heapq.heapreplace(heap, (value, task_name(task), client))
+
+    def report(self):
+        """Logs the summary of the job.
+        """
+        if FLAGS.usage_top <= 0 or self.num_tasks == 0:
+            return
+        logging.info("Resource usage of %d tasks: %.1f wall seconds, %.1f "
+                     "cpu seconds, %d outputs, %.1f MB peak client memory."
+                     % (self.num_tasks, self.totals['wall'],
+                        self.totals['cpu'], self.totals['outputs'],
+                        self.peak_rss))
+        logging.info("Slowest tasks:")
+        for wall, task, client in sorted(self.slowest, reverse=True):
+            logging.info("  %.3fs %s on %s" % (wall, task, client))
+        logging.info("Tasks with the largest memory growth:")
+        for growth, task, client in sorted(self.hungriest, reverse=True):
+            logging.info("  %.1fMB %s on %s" % (growth, task, client))
+        logging.info("Clients with the lowest throughput:")
+        throughputs = [(num_tasks / max(busy, 1e-6), client, num_tasks,
+                        outputs)
+                       for client, (num_tasks, outputs, busy)
+                       in self.clients.items()]
+        throughputs.sort()
+        for throughput, client, num_tasks, outputs in \
+                throughputs[:FLAGS.usage_top]:
+            logging.info("  %.2f tasks/s %s (%d tasks, %d outputs)"
+                         % (throughput, client, num_tasks, outputs))
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,100 @@
+"""Tests of the columns holding the values of the intermediate keys.
+"""
+
+# python modules
+import array
+import pickle
+import unittest
+
+import gflags
+from mincepie import columnar
+from mincepie import mapreducer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FLAGS = gflags.FLAGS
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ArrayColumnTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_extend(self):
+        column = columnar.extend(None, numpy.arange(3))
+        self.assertTrue(isinstance(column, columnar.ArrayColumn))
+        for start in range(3, 30, 3):
+            self.assertTrue(columnar.extend(column, numpy.arange(start,
+                                                                 start + 3))
+                            is column)
+        self.assertEqual(len(column), 30)
+        self.assertTrue(numpy.array_equal(column.array(), numpy.arange(30)))
+        self.assertEqual(column[4], 4)
+        self.assertEqual(sum(column), sum(range(30)))
+
+    def test_upcast(self):
+        column = columnar.extend(None, numpy.arange(2))
+        column = columnar.extend(column, numpy.array([0.5]))
+        self.assertEqual(column.array().dtype, numpy.float64)
+        self.assertEqual(list(column), [0, 1, 0.5])
+
+    def test_rows(self):
+        # the values may be arrays themselves, stacked along the first axis
+        column = columnar.extend([], numpy.ones((2, 3)))
+        column = columnar.extend(column, numpy.zeros((1, 3)))
+        self.assertEqual(numpy.asarray(column).shape, (3, 3))
+
+    def test_pickle(self):
+        column = columnar.extend(None, numpy.arange(5.))
+        values = pickle.loads(pickle.dumps(column, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(isinstance(values, numpy.ndarray))
+        self.assertTrue(numpy.array_equal(values, numpy.arange(5.)))
+
+    def test_list(self):
+        # python values stay in a list, and arrays added to it are unboxed
+        column = columnar.extend(None, [1, 2])
+        column = columnar.extend(column, numpy.arange(2))
+        self.assertEqual(column, [1, 2, 0, 1])
+        self.assertEqual([type(value) for value in column], [int] * 4)
+        self.assertEqual(columnar.concatenate([[1], numpy.arange(2)]),
+                         [1, 0, 1])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TypedColumnTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.value_type = 'd'
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_extend(self):
+        column = columnar.extend(None, numpy.arange(3))
+        column = columnar.extend(column, numpy.arange(6)[::2])
+        column = columnar.extend(column, [7])
+        self.assertEqual(column, array.array('d', [0, 1, 2, 0, 2, 4, 7]))
+
+    def test_results(self):
+        results = columnar.encode({'a': numpy.arange(3), 'b': [5.]})
+        results = pickle.loads(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(dict(results.items()),
+                         {'a': array.array('d', [0, 1, 2]),
+                          'b': array.array('d', [5])})
+
+    def test_batch_reducer(self):
+        # the reducer gets a view of the typed column
+        reducer = mapreducer.ArraySumReducer()
+        columns = [array.array('d', [1, 2]), array.array('d', [3])]
+        self.assertEqual(reducer.reduce_batch_list(['a', 'b'], columns),
+                         [3, 3])
+        self.assertEqual(reducer.reduce('a', columns[0]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
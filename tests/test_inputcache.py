@@ -0,0 +1,83 @@
+"""Tests that the cached expansion of the input patterns matches glob.
+"""
+
+# python modules
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gflags
+from mincepie import inputcache
+
+FLAGS = gflags.FLAGS
+
+PATTERNS = ['*', '*/', '*//', '*/*', 'a/*/', '*/*/', '*/*.txt', '*/sub/',
+            '*/sub', 'a/x.txt', 'a/', 'top.txt', 'missing', 'missing/*',
+            '.*', '*/.*', 'a/[xy].txt', '[ab]/*', 'a/*/*']
+
+
+class GlobTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.input_cache = True
+        FLAGS.input_cache_threads = 2
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        FLAGS.input_cache_dir = os.path.join(self.root, 'cache')
+        self.directory = os.path.join(self.root, 'input')
+        for name in ['a/sub/', 'b/', '.hidden/']:
+            os.makedirs(os.path.join(self.directory, name))
+        for name in ['top.txt', '.top', 'a/x.txt', 'a/y.txt', 'a/sub/z.txt',
+                     'b/y.txt', 'b/.y']:
+            with open(os.path.join(self.directory, name), 'w') as fid:
+                fid.write(name)
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+        FLAGS.Reset()
+
+    def age(self):
+        # directories modified just now are not cached
+        past = time.time() - 100
+        for path, _, _ in os.walk(self.directory):
+            os.utime(path, (past, past))
+
+    def check(self, patterns):
+        for pattern in patterns:
+            self.assertEqual(inputcache.glob_files(pattern),
+                             sorted(glob.glob(pattern)), pattern)
+
+    def test_glob(self):
+        self.check(PATTERNS)
+
+    def test_absolute(self):
+        self.check([os.path.join(self.directory, pattern)
+                    for pattern in ['*/', 'a/*/', '*/*.txt', 'a/x.txt']])
+
+    def test_cached(self):
+        patterns = ['*/', 'a/*/', '*/*.txt']
+        self.age()
+        self.check(patterns)
+        self.assertTrue(os.path.exists(inputcache.cache_name('*/*.txt')))
+        # from the cache
+        self.check(patterns)
+        # a new file changes the modification time of its directory
+        with open(os.path.join(self.directory, 'a', 'w.txt'), 'w') as fid:
+            fid.write('w')
+        self.check(patterns)
+        self.assertTrue('a/w.txt' in inputcache.glob_files('*/*.txt'))
+
+    def test_no_cache(self):
+        FLAGS.input_cache = False
+        self.age()
+        self.check(PATTERNS)
+        self.assertFalse(os.path.exists(FLAGS.input_cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests of saving the intermediate data and running the reduce phase again
+from it with --reduce_only.
+"""
+
+# python modules
+import os
+import shutil
+import tempfile
+import unittest
+
+import gflags
+from mincepie import intermediate
+from mincepie import mapreducer
+from mincepie import mpitransport
+
+FLAGS = gflags.FLAGS
+
+
+class SavedResultWriter(mapreducer.BasicWriter):
+    """Keeps the results of the last job.
+    """
+    results = None
+
+    def write(self, result):
+        SavedResultWriter.results = dict(result)
+
+mapreducer.REGISTER_WRITER(SavedResultWriter)
+
+
+class Unpicklable(object):
+    def __reduce__(self):
+        raise RuntimeError("cannot be saved")
+
+
+class IntermediateTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.intermediate_partitions = 3
+        self.directory = tempfile.mkdtemp()
+        FLAGS.intermediate_dir = self.directory
+        SavedResultWriter.results = None
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        FLAGS.Reset()
+
+    def test_save_load(self):
+        map_results = {'a': [1, 2, 3], 'b': ['x'], (1, 2): [None] * 100}
+        intermediate.save(map_results)
+        loaded = intermediate.load()
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(sorted(loaded), sorted(map_results))
+        self.assertEqual(dict(loaded.items()), map_results)
+        self.assertEqual(loaded.count('a'), 3)
+        self.assertEqual(list(loaded.slice('a', 1, 3)), [2, 3])
+        self.assertEqual([list(chunk) for chunk in loaded.chunks('a', 2)],
+                         [[1, 2], [3]])
+        self.assertEqual(loaded.hot_keys(50, 0), set([(1, 2)]))
+
+    def test_interrupted_save(self):
+        intermediate.save({'a': [1]})
+        # a save that fails half way leaves no index, rather than the index
+        # of the previous save over the new partition files
+        self.assertRaises(RuntimeError, intermediate.save,
+                          {'a': [2], 'b': [Unpicklable()]})
+        self.assertFalse(os.path.exists(os.path.join(
+                self.directory, intermediate.INDEX_NAME)))
+        self.assertRaises(IOError, intermediate.load)
+        intermediate.save({'a': [3]})
+        self.assertEqual(dict(intermediate.load().items()), {'a': [3]})
+
+    def test_reduce_only(self):
+        FLAGS.reader = 'IterateReader'
+        FLAGS.input = '10'
+        FLAGS.mapper = 'IdentityMapper'
+        FLAGS.reducer = 'SumReducer'
+        FLAGS.writer = 'SavedResultWriter'
+        mpitransport.run_local(2)
+        self.assertEqual(SavedResultWriter.results,
+                         dict((key, key) for key in range(10)))
+        # the input is not read again: the reduce phase runs on the saved
+        # data, here with another reducer
+        FLAGS.reduce_only = True
+        FLAGS.input = '0'
+        FLAGS.reducer = 'IdentityReducer'
+        mpitransport.run_local(2)
+        self.assertEqual(dict((key, list(values)) for key, values in
+                              SavedResultWriter.results.items()),
+                         dict((key, [key]) for key in range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Tests of the native MPI transport, run over the in-process LocalComm.
+"""
+
+# python modules
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gflags
+from mincepie import mapreducer
+from mincepie import mince
+from mincepie import mpitransport
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FLAGS = gflags.FLAGS
+
+
+class ModuloMapper(mapreducer.BasicMapper):
+    def map(self, key, value):
+        yield key % 3, value
+
+mapreducer.REGISTER_MAPPER(ModuloMapper)
+
+
+class SlowMapper(mapreducer.BasicMapper):
+    """Gets stuck for a while on the input 5.
+    """
+    def map(self, key, value):
+        if key == 5:
+            time.sleep(1)
+        yield key % 3, value
+
+mapreducer.REGISTER_MAPPER(SlowMapper)
+
+
+class ArrayMapper(mapreducer.BasicMapper):
+    """Emits arrays large enough to be sent as raw buffers.
+    """
+    def map(self, key, value):
+        yield key % 2, numpy.arange(256.) * value
+
+mapreducer.REGISTER_MAPPER(ArrayMapper)
+
+
+class ResultWriter(mapreducer.BasicWriter):
+    """Keeps the results of the last job.
+    """
+    results = None
+
+    def write(self, result):
+        ResultWriter.results = dict(result)
+
+mapreducer.REGISTER_WRITER(ResultWriter)
+
+
+class StallingTaskManager(mince.TaskManager):
+    """A task manager that leaves the clients idle after a few maps.
+    """
+    def next_task(self, channel):
+        if self.num_done_maps >= 4:
+            self.idle.add(channel)
+            return (None, None)
+        return super(StallingTaskManager, self).next_task(channel)
+
+
+class RunLocalTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.reader = 'IterateReader'
+        FLAGS.input = '10'
+        FLAGS.mapper = 'ModuloMapper'
+        FLAGS.reducer = 'SumReducer'
+        FLAGS.writer = 'ResultWriter'
+        ResultWriter.results = None
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_run_local(self):
+        mpitransport.run_local(3)
+        self.assertEqual(ResultWriter.results, {0: 18, 1: 12, 2: 15})
+
+    def test_sharded_total_order(self):
+        # the clients write the shards, and the server only gets their names
+        FLAGS.input = '20'
+        FLAGS.total_order = True
+        FLAGS.num_partitions = 2
+        FLAGS.writer = 'ShardedFileWriter'
+        output_dir = tempfile.mkdtemp()
+        try:
+            FLAGS.output = os.path.join(output_dir, 'out')
+            mpitransport.run_local(2)
+            names = sorted(glob.glob(FLAGS.output + '*'))
+            self.assertEqual([os.path.basename(name) for name in names],
+                             ['out-00000-of-00002', 'out-00001-of-00002'])
+            lines = []
+            for name in names:
+                with open(name) as fid:
+                    lines.extend(fid.read().splitlines())
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertEqual(lines, ['0:63', '1:70', '2:57'])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_array_payload(self):
+        FLAGS.mapper = 'ArrayMapper'
+        mpitransport.run_local(2)
+        expected = {0: numpy.arange(256.) * 20, 1: numpy.arange(256.) * 25}
+        self.assertEqual(sorted(ResultWriter.results), [0, 1])
+        for key, values in expected.items():
+            self.assertTrue(numpy.array_equal(ResultWriter.results[key],
+                                              values))
+
+    def test_task_timeout(self):
+        # the server polls for replies, so the stuck client times out and
+        # the others go on without its task
+        FLAGS.mapper = 'SlowMapper'
+        FLAGS.task_timeout = 0.3
+        FLAGS.max_attempts = 1
+        mpitransport.run_local(2)
+        self.assertEqual(ResultWriter.results, {0: 18, 1: 12, 2: 10})
+
+    def test_idle_clients(self):
+        # no reply is coming: the server lets the clients go instead of
+        # waiting forever
+        task_manager = mince.TaskManager
+        mince.TaskManager = StallingTaskManager
+        try:
+            self.assertRaises(SystemExit, mpitransport.run_local, 2)
+        finally:
+            mince.TaskManager = task_manager
+        self.assertEqual(ResultWriter.results, None)
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ArrayMessageTest(unittest.TestCase):
+    def test_send_recv(self):
+        comms = mpitransport.LocalComm.create(2)
+        values = numpy.arange(1000, dtype=numpy.int32).reshape(10, 100)
+        mpitransport.send(comms[0], 1, mince.COMMAND.mapdone,
+                          ('key', {'a': values[:, ::2], 'b': [1, 2]}))
+        # the array is out of the pickle, in its own message
+        messages = comms[1].mailboxes[1].messages
+        self.assertEqual([tag for _, tag, _ in messages],
+                         [mpitransport.TAG_COMMAND, mpitransport.TAG_ARRAY])
+        source, command, data = mpitransport.recv(comms[1], 0)
+        self.assertEqual((source, command), (0, mince.COMMAND.mapdone))
+        self.assertEqual(data[0], 'key')
+        self.assertEqual(data[1]['b'], [1, 2])
+        self.assertEqual(data[1]['a'].dtype, values.dtype)
+        self.assertTrue(numpy.array_equal(data[1]['a'], values[:, ::2]))
+
+    def test_small_array(self):
+        comms = mpitransport.LocalComm.create(2)
+        mpitransport.send(comms[0], 1, mince.COMMAND.reducedone,
+                          ('key', numpy.arange(4)))
+        self.assertEqual(len(comms[1].mailboxes[1].messages), 1)
+        data = mpitransport.recv(comms[1], 0)[2]
+        self.assertTrue(numpy.array_equal(data[1], numpy.arange(4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Tests of the wire protocol against peers that predate the protocol
+version: the first releases of the server and client, emulated here over a
+plain socket.
+"""
+
+# python modules
+import asyncore
+import cPickle as pickle
+import hashlib
+import hmac
+import os
+import socket
+import threading
+import unittest
+
+import gflags
+from mincepie import mapreducer
+from mincepie import mince
+
+FLAGS = gflags.FLAGS
+
+# the commands known to the first releases
+BASELINE_COMMANDS = ('challenge', 'auth', 'disconnect', 'map', 'reduce',
+                     'mapdone', 'reducedone')
+
+
+class WordMapper(mapreducer.BasicMapper):
+    def map(self, key, value):
+        for word in value.split():
+            yield word, 1
+
+mapreducer.REGISTER_MAPPER(WordMapper)
+
+
+class BaselinePeer(object):
+    """One end of a connection that speaks the protocol of the first
+    releases: "command:argument" lines before the authentication, and
+    "command:length" lines followed by pickled data after it. Like the
+    first releases, it fails on any command it does not know.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(10)
+        self.fid = sock.makefile('rb')
+
+    def send_arg(self, command, arg=''):
+        self.sock.sendall("%s:%s\n" % (command, arg))
+
+    def send_data(self, command, data):
+        pdata = pickle.dumps(data)
+        self.sock.sendall("%s:%d\n%s" % (command, len(pdata), pdata))
+
+    def read_line(self):
+        line = self.fid.readline()
+        if not line:
+            return None, None
+        command, _, arg = line[:-1].partition(':')
+        if command not in BASELINE_COMMANDS:
+            raise AssertionError("Unknown command received: " + command)
+        return command, arg
+
+    def read_command(self):
+        """Reads an authenticated command, and returns the command and its
+        payload, unpickled.
+        """
+        command, length = self.read_line()
+        if command in (None, 'challenge') or not length:
+            return command, length
+        payload = self.fid.read(int(length))
+        # the first releases do not have the modules added since
+        if 'mincepie' in payload:
+            raise AssertionError("Unknown module in the %s data." % command)
+        return command, pickle.loads(payload)
+
+    def answer_challenge(self):
+        command, challenge = self.read_line()
+        assert command == 'challenge'
+        mac = hmac.new(FLAGS.password, challenge, hashlib.sha1)
+        self.send_arg('auth', mac.digest().encode("hex"))
+
+    def challenge(self):
+        challenge = os.urandom(20).encode("hex")
+        self.send_arg('challenge', challenge)
+        return hmac.new(FLAGS.password, challenge,
+                        hashlib.sha1).digest().encode("hex")
+
+    def close(self):
+        self.fid.close()
+        self.sock.close()
+
+
+class BaselinePeerTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.mapper = 'WordMapper'
+        FLAGS.reducer = 'SumReducer'
+
+    def tearDown(self):
+        FLAGS.Reset()
+        asyncore.close_all()
+
+    def run_in_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_baseline_client(self):
+        # the parts of the hot key are reduced under the key itself
+        FLAGS.hot_key_values = 2
+        server = mince.Server()
+        server.datasource = {0: 'a b', 1: 'b'}
+        server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(1)
+        thread = self.run_in_thread(server.loop)
+        client = BaselinePeer(socket.create_connection(
+                server.socket.getsockname()))
+        client.answer_challenge()
+        expected = client.challenge()
+        self.assertEqual(client.read_line(), ('auth', expected))
+        while True:
+            command, data = client.read_command()
+            if command == 'map':
+                results = {}
+                for word in data[1].split():
+                    results.setdefault(word, []).append(1)
+                client.send_data('mapdone', (data[0], results))
+            elif command == 'reduce':
+                client.send_data('reducedone', (data[0], sum(data[1])))
+            else:
+                break
+        self.assertEqual(command, 'disconnect')
+        client.close()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(dict(server.taskmanager.results), {'a': 1, 'b': 2})
+
+    def test_baseline_server(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        client = mince.Client()
+        thread = self.run_in_thread(
+                lambda: client.run_client(*listener.getsockname()))
+        listener.settimeout(10)
+        server = BaselinePeer(listener.accept()[0])
+        listener.close()
+        expected = server.challenge()
+        self.assertEqual(server.read_line(), ('auth', expected))
+        server.answer_challenge()
+        server.send_data('map', (0, 'a b a'))
+        command, data = server.read_command()
+        self.assertEqual(command, 'mapdone')
+        self.assertEqual(data[0], 0)
+        self.assertEqual(dict(data[1]), {'a': [1, 1], 'b': [1]})
+        server.send_arg('disconnect')
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Tests of the stores of the intermediate values and the results.
+"""
+
+# python modules
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import gflags
+from mincepie import storage
+
+FLAGS = gflags.FLAGS
+
+
+class StoreTests(object):
+    """The tests run on every store. Subclasses set the storage name.
+    """
+    storage = None
+
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.storage = self.storage
+        self.storage_dir = tempfile.mkdtemp()
+        FLAGS.storage_dir = self.storage_dir
+        self.store = storage.new_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.storage_dir)
+        FLAGS.Reset()
+
+    def test_append(self):
+        self.store.append('a', [1, 2])
+        self.store.append('b', ['x'])
+        self.store.append('a', iter([3]))
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(sorted(self.store), ['a', 'b'])
+        self.assertTrue('a' in self.store)
+        self.assertFalse('c' in self.store)
+        self.assertEqual(list(self.store['a']), [1, 2, 3])
+        self.assertEqual(list(self.store['b']), ['x'])
+        self.assertEqual(self.store.count('a'), 3)
+        self.assertEqual(self.store.count('b'), 1)
+        self.assertRaises(KeyError, lambda: self.store['c'])
+
+    def test_set(self):
+        self.store['a'] = 5
+        self.store.append('b', [1])
+        self.store['b'] = [7]
+        self.assertEqual(self.store['a'], 5)
+        self.assertEqual(list(self.store['b']), [7])
+        self.assertEqual(sorted(self.store.items()), [('a', 5), ('b', [7])])
+        self.assertEqual(sorted(pickle.loads(pickle.dumps(self.store)).items()),
+                         [('a', 5), ('b', [7])])
+
+    def test_slice(self):
+        for start in range(0, 10, 3):
+            self.store.append('a', range(start, min(start + 3, 10)))
+        self.assertEqual(list(self.store.slice('a', 0, 4)), [0, 1, 2, 3])
+        self.assertEqual(list(self.store.slice('a', 4, 8)), [4, 5, 6, 7])
+        self.assertEqual(list(self.store.slice('a', 8, 20)), [8, 9])
+        self.assertEqual(list(self.store.slice('a', 12, 20)), [])
+        self.assertRaises(KeyError, self.store.slice, 'b', 0, 1)
+
+    def test_chunks(self):
+        for start in range(0, 10, 3):
+            self.store.append('a', range(start, min(start + 3, 10)))
+        chunks = [list(chunk) for chunk in self.store.chunks('a', 4)]
+        self.assertEqual(chunks, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        chunks = [list(chunk) for chunk in self.store.chunks('a', 1)]
+        self.assertEqual(chunks, [[value] for value in range(10)])
+
+    def test_ordered(self):
+        store = storage.new_store(ordered=True)
+        try:
+            for key in [3, 1, 2]:
+                store[key] = key
+            self.assertEqual(list(store), [3, 1, 2])
+        finally:
+            store.close()
+
+    def test_close(self):
+        self.store.append('a', [1])
+        self.store.close()
+        self.assertEqual(os.listdir(self.storage_dir), [])
+        # for tearDown to close
+        self.store = storage.new_store()
+
+
+class MemoryStoreTest(StoreTests, unittest.TestCase):
+    storage = 'memory'
+
+
+class SqliteStoreTest(StoreTests, unittest.TestCase):
+    storage = 'sqlite'
+
+    def test_paging(self):
+        # more records than are read at a time
+        for value in range(3 * storage.READ_PAGE_SIZE + 1):
+            self.store.append('a', [value])
+            self.store.append('b', [-value])
+        self.assertEqual(list(self.store['a']),
+                         range(3 * storage.READ_PAGE_SIZE + 1))
+        self.assertEqual(list(self.store.slice('b', 1, 3)), [-1, -2])
+
+
+class LogStoreTest(StoreTests, unittest.TestCase):
+    storage = 'log'
+
+
+if __name__ == '__main__':
+    unittest.main()
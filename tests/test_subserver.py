@@ -0,0 +1,137 @@
+"""Tests of the forwarding of streamed reduce tasks by a sub-server.
+"""
+
+# python modules
+import unittest
+
+import gflags
+from mincepie import mince
+from mincepie import subserver
+from mincepie.mince import COMMAND
+
+FLAGS = gflags.FLAGS
+
+
+class FakeUpstream(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_command(self, command, data=None):
+        self.sent.append((command, data))
+
+
+class FakeSubServer(object):
+    def __init__(self):
+        self.upstream = FakeUpstream()
+        self.channels = set()
+        self.cancelled = []
+
+    def cancel_copies(self, keys):
+        self.cancelled.extend(keys)
+
+
+class FakeChannel(object):
+    """A local client recording what it is sent.
+    """
+    def __init__(self, server, version=mince.PROTOCOL_VERSION):
+        self.server = server
+        self.peer_version = version
+        self.send_buffer = 0
+        self.sent = []
+        server.channels.add(self)
+
+    def supports(self, command):
+        return command in mince.BASELINE_COMMANDS or \
+                self.peer_version >= mince.PROTOCOL_VERSION
+
+    def start_new_task(self):
+        command, data = self.server.taskmanager.next_task(self)
+        if command is not None:
+            self.sent.append((command, data))
+
+    def send_command(self, command, data=None):
+        self.sent.append((command, data))
+
+
+class StreamForwardTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        self.server = FakeSubServer()
+        self.taskmanager = subserver.BatchTaskManager(self.server)
+        self.server.taskmanager = self.taskmanager
+        self.upstream = self.server.upstream
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_forward(self):
+        client = FakeChannel(self.server)
+        client.start_new_task()
+        self.taskmanager.stream_chunk('a', [1, 2])
+        # the idle client takes the task as it starts, and gets the chunks
+        # as they arrive
+        self.assertEqual(client.sent, [(COMMAND.reducestream, ('a', [], True)),
+                                       (COMMAND.reducechunk, ('a', [1, 2]))])
+        self.taskmanager.stream_chunk('a', [3])
+        self.taskmanager.end_stream('a')
+        self.assertEqual(client.sent[2:], [(COMMAND.reducechunk, ('a', [3])),
+                                           (COMMAND.reduceend, ('a',))])
+        self.assertEqual(len(self.taskmanager.stream_chunks), 0)
+        self.taskmanager.reduce_done(('a', 6))
+        self.assertEqual(self.upstream.sent[0][0], COMMAND.reducedone)
+        self.assertEqual(self.upstream.sent[0][1][:2], ('a', 6))
+
+    def test_backpressure(self):
+        # while the client is busy, only a few chunks are kept
+        FakeChannel(self.server)
+        for value in range(mince.STREAM_QUEUE_SIZE):
+            self.assertFalse(self.taskmanager.stream_blocked())
+            self.taskmanager.stream_chunk('a', [value])
+        self.assertTrue(self.taskmanager.stream_blocked())
+
+    def test_older_client(self):
+        # an older client gets the whole task once it has arrived
+        client = FakeChannel(self.server, mince.BASELINE_VERSION)
+        client.start_new_task()
+        self.taskmanager.stream_chunk('a', [1, 2])
+        self.assertEqual(client.sent, [])
+        self.assertFalse(self.taskmanager.stream_blocked())
+        self.taskmanager.end_stream('a')
+        self.assertEqual(client.sent,
+                         [(COMMAND.reducestream, ('a', [[1, 2]], False))])
+
+    def test_lost_client(self):
+        clients = [FakeChannel(self.server), FakeChannel(self.server)]
+        for client in clients:
+            client.start_new_task()
+        self.taskmanager.stream_chunk('a', [1])
+        runner = self.taskmanager.stream_runner
+        other = [client for client in clients if client is not runner][0]
+        self.taskmanager.task_failed('a')
+        # the rest is dropped, not run again by the other client
+        self.taskmanager.stream_chunk('a', [2])
+        self.assertEqual(self.upstream.sent, [])
+        self.taskmanager.end_stream('a')
+        self.assertEqual(self.upstream.sent, [(COMMAND.cancelled, None)])
+        self.assertEqual(other.sent, [])
+        self.assertEqual(len(runner.sent), 2)
+        # the next task is taken as usual
+        self.taskmanager.add_tasks(COMMAND.reduce, [('b', [1])], True)
+        self.assertEqual(other.sent, [(COMMAND.reduce, ('b', [1]))])
+
+    def test_cancel(self):
+        client = FakeChannel(self.server)
+        client.start_new_task()
+        self.taskmanager.stream_chunk('a', [1])
+        self.taskmanager.cancel(['a'])
+        self.assertEqual(self.server.cancelled, ['a'])
+        self.assertEqual(self.upstream.sent, [(COMMAND.cancelled, None)])
+        # the chunks already on their way do not start the task again
+        self.taskmanager.stream_chunk('a', [2])
+        self.taskmanager.end_stream('a')
+        self.assertEqual(self.taskmanager.command, None)
+        self.assertEqual(self.upstream.sent, [(COMMAND.cancelled, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+"""Tests of the task manager of the server, driven by fake clients.
+"""
+
+# python modules
+import unittest
+
+import gflags
+from mincepie import mince
+from mincepie import mpitransport
+from mincepie import progress
+
+FLAGS = gflags.FLAGS
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.channels = set()
+        self.progress = progress.Progress()
+        self.taskmanager = None
+        self.closed = False
+
+    def handle_close(self):
+        self.closed = True
+
+
+class FakeChannel(object):
+    """A client that holds the task it is given until the test finishes it.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.task = None
+        server.channels.add(self)
+
+    def start_new_task(self):
+        command, data = self.server.taskmanager.next_task(self)
+        if command is not None:
+            self.task = (command, data)
+
+    def finish(self, done, data):
+        """Passes the reply of the client to the given task manager method,
+        and asks for the next task, as ServerChannel.task_done does.
+        """
+        self.task = None
+        done(data)
+        self.start_new_task()
+
+
+class IdleClientTest(unittest.TestCase):
+    """With --max_attempts=1 the last running task is not run again, so the
+    other clients wait idle until it is done. Its result should be used
+    before they move on to the next phase.
+    """
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.max_attempts = 1
+        FLAGS.reducer = 'SumReducer'
+        self.server = FakeServer()
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def start(self, num_clients):
+        self.manager = mince.TaskManager({'input': None}, self.server)
+        self.server.taskmanager = self.manager
+        clients = [FakeChannel(self.server) for _ in range(num_clients)]
+        for client in clients:
+            client.start_new_task()
+        return clients
+
+    def running(self, clients, command):
+        """Returns the clients running a task with the given command.
+        """
+        return [client for client in clients
+                if client.task is not None and client.task[0] == command]
+
+    def test_final_map_batch(self):
+        mapper, idle = self.start(2)
+        self.assertEqual(idle.task, None)
+        mapper.finish(self.manager.map_batch_done,
+                      (['input'], {'word': [1, 2]}))
+        self.assertEqual(idle.task, (mince.COMMAND.reduce, ('word', [1, 2])))
+        self.assertFalse(self.server.closed)
+        idle.finish(self.manager.reduce_done, ('word', 3))
+        self.assertTrue(self.server.closed)
+        self.assertEqual(dict(self.manager.results), {'word': 3})
+
+    def test_split_hot_key(self):
+        FLAGS.hot_key_values = 2
+        clients = self.start(3)
+        clients[0].finish(self.manager.map_done,
+                          ('input', {'word': [1, 2, 3, 4]}))
+        reducers = self.running(clients, mince.COMMAND.reduce)
+        self.assertEqual(len(reducers), 2)
+        for client in reducers:
+            task = client.task[1][0]
+            self.assertTrue(isinstance(task, mince.SplitTask))
+            client.finish(self.manager.reduce_done,
+                          (task, 3 if task.part == 0 else 7))
+        # the merge of the parts goes to one of the idle clients
+        merges = self.running(clients, mince.COMMAND.reduce)
+        self.assertEqual([client.task for client in merges],
+                         [(mince.COMMAND.reduce, ('word', [3, 7]))])
+        self.assertFalse(self.server.closed)
+        merges[0].finish(self.manager.reduce_done, ('word', 10))
+        self.assertTrue(self.server.closed)
+        self.assertEqual(dict(self.manager.results), {'word': 10})
+
+    def test_total_order(self):
+        FLAGS.total_order = True
+        FLAGS.num_partitions = 1
+        mapper, idle = self.start(2)
+        mapper.finish(self.manager.map_done, ('input', {'b': [1], 'a': [2]}))
+        self.assertEqual(idle.task[0], mince.COMMAND.reducepartition)
+        partition = idle.task[1][0]
+        idle.finish(self.manager.reduce_done,
+                    (partition, [('a', 2), ('b', 1)]))
+        self.assertTrue(self.server.closed)
+        self.assertEqual(list(self.manager.results.items()),
+                         [('a', 2), ('b', 1)])
+
+
+class BookkeepingTest(unittest.TestCase):
+    """The number of copies and failed attempts of the running tasks, as
+    tasks are run again, cancelled, failed and stolen.
+    """
+    def setUp(self):
+        FLAGS(['test'])
+        FLAGS.max_attempts = 3
+        FLAGS.reducer = 'SumReducer'
+        self.server = FakeServer()
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def start(self, datasource, num_clients):
+        self.manager = mince.TaskManager(datasource, self.server)
+        self.server.taskmanager = self.manager
+        clients = [FakeChannel(self.server) for _ in range(num_clients)]
+        for client in clients:
+            client.start_new_task()
+        return clients
+
+    def test_cancel(self):
+        # the idle client runs a copy of the only task
+        first, second = self.start({'input': None}, 2)
+        self.assertEqual(second.task, first.task)
+        self.assertEqual(self.manager.copies, {'input': 2})
+        # cancelled copies are not failed attempts
+        self.manager.task_cancelled('input')
+        self.assertEqual(self.manager.copies, {'input': 1})
+        self.assertTrue('input' in self.manager.working_maps)
+        self.manager.task_cancelled('input')
+        self.assertEqual(self.manager.attempts, {})
+        self.assertFalse('input' in self.manager.working_maps)
+        self.assertEqual(list(self.manager.retry_maps), ['input'])
+        # a late cancel does not go below zero
+        self.manager.task_cancelled('input')
+        self.assertEqual(self.manager.copies, {'input': 0})
+
+    def test_late_reply(self):
+        first, second = self.start({'input': None}, 2)
+        first.finish(self.manager.map_done, ('input', {'word': [1]}))
+        self.assertFalse('input' in self.manager.copies)
+        # the result of the other copy is dropped
+        self.manager.map_done(('input', {'word': [2]}))
+        self.assertEqual(self.manager.num_done_maps, 1)
+        self.assertEqual(list(self.manager.map_results['word']), [1])
+        # and so is a failure reported after the task is done
+        self.manager.task_failed('input')
+        self.assertEqual(self.manager.attempts, {})
+
+    def test_failed_attempts(self):
+        FLAGS.max_attempts = 2
+        self.start({'input': None}, 2)
+        self.manager.task_failed('input')
+        self.assertEqual(self.manager.copies, {'input': 1})
+        self.assertEqual(self.manager.attempts, {'input': 1})
+        self.assertTrue('input' in self.manager.working_maps)
+        self.manager.task_failed('input')
+        self.assertEqual(self.manager.copies, {})
+        self.assertEqual(self.manager.quarantine[mince.COMMAND.map],
+                         {'input': None})
+        self.assertEqual(self.manager.num_done_maps, 1)
+
+    def test_rerun_limit(self):
+        # a task that failed twice out of three attempts runs on one client
+        # at a time
+        self.manager = mince.TaskManager({'input': None}, self.server)
+        self.manager.attempts = {'input': 2}
+        self.server.taskmanager = self.manager
+        first, second = [FakeChannel(self.server) for _ in range(2)]
+        first.start_new_task()
+        second.start_new_task()
+        self.assertEqual(second.task, None)
+        self.assertEqual(self.manager.copies, {'input': 1})
+
+    def test_steal(self):
+        datasource = dict(('input%d' % i, i) for i in range(6))
+        self.manager = mince.TaskManager(datasource, self.server)
+        self.server.taskmanager = self.manager
+        victim = FakeChannel(self.server)
+        command, batch = self.manager.next_batch(victim, 6)
+        self.assertEqual(command, mince.COMMAND.mapbatch)
+        keys = [key for key, _ in batch]
+        stolen = keys[-2:]
+        self.assertEqual(self.manager.steal(stolen),
+                         (mince.COMMAND.mapbatch,
+                          [(key, datasource[key]) for key in stolen]))
+        # the stolen tasks still have a single copy, on the thief
+        self.assertEqual(self.manager.copies, dict((key, 1) for key in keys))
+        self.assertEqual(self.manager.attempts, {})
+        # so a failure of the thief queues them again
+        self.manager.task_failed(stolen[0])
+        self.assertEqual(list(self.manager.retry_maps), [stolen[0]])
+        self.assertEqual(self.manager.attempts, {stolen[0]: 1})
+        # tasks that are not running cannot be stolen
+        self.assertEqual(self.manager.steal([stolen[0]]), None)
+        self.manager.map_batch_done((stolen[1:], {'word': [1]}))
+        self.assertFalse(stolen[1] in self.manager.copies)
+        self.manager.map_batch_done((keys[:-2], {'word': [2]}))
+        self.assertEqual(sorted(self.manager.copies), [stolen[0]])
+        self.assertEqual(self.manager.num_done_maps, 5)
+
+
+class LateReplyTest(unittest.TestCase):
+    """Replies carry the task token of their task, so the reply to an older
+    task is dropped before being unpickled.
+    """
+    def setUp(self):
+        FLAGS(['test'])
+        self.channel = mpitransport.MPIChannel(FakeServer(), 1)
+        self.channel.frame_input = True
+        self.channel.task_token = 3
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_skip(self):
+        self.channel.frame_received(2)
+        self.assertTrue(self.channel.skip_data(mince.COMMAND.mapdone))
+        # only results are dropped
+        self.assertFalse(self.channel.skip_data(mince.COMMAND.register))
+        self.channel.frame_received(3)
+        self.assertFalse(self.channel.skip_data(mince.COMMAND.mapdone))
+        # as are the results of a cancelled task
+        self.channel.cancelling = True
+        self.assertTrue(self.channel.skip_data(mince.COMMAND.reducedone))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Tests of the measures of the resources used by each task.
+"""
+
+# python modules
+import unittest
+
+import gflags
+from mincepie import usage
+
+FLAGS = gflags.FLAGS
+
+
+class TaskMeterTest(unittest.TestCase):
+    def setUp(self):
+        FLAGS(['test'])
+        self.meter = usage.TaskMeter()
+
+    def tearDown(self):
+        FLAGS.Reset()
+
+    def test_disabled(self):
+        self.meter.begin()
+        self.assertEqual(self.meter.end(3), {})
+
+    @unittest.skipIf(usage.current_rss() is None, "no /proc/self/statm")
+    def test_growth(self):
+        FLAGS.usage_top = 10
+        # a task that keeps its memory, after one that used more
+        self.meter.begin()
+        ' ' * (200 << 20)
+        self.meter.end(0)
+        self.meter.begin()
+        kept = ' ' * (50 << 20)
+        task_usage = self.meter.end(1)
+        self.assertTrue(task_usage['rss_growth'] > 40, task_usage)
+        self.assertTrue(task_usage['rss'] >= usage.current_rss())
+        self.assertEqual(task_usage['outputs'], 1)
+        del kept
+
+
+if __name__ == '__main__':
+    unittest.main()